@@ -0,0 +1,72 @@
+'''
+谱截断各特征分解方式的耗时与精度（cojo_engine.spectral_truncation）
+LD 用 AR(ρ) 基因型样本的相关矩阵：n > p 时满秩，阈值 0.2 附近有大量特征值，是 'auto' 选择的真实情形
+用法：
+    python benchmarks/bench_spectral_solver.py --p 12000 --n 5000
+    python benchmarks/bench_spectral_solver.py --p 3000 --n 5000 --solvers auto subset randomized dense
+默认只跑 'auto' 与 'subset'（p ≥ 12000 时 'randomized' 可能要几分钟，需要时用 --solvers 指定）
+'''
+import sys
+import time
+import argparse
+import warnings
+import numpy as np
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+from cojo_engine import spectral_truncation, choose_spectral_solver, truncation_threshold
+
+
+def ar_ld(p, n, rho=0.9, seed=0, chunk=2000):
+    """n 个样本、p 个 SNP 的 AR(ρ) 基因型相关矩阵（分块生成，只保留 R）"""
+    rng = np.random.default_rng(seed)
+    X = np.empty((n, p))
+    X[:, 0] = rng.standard_normal(n)
+    scale = np.sqrt(1 - rho ** 2)
+    for start in range(1, p, chunk):
+        stop = min(p, start + chunk)
+        eps = rng.standard_normal((n, stop - start))
+        for j in range(start, stop):
+            X[:, j] = rho * X[:, j - 1] + scale * eps[:, j - start]
+    X -= X.mean(axis=0)
+    X /= np.linalg.norm(X, axis=0)
+    R = X.T @ X
+    del X
+    np.fill_diagonal(R, 1.0)
+    return R
+
+
+def run(p, n, rho, solvers, seed=0):
+    t0 = time.perf_counter()
+    R = ar_ld(p, n, rho, seed)
+    print(f"p={p} n={n} ρ={rho}: 生成 LD {time.perf_counter() - t0:.1f}s，"
+          f"阈值 {truncation_threshold(R):.3f}，auto → {choose_spectral_solver(p)}")
+    rows, reference = [], None
+    for solver in solvers:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            t0 = time.perf_counter()
+            spectral = spectral_truncation(R, solver=solver)
+            elapsed = time.perf_counter() - t0
+        row = {'solver': solver, 'used': spectral.solver, 'k': spectral.k, 'seconds': round(elapsed, 2),
+               'fallback': any('退回' in str(w.message) for w in caught)}
+        if reference is None:
+            reference = spectral
+        elif spectral.k == reference.k:
+            row['max_eigenvalue_error'] = float(np.max(np.abs(spectral.Lambda - reference.Lambda)))
+        else:
+            row['max_eigenvalue_error'] = float('inf')
+        rows.append(row)
+        print(row)
+        del spectral
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--p', type=int, default=12000)
+    parser.add_argument('--n', type=int, default=5000)
+    parser.add_argument('--rho', type=float, default=0.9)
+    parser.add_argument('--solvers', nargs='+', default=['auto', 'subset'])
+    args = parser.parse_args()
+    run(args.p, args.n, args.rho, args.solvers)
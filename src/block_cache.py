@@ -0,0 +1,108 @@
+'''
+block 几何结构的磁盘缓存（按内容寻址）
+block 的构建（clique → 去重 → 修剪）只依赖 LD 矩阵、SNP 列表和阈值（r_min、pve_min、min_size），
+与 Z 无关；同一个 locus 重跑、或者多个结局 GWAS 共用同一个 locus 时，结果完全相同
+缓存内容：候选 clique（去重后）、修剪后的成员与 L2 载荷（evaluate_and_prune_block 的输出）
+命中时只需要重新做依赖 Z 的 enrich 和 W R 乘积
+    <cache_dir>/<key>.pkl      一个 key 一个文件，key 为 LD + SNP 列表 + 阈值的哈希
+超过 max_bytes 时按最近访问时间淘汰（命中时刷新文件 mtime）
+'''
+import os
+import pickle
+import hashlib
+import numpy as np
+from pathlib import Path
+
+GEOMETRY_VERSION = 1                    ## block 算法有实质变化时加一，旧缓存自动失效
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3       ## 默认 2 GB
+
+_SUFFIX = '.pkl'
+
+
+def block_geometry_key(R, snp_ids, r_min=0.8, pve_min=0.7, min_size=2, **options):
+    """
+    由 LD、SNP 列表、阈值和其他影响 block 结果的选项（如 clique backend）计算缓存 key
+    Returns:
+        key: str，blake2b 十六进制摘要
+    """
+    R = np.ascontiguousarray(R, dtype=np.float64)
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"v{GEOMETRY_VERSION}|{R.shape}".encode())
+    h.update(R.tobytes())
+    h.update('\x1f'.join(str(s) for s in snp_ids).encode('utf-8'))
+    h.update(f"|r_min={r_min!r}|pve_min={pve_min!r}|min_size={min_size!r}".encode())
+    for name in sorted(options):
+        h.update(f"|{name}={options[name]!r}".encode())
+    return h.hexdigest()
+
+
+def load_block_geometry(cache_dir, key):
+    """
+    读取缓存的 block 几何结构，未命中或文件损坏时返回 None
+    Returns:
+        geometry: dict {'candidates': list of np.ndarray, 'pruned': list of dict} 或 None
+    """
+    path = Path(cache_dir) / f"{key}{_SUFFIX}"
+    if not path.exists():
+        return None
+    try:
+        with open(path, 'rb') as f:
+            geometry = pickle.load(f)
+    except Exception:
+        return None
+    if geometry.get('version') != GEOMETRY_VERSION:
+        return None
+    try:
+        os.utime(path)          ## 刷新访问时间，供 LRU 淘汰
+    except OSError:
+        pass
+    return geometry
+
+
+def save_block_geometry(cache_dir, key, geometry, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    写入 block 几何结构（先写临时文件再改名），随后按大小淘汰最旧的条目
+    Args:
+        cache_dir: 缓存文件夹，不存在时自动创建
+        key: block_geometry_key 的返回值
+        geometry: dict，至少包含 'candidates' 与 'pruned'
+        max_bytes: 缓存总大小上限
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    path = cache_dir / f"{key}{_SUFFIX}"
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(dict(geometry, version=GEOMETRY_VERSION), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    evict_block_cache(cache_dir, max_bytes, keep=path)
+    return path
+
+
+def evict_block_cache(cache_dir, max_bytes=DEFAULT_MAX_BYTES, keep=None):
+    """
+    缓存总大小超过 max_bytes 时，按 mtime 从旧到新删除，直到回到上限以内（keep 指定的文件不删）
+    Returns:
+        removed: 被删除的文件数
+    """
+    entries = []
+    for path in Path(cache_dir).glob(f"*{_SUFFIX}"):
+        try:
+            st = path.stat()
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries, key=lambda e: e[0]):
+        if total <= max_bytes:
+            break
+        if keep is not None and path == Path(keep):
+            continue
+        try:
+            path.unlink()
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
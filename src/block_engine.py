@@ -0,0 +1,486 @@
+'''
+block 构建用的图工具：不经过 networkx 对象
+1. 强 LD 边一次性向量化提取（上三角 + 阈值掩码），代替 for i / for j>i 双重循环
+2. 邻接表直接由边数组生成
+3. maximal clique 枚举与 nx.find_cliques 同一算法（Tomita pivot），
+   在相同邻接表上输出顺序也完全一致，因此下游 blocks 结构不变
+4. 高 LD 区域（HLA 一类、长单倍型）用的位集 Bron–Kerbosch：
+   整数位集 + Tomita pivot + 可选退化序，支持 clique 数上限和墙钟时间预算
+5. block 修剪只需要 PC1：热启动幂迭代跟踪最大特征对，每删一个 SNP 约 O(m²)，
+   不再每一步做两次完整特征分解
+6. 候选 clique 去重：clique × SNP 稀疏成员矩阵，一次矩阵乘积得到全部 mean_r，
+   贪心选择在整数数组上进行
+7. block 载荷拼成 B × p 稀疏载荷矩阵 W：r_to_others = W R，block_block = W R Wᵀ，
+   代替逐 block / 逐 block 对的 Python 循环
+8. clean 空间（剩余 SNP + block）的 LD 直接由 R、r_to_others、block_block 拼出；
+   (p+B) × (p+B) 的 R_extended 改为惰性视图 ExtendedLD，需要时才取子块或物化
+'''
+import time
+import heapq
+import warnings
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import LinearOperator
+
+
+def dense_ld_edges(R, r_min=0.8):
+    """
+    从稠密 LD 中一次性取出上三角 R ≥ r_min 的边（正相位）
+    Returns:
+        (rows, cols): rows < cols，按 (i, j) 字典序排列，与双重循环的加边顺序一致
+    """
+    R = np.asarray(R)
+    mask = np.triu(R >= r_min, k=1)
+    rows, cols = np.nonzero(mask)
+    return rows, cols
+
+
+def adjacency_from_edges(p, rows, cols):
+    """
+    由边数组构建邻接表（CSR 形式）
+    Returns:
+        indptr: (p + 1,) 每个节点邻居在 indices 中的起止位置
+        indices: (2E,) 邻居节点，每个节点内部升序
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    src = np.concatenate([rows, cols])
+    dst = np.concatenate([cols, rows])
+    order = np.lexsort((dst, src))
+    src, dst = src[order], dst[order]
+    indptr = np.zeros(p + 1, dtype=np.int64)
+    np.add.at(indptr, src + 1, 1)
+    indptr = np.cumsum(indptr)
+    return indptr, dst
+
+
+def find_cliques_adjacency(p, indptr, indices):
+    """
+    在邻接表上枚举全部 maximal cliques（含孤立点的单点 clique）
+    算法与 networkx.find_cliques 完全相同（迭代式 Bron–Kerbosch + Tomita pivot），
+    邻居集合按升序构建，和按字典序加边的 nx.Graph 得到的集合一致，所以输出顺序也一致
+    Yields:
+        clique: list of int
+    """
+    if p == 0:
+        return
+    adj = {u: set(indices[indptr[u]:indptr[u + 1]].tolist()) for u in range(p)}
+    Q = [None]
+
+    cand = set(range(p))
+    subg = cand.copy()
+    stack = []
+    u = max(subg, key=lambda u: len(cand & adj[u]))
+    ext_u = cand - adj[u]
+
+    try:
+        while True:
+            if ext_u:
+                q = ext_u.pop()
+                cand.remove(q)
+                Q[-1] = q
+                adj_q = adj[q]
+                subg_q = subg & adj_q
+                if not subg_q:
+                    yield Q[:]
+                else:
+                    cand_q = cand & adj_q
+                    if cand_q:
+                        stack.append((subg, cand, ext_u))
+                        Q.append(None)
+                        subg = subg_q
+                        cand = cand_q
+                        u = max(subg, key=lambda u: len(cand & adj[u]))
+                        ext_u = cand - adj[u]
+            else:
+                Q.pop()
+                subg, cand, ext_u = stack.pop()
+    except IndexError:
+        pass
+
+
+########## 位集 Bron–Kerbosch
+def bitset_adjacency(p, indptr, indices):
+    """邻接表 → 每个节点一个 Python 整数位集（第 j 位为 1 表示与 j 相邻）"""
+    adj = [0] * p
+    for u in range(p):
+        mask = 0
+        for v in indices[indptr[u]:indptr[u + 1]].tolist():
+            mask |= 1 << v
+        adj[u] = mask
+    return adj
+
+
+def degeneracy_order(p, indptr, indices):
+    """
+    退化序：反复取出当前度数最小的节点（小根堆 + 惰性删除）
+    按此顺序作为 Bron–Kerbosch 外层循环，每个子问题的候选集不超过退化度
+    """
+    degree = np.diff(indptr).astype(np.int64)
+    heap = [(int(degree[u]), u) for u in range(p)]
+    heapq.heapify(heap)
+    removed = np.zeros(p, dtype=bool)
+    order = []
+    while heap:
+        d, u = heapq.heappop(heap)
+        if removed[u] or d != degree[u]:
+            continue
+        removed[u] = True
+        order.append(u)
+        for v in indices[indptr[u]:indptr[u + 1]].tolist():
+            if not removed[v]:
+                degree[v] -= 1
+                heapq.heappush(heap, (int(degree[v]), v))
+    return order
+
+
+def _iter_bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def find_cliques_bitset(p, indptr, indices, max_cliques=None, time_budget=None,
+                        use_degeneracy=True, min_size=1):
+    """
+    位集版 Bron–Kerbosch（Tomita pivot），用于 clique 数量可能爆炸的高 LD locus
+    Args:
+        p: 节点数
+        indptr, indices: adjacency_from_edges 得到的邻接表
+        max_cliques: 最多输出多少个 clique，None 表示不限
+        time_budget: 墙钟时间预算（秒），None 表示不限
+        use_degeneracy: 外层循环是否按退化序展开（稀疏图上显著减小分支）
+        min_size: 小于该大小的 clique 不输出（不影响搜索本身）
+    Returns:
+        cliques: list of list of int，未截断时与 nx.find_cliques 的集合相同（顺序不同）
+        info: dict {'n_cliques', 'truncated', 'reason', 'elapsed'}
+    """
+    start = time.perf_counter()
+    adj = bitset_adjacency(p, indptr, indices)
+    cliques = []
+    info = {'n_cliques': 0, 'truncated': False, 'reason': '', 'elapsed': 0.0}
+    if p == 0:
+        return cliques, info
+
+    def choose_todo(P, X):
+        # Tomita pivot：取 P ∪ X 中与 P 相邻最多的节点，只展开 P \ N(u)
+        best_u, best_cnt = -1, -1
+        for u in _iter_bits(P | X):
+            cnt = (P & adj[u]).bit_count()
+            if cnt > best_cnt:
+                best_u, best_cnt = u, cnt
+        return P & ~adj[best_u]
+
+    # 每一帧: [R, P, X, todo]
+    stack = []
+    if use_degeneracy:
+        order = degeneracy_order(p, indptr, indices)
+        later = (1 << p) - 1
+        earlier = 0
+        roots = []
+        for v in order:
+            vbit = 1 << v
+            later &= ~vbit
+            roots.append(([v], adj[v] & later, adj[v] & earlier))
+            earlier |= vbit
+    else:
+        roots = [([], (1 << p) - 1, 0)]
+
+    n_steps = 0
+    for R0, P0, X0 in roots:
+        if not P0 and not X0:
+            if len(R0) >= min_size:
+                cliques.append(R0)
+            continue
+        if not P0:
+            continue
+        stack.append([R0, P0, X0, choose_todo(P0, X0)])
+        while stack:
+            frame = stack[-1]
+            todo = frame[3]
+            if not todo:
+                stack.pop()
+                continue
+            vbit = todo & -todo
+            v = vbit.bit_length() - 1
+            frame[3] = todo ^ vbit
+            P_new = frame[1] & adj[v]
+            X_new = frame[2] & adj[v]
+            frame[1] &= ~vbit
+            frame[2] |= vbit
+            R_new = frame[0] + [v]
+            if not P_new:
+                if not X_new and len(R_new) >= min_size:
+                    cliques.append(R_new)
+                    if max_cliques is not None and len(cliques) >= max_cliques:
+                        info['truncated'], info['reason'] = True, 'max_cliques'
+                        break
+            else:
+                stack.append([R_new, P_new, X_new, choose_todo(P_new, X_new)])
+
+            n_steps += 1
+            if time_budget is not None and n_steps % 256 == 0:
+                if time.perf_counter() - start > time_budget:
+                    info['truncated'], info['reason'] = True, 'time_budget'
+                    break
+        if info['truncated']:
+            break
+
+    info['n_cliques'] = len(cliques)
+    info['elapsed'] = time.perf_counter() - start
+    if info['truncated']:
+        warnings.warn(
+            f"clique 枚举在 {info['reason']} 处截断：已得到 {len(cliques)} 个 clique，"
+            f"耗时 {info['elapsed']:.1f}s"
+        )
+    return cliques, info
+
+
+def clique_membership(cliques, p):
+    """
+    clique × SNP 的 0/1 稀疏成员矩阵
+    Returns:
+        M: scipy.sparse.csr_matrix (C, p)，第 c 行的列索引即第 c 个 clique 的 SNP（保持输入顺序）
+    """
+    sizes = np.fromiter((len(c) for c in cliques), dtype=np.int64, count=len(cliques))
+    indptr = np.concatenate([[0], np.cumsum(sizes)])
+    indices = (np.concatenate([np.asarray(c, dtype=np.int64) for c in cliques])
+               if len(cliques) else np.zeros(0, dtype=np.int64))
+    data = np.ones(len(indices))
+    return sparse.csr_matrix((data, indices, indptr), shape=(len(cliques), p))
+
+
+def clique_mean_r(cliques, R, chunk_elems=2 ** 24):
+    """
+    每个 clique 内部上三角 LD 的均值（与 resolve_block_overlap 的 'mean_r' 定义一致）
+    上三角之和 = (m^T R m - Σ_{i∈c} R_ii) / 2，其中 m 为 clique 的 0/1 成员向量，
+    所有 clique 一起用成员矩阵 M 计算 rowsum((M R) ∘ M)；按行分块，中间结果不超过 chunk_elems 个元素
+    Args:
+        cliques: list of list of int，或 clique_membership 得到的成员矩阵
+        R: (p, p) 对称 LD 矩阵
+    Returns:
+        mean_r: (C,) 单点 clique 为 0
+    """
+    R = np.asarray(R)
+    p = R.shape[0]
+    M = cliques if sparse.issparse(cliques) else clique_membership(cliques, p)
+    C = M.shape[0]
+    sizes = np.diff(M.indptr)
+    diag = M @ np.diagonal(R)
+    total = np.zeros(C)
+    step = max(1, chunk_elems // max(p, 1))
+    for start in range(0, C, step):
+        M_chunk = M[start:start + step]
+        MR = np.asarray(M_chunk @ R)                    # (chunk, p)
+        total[start:start + step] = np.asarray(M_chunk.multiply(MR).sum(axis=1)).ravel()
+    n_pairs = sizes * (sizes - 1) / 2
+    mean_r = np.zeros(C)
+    ok = n_pairs > 0
+    mean_r[ok] = (total[ok] - diag[ok]) / 2 / n_pairs[ok]
+    return mean_r
+
+
+def greedy_disjoint_cliques(M, order):
+    """
+    按给定顺序贪心选择互不重叠的 clique（只要与已选 SNP 有任何重叠就跳过）
+    全部 SNP 都被占用后提前停止
+    Args:
+        M: clique_membership 得到的 (C, p) 成员矩阵
+        order: clique 的考察顺序（一般为 mean_r 降序）
+    Returns:
+        kept: list of int，被选中的 clique 在 M 中的行号，按选择顺序
+    """
+    indptr, indices = M.indptr, M.indices
+    used = np.zeros(M.shape[1], dtype=bool)
+    n_total = np.unique(indices).size
+    n_used = 0
+    kept = []
+    for c in order:
+        if n_used == n_total:
+            break
+        members = indices[indptr[c]:indptr[c + 1]]
+        if used[members].any():
+            continue
+        used[members] = True
+        n_used += len(members)
+        kept.append(int(c))
+    return kept
+
+
+def sort_cliques_by_mean_r(cliques, R):
+    """
+    按 mean_r 降序排列 clique（同分时按 SNP 索引字典序），
+    下游的贪心去重可以直接按顺序消费，并在全部 SNP 都被占用时提前停止
+    Returns:
+        cliques_sorted: list of sorted list of int
+        mean_r_sorted: np.ndarray
+    """
+    cliques = [sorted(c) for c in cliques]
+    mean_r = clique_mean_r(cliques, R)
+    order = sorted(range(len(cliques)), key=lambda c: (-mean_r[c], cliques[c]))
+    return [cliques[c] for c in order], mean_r[order]
+
+
+########## block 修剪：只跟踪最大特征对
+def leading_eigpair(A, v0=None, tol=1e-10, max_iter=100, dense_below=16):
+    """
+    对称矩阵的最大特征值及其特征向量（热启动幂迭代）
+    Args:
+        A: (m, m) 对称矩阵（LD 子矩阵）
+        v0: 初始向量，一般取上一轮的 PC1 去掉被删 SNP 后的部分；None 时用全 1 向量
+        tol: 残差 ||A v - λ v|| ≤ tol * max(1, |λ|) 视为收敛
+        max_iter: 最多迭代次数，未收敛（特征值间隔太小）时退回 np.linalg.eigh
+        dense_below: m 小于该值时直接 eigh，小矩阵上幂迭代没有优势
+    Returns:
+        lambda_max: float
+        v: (m,) 单位向量，符号约定为 sum(v) ≥ 0
+    Raises:
+        np.linalg.LinAlgError: 矩阵含非有限值
+    """
+    m = A.shape[0]
+    if not np.all(np.isfinite(A)):
+        raise np.linalg.LinAlgError("LD 子矩阵含非有限值")
+    if m < dense_below:
+        eigvals, eigvecs = np.linalg.eigh(A)
+        lam, v = eigvals[-1], eigvecs[:, -1]
+    else:
+        v = np.ones(m) if v0 is None else np.asarray(v0, dtype=np.float64).copy()
+        norm = np.linalg.norm(v)
+        v = v / norm if norm > 0 else np.ones(m) / np.sqrt(m)
+        converged = False
+        for _ in range(max_iter):
+            w = A @ v
+            lam = v @ w
+            if np.linalg.norm(w - lam * v) <= tol * max(1.0, abs(lam)):
+                converged = True
+                break
+            v = w / np.linalg.norm(w)
+        if not converged:
+            eigvals, eigvecs = np.linalg.eigh(A)
+            lam, v = eigvals[-1], eigvecs[:, -1]
+    if v.sum() < 0:
+        v = -v
+    return float(lam), v
+
+
+########## block 载荷矩阵
+def block_loading_matrix(blocks, p):
+    """
+    所有 block 的建模载荷拼成稀疏矩阵 W (B, p)：第 b 行在 block b 的 SNP 上取 'loading_weights'，其余为 0
+    于是 block PC1 = W x，Cov(block PC1, SNP) = W R，Cov(block PC1, block PC1) = W R Wᵀ
+    """
+    B = len(blocks)
+    if B == 0:
+        return sparse.csr_matrix((0, p))
+    rows = np.concatenate([np.full(len(blk['snps']), b) for b, blk in enumerate(blocks)])
+    cols = np.concatenate([np.asarray(blk['snps'], dtype=np.int64) for blk in blocks])
+    vals = np.concatenate([np.asarray(blk['loading_weights'], dtype=np.float64) for blk in blocks])
+    return sparse.csr_matrix((vals, (rows, cols)), shape=(B, p))
+
+
+def block_ld_products(W, R, R_sparse=None):
+    """
+    一次性得到 block 与全部 SNP、block 与 block 之间的相关
+    Args:
+        W: block_loading_matrix 得到的 (B, p) 稀疏载荷矩阵
+        R: (p, p) 稠密 LD
+        R_sparse: 可选，CSR 稀疏 LD；给定时 W R 只用稀疏 LD 计算（与 enrich 的稀疏路径一致）
+    Returns:
+        r_to_others: (B, p)，第 b 行即 block b 的 'r_to_others'
+        block_block: (B, B)，对角线为 1（载荷已满足 wᵀ R_block w = 1）
+    """
+    if R_sparse is not None:
+        WR = (W @ R_sparse).toarray()
+    else:
+        WR = np.asarray(W @ np.asarray(R))
+    block_block = np.asarray(W @ WR.T).T
+    np.fill_diagonal(block_block, 1.0)
+    return WR, block_block
+
+
+########## clean 空间 LD / 惰性 R_extended
+def clean_space_indices(p, remaining_snp_idx, n_blocks):
+    """clean 空间在 R_extended 中的位置：剩余 SNP 在前，block（p, p+1, ...）在后"""
+    remaining = np.asarray(remaining_snp_idx, dtype=np.int64)
+    return np.concatenate([remaining, p + np.arange(n_blocks, dtype=np.int64)])
+
+
+class ExtendedLD(LinearOperator):
+    """
+    R_extended 的惰性视图（LinearOperator 形式）：
+        [[ R            , r_to_othersᵀ ],
+         [ r_to_others  , block_block  ]]      形状 (p+B, p+B)
+    只引用 R、r_to_others (B, p)、block_block (B, B)，不分配 (p+B)² 的稠密矩阵
+    支持：
+        - R_ext[np.ix_(rows, cols)]：直接拼出子块，与稠密 R_extended 的切片逐元素一致
+        - R_ext @ x / R_ext.matvec(x)
+        - R_ext.toarray() / np.asarray(R_ext)：需要时才物化
+    """
+
+    def __init__(self, R, r_to_others, block_block):
+        self.R = R
+        self.p = R.shape[0]
+        self.r_to_others = np.asarray(r_to_others, dtype=np.float64)
+        self.block_block = np.asarray(block_block, dtype=np.float64)
+        self.n_blocks = self.r_to_others.shape[0]
+        if self.r_to_others.shape != (self.n_blocks, self.p) or self.block_block.shape != (self.n_blocks, self.n_blocks):
+            raise ValueError("r_to_others 应为 (B, p)，block_block 应为 (B, B)")
+        n = self.p + self.n_blocks
+        super().__init__(dtype=np.dtype(np.float64), shape=(n, n))
+
+    def submatrix(self, rows, cols):
+        """取 (rows, cols) 子块，rows/cols 为 R_extended 中的整数位置"""
+        rows = np.asarray(rows, dtype=np.int64).ravel()
+        cols = np.asarray(cols, dtype=np.int64).ravel()
+        p = self.p
+        rs, cs = rows < p, cols < p
+        out = np.empty((len(rows), len(cols)), dtype=np.float64)
+        out[np.ix_(rs, cs)] = self.R[np.ix_(rows[rs], cols[cs])]
+        out[np.ix_(rs, ~cs)] = self.r_to_others[np.ix_(cols[~cs] - p, rows[rs])].T
+        out[np.ix_(~rs, cs)] = self.r_to_others[np.ix_(rows[~rs] - p, cols[cs])]
+        out[np.ix_(~rs, ~cs)] = self.block_block[np.ix_(rows[~rs] - p, cols[~cs] - p)]
+        return out
+
+    def clean(self, remaining_snp_idx):
+        """clean 空间 LD：剩余 SNP + 全部 block"""
+        idx = clean_space_indices(self.p, remaining_snp_idx, self.n_blocks)
+        return self.submatrix(idx, idx)
+
+    def toarray(self):
+        idx = np.arange(self.shape[0])
+        return self.submatrix(idx, idx)
+
+    def __array__(self, dtype=None, copy=None):
+        out = self.toarray()
+        return out if dtype is None else out.astype(dtype)
+
+    def __getitem__(self, key):
+        # np.ix_ 形式的 (rows[:, None], cols[None, :]) 直接拼子块，其他索引先物化
+        if (isinstance(key, tuple) and len(key) == 2
+                and all(isinstance(k, np.ndarray) and k.ndim == 2 for k in key)
+                and key[0].shape[1] == 1 and key[1].shape[0] == 1):
+            return self.submatrix(key[0], key[1])
+        return self.toarray()[key]
+
+    def _matvec(self, x):
+        x = np.asarray(x, dtype=np.float64).ravel()
+        x_snp, x_blk = x[:self.p], x[self.p:]
+        y_snp = np.asarray(self.R) @ x_snp + self.r_to_others.T @ x_blk
+        y_blk = self.r_to_others @ x_snp + self.block_block @ x_blk
+        return np.concatenate([y_snp, y_blk])
+
+    def _rmatvec(self, x):
+        return self._matvec(x)      ## 对称
+
+
+def build_clean_ld(R, remaining_snp_idx, r_to_others, block_block):
+    """
+    直接拼出 clean 空间 LD (M+B, M+B)，与 R_extended[np.ix_(clean_indices, clean_indices)] 逐元素一致
+    Args:
+        R: (p, p) LD（ndarray 或 np.memmap）
+        remaining_snp_idx: (M,) 未被 block 覆盖的 SNP
+        r_to_others: (B, p) 每个 block 与全部 SNP 的相关
+        block_block: (B, B)
+    """
+    return ExtendedLD(R, r_to_others, block_block).clean(remaining_snp_idx)
@@ -0,0 +1,951 @@
+'''
+conditional Z / 信号能量的计算核心（COJO 思想，全局谱截断空间）
+记 P = U Λ⁻¹ Uᵀ（全局能量算子），G = U Λ^{-1/2}，于是 zᵀ P z = ||Gᵀ z||²
+已选集合 S 上：
+    A_S = P[S, S] = U_S Λ⁻¹ U_Sᵀ              （原代码中的 R_sub_inv）
+    M_S = R[:, S] A_S                           （投影算子，与 z 无关）
+    z_cond = z - M_S z_S
+    E_residual = z_condᵀ P z_cond = ||Gᵀ z - H_S z_S||²，  H_S = Gᵀ M_S = (Gᵀ R)[:, S] A_S
+M_S、H_S 只依赖 S，bootstrap 各次重复基本在同一批 S 上反复计算，因此按 S 缓存（LRU，按字节数限额）
+前向选择的候选打分：A_{S+j} 只是在 A_S 外加一行一列，所有候选 j 的剩余能量可以一次矩阵乘积得到
+每个 locus 的 clean 空间只做一次谱截断，结果放在 SpectralContext 中（U、Λ、G、P、投影缓存），
+前向选择、稳定 beta、SOP 计算都从它取，不在循环里重建
+'''
+import os
+import warnings
+import numpy as np
+from collections import OrderedDict
+from scipy.linalg import eigh as scipy_eigh
+from scipy.sparse.linalg import eigsh
+from concurrent.futures import ProcessPoolExecutor
+from block_engine import leading_eigpair
+from diagnostics import (SelectionDiagnostics, SILENT, STOP_NONE, STOP_TARGET, STOP_ALL_SELECTED,
+                         STOP_Z_BELOW, STOP_NO_GAIN)
+
+DEFAULT_PROJECTOR_CACHE_BYTES = 256 * 1024 ** 2     ## 默认 256 MB
+DEFAULT_TRIE_BYTES = 64 * 1024 ** 2                 ## 选择路径 trie 的参考状态总上限
+DEFAULT_BOOTSTRAP_CHUNK = 16                        ## 并行 bootstrap 每个任务的重复数（固定切分，与 worker 数无关）
+DENSE_EIGH_MAX_P = 3000                             ## clean 空间小于此值用全谱 eigh，否则用 LAPACK 子集
+DEFAULT_PARTIAL_EIGH_K = 64                         ## 迭代特征分解的初始个数（不够时倍增）
+SPECTRAL_RESIDUAL_TOL = 1e-6                        ## 迭代特征对的残差上限（相对 λ_max）
+
+
+class ProjectorCache:
+    """
+    按已选集合缓存投影算子 M_S (p, |S|) 与能量二次型 H_S (k, |S|)
+    key 为排序后的 S（z_cond 与 S 的顺序无关），超过 max_bytes 时淘汰最久未使用的条目
+    一个 locus 的一个 clean 空间（R, U_trunc, Lambda_trunc）对应一个缓存实例
+    """
+
+    def __init__(self, R, U_trunc, Lambda_trunc, max_bytes=DEFAULT_PROJECTOR_CACHE_BYTES, G=None):
+        self.R = np.asarray(R)
+        self.U_trunc = np.asarray(U_trunc)
+        self.Lambda_inv = 1.0 / np.asarray(Lambda_trunc)
+        self.G = self.U_trunc * np.sqrt(self.Lambda_inv) if G is None else G   # (p, k) = U Λ^{-1/2}
+        self.GtR = self.G.T @ self.R                          # (k, p)，一次计算，所有 S 共用
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, selected):
+        """
+        Returns:
+            S: (|S|,) 排序后的索引
+            M_S: (p, |S|) 投影算子
+            H_S: (k, |S|) 能量二次型
+        """
+        key = tuple(sorted(int(i) for i in selected))
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+        self.misses += 1
+        S = np.array(key, dtype=np.int64)
+        U_S = self.U_trunc[S, :]
+        A_S = (U_S * self.Lambda_inv) @ U_S.T                 # (|S|, |S|)，不构造 diag 矩阵
+        M_S = self.R[:, S] @ A_S
+        H_S = self.GtR[:, S] @ A_S
+        entry = (S, M_S, H_S)
+        size = S.nbytes + M_S.nbytes + H_S.nbytes
+        if size <= self.max_bytes:
+            self._entries[key] = entry
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (S_old, M_old, H_old) = self._entries.popitem(last=False)
+                self.nbytes -= S_old.nbytes + M_old.nbytes + H_old.nbytes
+        return entry
+
+    ## 单个 z 与多个 z（bootstrap 各次重复按行堆叠）走同一套批量公式，保证两种用法数值一致
+    def conditional_z(self, z, selected):
+        """z_cond = z - M_S z_S"""
+        if len(selected) == 0:
+            return z.copy()
+        return self.conditional_z_batch(z[None, :], selected)[0]
+
+    def conditional_z_batch(self, Z, selected):
+        """Z: (n, p)，每行一个 z；Z_cond = Z - Z_S M_Sᵀ"""
+        if len(selected) == 0:
+            return Z.copy()
+        S, M_S, _ = self.get(selected)
+        return Z - Z[:, S] @ M_S.T
+
+    def energy_basis(self, z):
+        """y = Gᵀ z，于是 E_total = ||y||²；每个 z 只算一次"""
+        return self.G.T @ z
+
+    def energy_basis_batch(self, Z):
+        """Y = Z G，每行对应一个 z"""
+        return Z @ self.G
+
+    def residual_energy(self, y, z, selected):
+        """E_residual = z_condᵀ P z_cond = ||y - H_S z_S||²，y 为 energy_basis(z)"""
+        return float(self.residual_energy_batch(y[None, :], z[None, :], selected)[0])
+
+    def residual_energy_batch(self, Y, Z, selected):
+        """按行计算 ||y - H_S z_S||²"""
+        if len(selected) == 0:
+            return np.einsum('rk,rk->r', Y, Y)
+        S, _, H_S = self.get(selected)
+        Rs = Y - Z[:, S] @ H_S.T
+        return np.einsum('rk,rk->r', Rs, Rs)
+
+    def candidate_energies(self, y, z, selected, candidates):
+        """
+        所有候选 j 加入后的剩余能量 E_residual(S ∪ {j})，一次完成：
+            β_{S+j} = [β_S + P[S, j] z_j ;  c_j]，  c_j = P[j, S] z_S + P_jj z_j
+            r_j = y - (GᵀR)[:, S+j] β_{S+j} = r_S - z_j (GᵀR)[:, S] P[S, j] - c_j (GᵀR)[:, j]
+        其中 r_S = y - H_S z_S；代价 O(k |S| |J|)，不对每个候选单独求 z_cond
+        Args:
+            y: energy_basis(z)
+            z: (p,) 校正后的 Z
+            selected: 当前已选索引
+            candidates: (|J|,) 候选索引（不应与 selected 重叠）
+        Returns:
+            E: (|J|,) 每个候选对应的剩余能量
+        """
+        return self.candidate_energies_batch(y[None, :], z[None, :], selected, candidates)[0]
+
+    def candidate_terms(self, selected, candidates):
+        """
+        候选打分中与 z 无关的量（同一 S、同一候选集合的多行 z 共用）
+        Returns:
+            dict: S, H_S, U_S（S 为空时为 None），J, V_J = Λ⁻¹ U_Jᵀ, P_JJ, GtR_J = (GᵀR)[:, J],
+                  A = (GᵀR)[:, S] P[S, J]（S 为空时为 None）
+        """
+        J = np.asarray(candidates, dtype=np.int64)
+        U_J = self.U_trunc[J, :]                              # (|J|, k)
+        V_J = (U_J * self.Lambda_inv).T                       # (k, |J|) = Λ⁻¹ U_Jᵀ
+        terms = {
+            'J': J,
+            'V_J': V_J,
+            'P_JJ': np.einsum('jk,kj->j', U_J, V_J),          # P 在候选上的对角元
+            'GtR_J': self.GtR[:, J],                          # (k, |J|)
+            'S': None, 'H_S': None, 'U_S': None, 'A': None,
+        }
+        if len(selected) > 0:
+            S, _, H_S = self.get(selected)
+            U_S = self.U_trunc[S, :]
+            terms.update(S=S, H_S=H_S, U_S=U_S,
+                         A=self.GtR[:, S] @ (U_S @ V_J))      # (k, |J|) = (GᵀR)[:, S] P[S, J]
+        return terms
+
+    def candidate_energies_batch(self, Y, Z, selected, candidates, chunk_elems=2 ** 22, terms=None):
+        """
+        candidate_energies 的多行版本：同一已选集合 S 下的多个 z 一起打分，
+        与 S、候选有关的量（candidate_terms）只算一次，也可以由调用方传入
+        Returns:
+            E: (n, |J|)
+        """
+        n = Z.shape[0]
+        if len(candidates) == 0:
+            return np.zeros((n, 0))
+        if terms is None:
+            terms = self.candidate_terms(selected, candidates)
+        J, V_J, P_JJ, GtR_J, A = terms['J'], terms['V_J'], terms['P_JJ'], terms['GtR_J'], terms['A']
+        Z_J = Z[:, J]
+        if terms['S'] is None:
+            R_S = Y
+            C = P_JJ * Z_J                                    # (n, |J|)
+        else:
+            Z_S = Z[:, terms['S']]
+            R_S = Y - Z_S @ terms['H_S'].T                    # (n, k)
+            C = (Z_S @ terms['U_S']) @ V_J + P_JJ * Z_J       # (n, |J|)
+
+        E = np.empty((n, len(J)))
+        k = R_S.shape[1]
+        step = max(1, chunk_elems // max(k * len(J), 1))
+        for start in range(0, n, step):
+            sl = slice(start, start + step)
+            D = R_S[sl, :, None] - GtR_J[None, :, :] * C[sl, None, :]
+            if A is not None:
+                D -= A[None, :, :] * Z_J[sl, None, :]
+            E[sl] = np.einsum('rkj,rkj->rj', D, D)
+        return E
+
+    def paired_candidate_energies(self, Y, Z, selected, candidates):
+        """
+        每行只有一个候选：第 r 行 z 加入 candidates[r] 后的剩余能量，公式同 candidate_energies_batch
+        Returns:
+            E: (n,)
+        """
+        j = np.asarray(candidates, dtype=np.int64)
+        U_j = self.U_trunc[j, :]                              # (n, k)
+        V_j = U_j * self.Lambda_inv                           # (n, k)，每行为 Λ⁻¹ U_jᵀ
+        P_jj = np.einsum('rk,rk->r', U_j, V_j)
+        g = self.GtR[:, j].T                                  # (n, k)
+        z_j = Z[np.arange(len(j)), j]
+        C = P_jj * z_j
+        if len(selected) == 0:
+            D = Y - g * C[:, None]
+        else:
+            S, _, H_S = self.get(selected)
+            Z_S = Z[:, S]
+            U_S = self.U_trunc[S, :]
+            C = C + np.einsum('rk,rk->r', Z_S @ U_S, V_j)
+            A = (V_j @ U_S.T) @ self.GtR[:, S].T              # (n, k)，第 r 行 = (GᵀR)[:, S] P[S, j_r]
+            D = Y - Z_S @ H_S.T - g * C[:, None] - A * z_j[:, None]
+        return np.einsum('rk,rk->r', D, D)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'nbytes': self.nbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+########## 每个 locus 一次的谱截断上下文
+class SpectralContext:
+    """
+    clean 空间 LD 的全局谱截断结果，由 spectral_truncation / apply_spectral_truncation 创建一次，传给所有使用者
+    属性：
+        R: (p, p) clean 空间 LD
+        U: (p, k) 保留的特征向量（特征值降序）
+        Lambda: (k,) 保留的特征值
+        Lambda_inv: (k,)
+        G: (p, k) = U Λ^{-1/2}，zᵀ P z = ||Gᵀ z||²
+        P: (p, p) = U Λ⁻¹ Uᵀ，首次访问时才构造
+        projectors: ProjectorCache，首次访问时才构造
+        selection_trie: SelectionTrie，bootstrap 各次重复共用的选择路径前缀树，首次访问时才构造
+        solver: 使用的特征分解方式（spectral_truncation 的 solver）
+    兼容旧写法：U_trunc, Lambda_trunc = ctx
+    pickle 时只保留 R、U、Lambda 等基本量，P 与投影缓存在读入后按需重建
+    """
+
+    def __init__(self, R, U, Lambda, threshold=None, eigenvalue_range=None, solver='dense'):
+        self.R = R
+        self.U = np.asarray(U)
+        self.Lambda = np.asarray(Lambda)
+        self.Lambda_inv = 1.0 / self.Lambda
+        self.G = self.U * np.sqrt(self.Lambda_inv)
+        self.threshold = threshold
+        self.eigenvalue_range = eigenvalue_range
+        self.solver = solver
+        self._P = None
+        self._projectors = None
+        self._trie = None
+
+    def __iter__(self):
+        return iter((self.U, self.Lambda))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(G=None, _P=None, _projectors=None, _trie=None)
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault('solver', 'dense')        ## 旧版本保存的结果
+        state.setdefault('_trie', None)
+        self.__dict__.update(state)
+        self.G = self.U * np.sqrt(self.Lambda_inv)
+
+    @property
+    def k(self):
+        return len(self.Lambda)
+
+    @property
+    def P(self):
+        if self._P is None:
+            self._P = self.G @ self.G.T
+        return self._P
+
+    @property
+    def projectors(self):
+        if self._projectors is None:
+            self._projectors = ProjectorCache(self.R, self.U, self.Lambda, G=self.G)
+        return self._projectors
+
+    @property
+    def selection_trie(self):
+        if self._trie is None:
+            self._trie = SelectionTrie(self.projectors)
+        return self._trie
+
+    def P_sub(self, idx):
+        """P[idx, idx] = U_idx Λ⁻¹ U_idxᵀ（原代码中的 R_sub_inv），不构造完整 P"""
+        idx = np.asarray(idx, dtype=np.int64)
+        U_idx = self.U[idx, :]
+        return (U_idx * self.Lambda_inv) @ U_idx.T
+
+    def energy(self, z):
+        """zᵀ P z"""
+        y = self.G.T @ np.asarray(z, dtype=np.float64)
+        return float(y @ y)
+
+    def conditional_z(self, z, selected):
+        """z - R[:, S] P[S, S] z_S，按因子形式计算，不缓存"""
+        z = np.asarray(z, dtype=np.float64)
+        if len(selected) == 0:
+            return z.copy()
+        S = np.asarray(selected, dtype=np.int64)
+        U_S = self.U[S, :]
+        beta = U_S @ (self.Lambda_inv * (U_S.T @ z[S]))
+        return z - self.R[:, S] @ beta
+
+
+def truncation_threshold(R, lambda_max=None):
+    """
+    谱截断阈值 max(0.2, 1e-6 λ_max)
+    λ_max 未知时先用 Gershgorin 上界（最大行绝对值和）判断：上界的 1e-6 倍不超过 0.2 时阈值就是 0.2，不必求 λ_max
+    """
+    if lambda_max is None:
+        bound = float(np.max(np.sum(np.abs(R), axis=1)))
+        if 1e-6 * bound <= 0.2:
+            return 0.2
+        lambda_max, _ = leading_eigpair(R)
+    return max(0.2, 1e-6 * float(lambda_max))
+
+
+def choose_spectral_solver(p):
+    """
+    按 clean 空间大小选择特征分解方式：小 p 全谱，其余 LAPACK 子集
+    迭代方法（lanczos / randomized）只能显式指定：满秩 LD（参考样本数 > p）在阈值附近有大量特征值，
+    它们需要的 k 会倍增到 p/4 左右再退回 subset，比直接 subset 慢（见 benchmarks/bench_spectral_solver.py）
+    """
+    if p < DENSE_EIGH_MAX_P:
+        return 'dense'
+    return 'subset'
+
+
+def _eigh_subset(R, threshold):
+    """LAPACK 按值取子集（syevr）：只求 (threshold, ∞) 内的特征对"""
+    eigenvals, eigenvecs = scipy_eigh(R, subset_by_value=(threshold, np.inf), driver='evr')
+    return eigenvals, eigenvecs
+
+
+def _top_eigpairs_lanczos(R, k, tol, rng):
+    v0 = rng.standard_normal(R.shape[0])
+    return eigsh(R, k=k, which='LA', tol=tol, v0=v0)
+
+
+def _top_eigpairs_randomized(R, k, tol, rng, n_oversample=10, n_iter=4):
+    """随机 range finder（Halko 等）：Q = orth(R^q R Ω)，再在 span(Q) 上做 Rayleigh-Ritz"""
+    p = R.shape[0]
+    m = min(p, k + max(n_oversample, k // 2))
+    Q, _ = np.linalg.qr(R @ rng.standard_normal((p, m)))
+    for _ in range(n_iter):
+        Q, _ = np.linalg.qr(R @ Q)
+    B = Q.T @ (R @ Q)
+    vals, W = np.linalg.eigh((B + B.T) / 2)
+    order = np.argsort(vals)[::-1][:k]
+    return vals[order], Q @ W[:, order]
+
+
+def _eigh_top_adaptive(R, threshold, top_k, k0, tol, rng):
+    """
+    只求最大的 k 个特征对，k 从 k0 起倍增，直到求出的最小特征值 ≤ threshold（阈值以上的已全部求出）
+    阈值以上（要保留）的特征对用残差 ||R u - λ u|| 检查精度；k 超过 p/2 或精度不够时返回 None（由调用方退回 LAPACK）
+    """
+    p = R.shape[0]
+    k = max(1, min(k0, p - 2))
+    while True:
+        vals, vecs = top_k(R, k, tol, rng)
+        if np.min(vals) <= threshold:
+            kept = vals > threshold
+            residual = np.linalg.norm(R @ vecs[:, kept] - vecs[:, kept] * vals[kept], axis=0)
+            if residual.size and np.max(residual) > SPECTRAL_RESIDUAL_TOL * max(1.0, float(np.max(vals))):
+                return None
+            return vals, vecs
+        if 2 * k > p // 2:
+            return None
+        k = 2 * k
+
+
+def spectral_truncation(R, threshold=None, solver='auto', tol=1e-10, random_state=0):
+    """
+    对 LD 矩阵做谱截断：保留特征值 > threshold 的成分（默认 max(0.2, 1e-6 λ_max)，至少保留一个）
+    solver:
+        'dense'       np.linalg.eigh 全谱（小 p，结果与原实现逐位一致）
+        'subset'      scipy.linalg.eigh(subset_by_value=...)，LAPACK 只求阈值以上的特征对
+        'lanczos'     scipy.sparse.linalg.eigsh，适合稀疏 / 低秩 R；需要的个数未知，按倍增搜索
+        'randomized'  随机 range finder + Rayleigh-Ritz，只适合阈值以上成分很少的（低秩）R
+        'auto'        按 p 选择（choose_spectral_solver）
+    迭代方法求出的特征对都做残差检查，不满足时退回 'subset'
+    部分分解时最小特征值未知，eigenvalue_range 的下界记为 nan
+    Returns:
+        SpectralContext
+    """
+    p = R.shape[0]
+    if solver == 'auto':
+        solver = choose_spectral_solver(p)
+    if solver == 'dense' or p <= 2:
+        eigenvals, eigenvecs = np.linalg.eigh(R)
+        idx = np.argsort(eigenvals)[::-1]
+        eigenvals = eigenvals[idx]
+        eigenvecs = eigenvecs[:, idx]
+        if threshold is None:
+            threshold = max(0.2, 1e-6 * eigenvals[0])
+        keep = eigenvals > threshold
+        if not np.any(keep):
+            keep[0] = True  # 至少保留最大的一个
+        return SpectralContext(R, eigenvecs[:, keep], eigenvals[keep], threshold=threshold,
+                               eigenvalue_range=(float(eigenvals.min()), float(eigenvals.max())), solver='dense')
+
+    if threshold is None:
+        threshold = truncation_threshold(R)
+    rng = np.random.default_rng(random_state)
+    result = None
+    if solver in ('lanczos', 'randomized'):
+        top_k = _top_eigpairs_lanczos if solver == 'lanczos' else _top_eigpairs_randomized
+        result = _eigh_top_adaptive(R, threshold, top_k, DEFAULT_PARTIAL_EIGH_K, tol, rng)
+        if result is None:
+            warnings.warn(f"{solver} 特征分解未收敛或保留成分过多，退回 subset")
+            solver = 'subset'
+    elif solver != 'subset':
+        raise ValueError(f"Unknown solver: {solver}")
+    if result is None:
+        result = _eigh_subset(R, threshold)
+    eigenvals, eigenvecs = result
+    idx = np.argsort(eigenvals)[::-1]
+    eigenvals = eigenvals[idx]
+    eigenvecs = eigenvecs[:, idx]
+    keep = eigenvals > threshold
+    if not np.any(keep):
+        lam, v = leading_eigpair(R)     # 至少保留最大的一个
+        eigenvals, eigenvecs, keep = np.array([lam]), v[:, None], np.array([True])
+    return SpectralContext(R, eigenvecs[:, keep], eigenvals[keep], threshold=threshold,
+                           eigenvalue_range=(float('nan'), float(eigenvals[0])), solver=solver)
+
+
+def spectral_accuracy(R, spectral, reference=None):
+    """
+    与稠密全谱结果比较部分 / 迭代分解的精度
+    Args:
+        reference: 可选，'dense' 得到的 SpectralContext；None 时现算
+    Returns:
+        dict: k / k_dense（保留成分数）、max_eigenvalue_error、max_residual（||R u - λ u||）、
+              subspace_sin（两组保留子空间之间最大主角的正弦）、energy_operator_error（||P - P_dense||_max）
+    """
+    if reference is None:
+        reference = spectral_truncation(R, spectral.threshold, solver='dense')
+    out = {'k': spectral.k, 'k_dense': reference.k, 'solver': spectral.solver}
+    out['max_residual'] = float(np.max(np.linalg.norm(R @ spectral.U - spectral.U * spectral.Lambda, axis=0)))
+    if spectral.k == reference.k:
+        out['max_eigenvalue_error'] = float(np.max(np.abs(spectral.Lambda - reference.Lambda)))
+        D = spectral.U - reference.U @ (reference.U.T @ spectral.U)     ## (I - U_ref U_refᵀ) U
+        out['subspace_sin'] = float(np.linalg.norm(D, 2))
+        out['energy_operator_error'] = float(np.max(np.abs(spectral.P - reference.P)))
+    else:
+        out['max_eigenvalue_error'] = out['subspace_sin'] = out['energy_operator_error'] = float('inf')
+    return out
+
+########## 背景方差 σ²：迭代加权中位数
+CHI2_1_MEDIAN = 0.454936448     ## χ²₁ 分布的中位数：噪声 SNP 的 median(z²) ≈ 0.4549 σ²
+
+
+def _pad_rows(Z):
+    """二维数组原样返回；长度不一的向量列表用 NaN 补齐成 (n, max_len)"""
+    if isinstance(Z, np.ndarray) and Z.ndim == 2:
+        return Z.astype(float, copy=False)
+    rows = [np.asarray(z, dtype=float).ravel() for z in Z]
+    out = np.full((len(rows), max((len(z) for z in rows), default=0)), np.nan)
+    for i, z in enumerate(rows):
+        out[i, :len(z)] = z
+    return out
+
+
+def estimate_sigma2_batch(Z, tol=1e-2, max_iter=10, lower=0.8, upper=5.0, return_n_iter=False):
+    """
+    一次估计多条 Z 向量（locus × 性状，或多个重复）的背景方差 σ²
+    z² 每行只排序一次：高斯核权重 exp(-z²/2σ²) 只依赖 z²，在排好序的 z² 上直接重算权重即是有序的，
+    每轮迭代只剩 exp + cumsum + 二分，不再 argsort；各行独立收敛，已收敛的行不再更新
+    Args:
+        Z: (n, p) 数组，或长度不一的 Z 向量列表（内部以 NaN 补齐，NaN 视为缺失）
+        tol / max_iter: 收敛阈值 / 最大迭代次数
+        lower / upper: σ² 的截断范围
+        return_n_iter: 是否同时返回每行的迭代次数
+    Returns:
+        sigma2: (n,)；没有有效值的行为 1.0
+        (sigma2, n_iter) 当 return_n_iter=True
+    """
+    Z = _pad_rows(Z)
+    n, p = Z.shape
+    sigma2 = np.ones(n)
+    n_iter = np.zeros(n, dtype=int)
+    z2s = np.sort(Z ** 2, axis=1)                   ## NaN 排在最后
+    n_valid = np.sum(~np.isnan(z2s), axis=1)
+    rows = np.flatnonzero(n_valid > 0)
+    if len(rows) == 0:
+        return (sigma2, n_iter) if return_n_iter else sigma2
+    z2s, n_valid = z2s[rows], n_valid[rows]
+    ## 初始值：普通中位数（与 np.median 一致：偶数个时取中间两个的均值）
+    r = np.arange(len(rows))
+    lo, hi = z2s[r, (n_valid - 1) // 2], z2s[r, n_valid // 2]
+    s2 = np.where(n_valid % 2 == 1, lo, (lo + hi) / 2) / CHI2_1_MEDIAN
+    last = n_valid - 1
+    active = np.ones(len(rows), dtype=bool)
+    for it in range(max_iter):
+        a = np.flatnonzero(active)
+        w = np.exp(-z2s[a] / (2 * s2[a, None] + 1e-8))
+        w[np.isnan(w)] = 0.0                        ## 补齐位置不计权重，cumw 在末尾保持平直
+        cumw = np.cumsum(w, axis=1)
+        target = 0.5 * cumw[:, -1]
+        ## searchsorted(cumw, target, 'right') - 1；越界（-1 或落到补齐位置）时取最大的有效 z²
+        k = np.sum(cumw <= target[:, None], axis=1) - 1
+        k = np.where((k < 0) | (k > last[a]), last[a], k)
+        s2_new = np.clip(z2s[a, k] / CHI2_1_MEDIAN, lower, upper)
+        converged = np.abs(s2_new - s2[a]) < tol
+        s2[a] = s2_new
+        n_iter[rows[a]] = it + 1
+        active[a[converged]] = False
+        if not active.any():
+            break
+    sigma2[rows] = s2
+    return (sigma2, n_iter) if return_n_iter else sigma2
+
+
+def estimate_sigma2(z, tol=1e-2, max_iter=10):
+    """单条 Z 向量的 σ²（estimate_sigma2_batch 的一行）"""
+    return estimate_sigma2_batch([z], tol=tol, max_iter=max_iter)[0]
+
+########## bootstrap：选择路径前缀树（trie）
+class _TrieNode:
+    """
+    trie 的一个节点 = 一条已选路径（按选择顺序）；ref 为在此节点完整打分的参考状态，
+    只在第二个重复到达时才建立（只经过一次的分叉末端不值得保存），visits 为到达过的重复数
+    """
+    __slots__ = ('children', 'ref', 'visits')
+
+    def __init__(self):
+        self.children = {}
+        self.ref = None
+        self.visits = 0
+
+
+class SelectionTrie:
+    """
+    bootstrap 各次重复的选择路径前缀树：扰动很小时大部分重复前几步的选择相同
+    每个节点保存一个参考 z 的完整打分（各候选的剩余能量 E_ref 及其分解），
+    其他重复 z = z_ref + δ 到达该节点时，候选残差 r_j 对 z 线性：
+        r_j(z) = R_S(z) - g_j C_j(z) - a_j z_j,   g_j = (GᵀR)[:, j],  a_j = A[:, j]
+        E_j(z) = E_j(ref) + 2 <r_j(ref), r_j(δ)> + ||r_j(δ)||²
+    右边两项只含 Gᵀ R_S(δ) 一类的矩阵乘积（按行批量即 GEMM），不构造 (k, |J|) 的残差张量
+    最优候选与次优候选的差距（margin）大于浮点舍入余量时，最优候选即可确定，只精确计算这一个候选的能量；
+    否则（几乎并列、真正可能分叉处）回到完整打分
+    与 z 无关的量（投影算子、候选项）仍由 ProjectorCache 提供；参考状态总量超过 max_bytes 后不再新增
+    trie 只依赖 clean 空间（R, U, Λ），与 sigma2、完成度阈值无关，可在多批重复之间共用
+    """
+
+    def __init__(self, projectors, max_bytes=DEFAULT_TRIE_BYTES):
+        self.projectors = projectors
+        self.root = _TrieNode()
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.nodes = 1
+        self.shortcuts = 0          ## 由参考展开 + margin 直接确定最优候选的次数
+        self.full_scores = 0        ## 完整打分的次数
+
+    def child(self, node, j):
+        nxt = node.children.get(j)
+        if nxt is None:
+            nxt = node.children[j] = _TrieNode()
+            self.nodes += 1
+        return nxt
+
+    @staticmethod
+    def _residual_parts(terms, Z, Y):
+        """按行计算 R_S(z) (n, k) 与 C(z) (n, |J|)"""
+        if terms['S'] is None:
+            return Y, terms['P_JJ'] * Z[:, terms['J']]
+        Z_S = Z[:, terms['S']]
+        R_S = Y - Z_S @ terms['H_S'].T
+        C = (Z_S @ terms['U_S']) @ terms['V_J'] + terms['P_JJ'] * Z[:, terms['J']]
+        return R_S, C
+
+    def set_reference(self, node, terms, z, y, E):
+        """
+        在节点上保存参考状态：z, y = Gᵀz, 各候选能量 E (|J|,)（完整打分的结果）
+        """
+        if node.ref is not None or not np.all(np.isfinite(E)) or self.nbytes >= self.max_bytes:
+            return
+        GtR_J, A = terms['GtR_J'], terms['A']
+        R_ref, C_ref = self._residual_parts(terms, z[None, :], y[None, :])
+        R_ref, C_ref = R_ref[0], C_ref[0]
+        z_J = z[terms['J']]
+        gg = np.einsum('kj,kj->j', GtR_J, GtR_J)
+        gR = R_ref @ GtR_J
+        if A is None:
+            aa = ga = aR = np.zeros(len(z_J))
+        else:
+            aa = np.einsum('kj,kj->j', A, A)
+            ga = np.einsum('kj,kj->j', GtR_J, A)
+            aR = R_ref @ A
+        ref = {
+            'z': z.copy(),
+            'y': y.copy(),
+            'R': R_ref,
+            'C': C_ref,
+            'z_J': z_J,
+            'E': E.copy(),
+            'gg': gg, 'aa': aa, 'ga': ga,
+            'rho_g': gR - C_ref * gg - z_J * ga,            ## <r_j(ref), g_j>
+            'rho_a': aR - C_ref * ga - z_J * aa,            ## <r_j(ref), a_j>
+            'scale': float(y @ y),
+        }
+        node.ref = ref
+        self.nbytes += sum(v.nbytes for v in ref.values() if isinstance(v, np.ndarray))
+
+    def predict(self, node, terms, Z, Y, rtol=1e-9):
+        """
+        用节点参考展开计算各行的候选能量，并判断最优候选是否与其他候选拉开了足够 margin
+        Returns:
+            ok: (n,) bool，True 表示该行最优候选已确定
+            best: (n,) 最优候选在 J 中的位置（ok 为 False 的行无意义）
+        """
+        ref = node.ref
+        n = Z.shape[0]
+        if ref is None or len(terms['J']) < 2:
+            return np.zeros(n, dtype=bool), np.zeros(n, dtype=np.int64)
+        R_d, C_d = self._residual_parts(terms, Z - ref['z'], Y - ref['y'])
+        d_J = Z[:, terms['J']] - ref['z_J']
+        gR_d = R_d @ terms['GtR_J']                         ## (n, |J|)
+        aR_d = R_d @ terms['A'] if terms['A'] is not None else np.zeros_like(gR_d)
+        RR = np.einsum('rk,rk->r', R_d, R_d)[:, None]
+        cross = (R_d @ ref['R'])[:, None] - ref['C'] * gR_d - ref['z_J'] * aR_d \
+            - C_d * ref['rho_g'] - d_J * ref['rho_a']       ## <r_j(ref), r_j(δ)>
+        quad = RR - 2 * C_d * gR_d - 2 * d_J * aR_d \
+            + C_d * C_d * ref['gg'] + d_J * d_J * ref['aa'] + 2 * C_d * d_J * ref['ga']   ## ||r_j(δ)||²
+        E_pred = ref['E'] + 2 * cross + quad
+        slack = rtol * (ref['scale'] + np.einsum('rk,rk->r', Y, Y) + 1.0)
+        two = np.partition(E_pred, 1, axis=1)[:, :2]
+        ok = np.isfinite(two).all(axis=1) & (two[:, 1] - two[:, 0] > 2 * slack)
+        return ok, np.argmin(E_pred, axis=1)
+
+    def stats(self):
+        total = self.shortcuts + self.full_scores
+        return {
+            'nodes': self.nodes,
+            'nbytes': self.nbytes,
+            'shortcuts': self.shortcuts,
+            'full_scores': self.full_scores,
+            'shortcut_rate': self.shortcuts / total if total else 0.0,
+        }
+
+########## bootstrap：所有重复同步推进的前向选择
+def lockstep_forward_selection(Z_raw, spectral, sigma2, target_completion=0.9, max_candidates=None,
+                               z_stop=1.645, use_trie=True, diagnostics=None, replicate_offset=0):
+    """
+    多个 z（bootstrap 各次重复）同时做前向选择，每一步所有仍在进行的重复一起推进
+    每一步按当前所在的 trie 节点（即已选路径）分组（扰动很小，大部分重复路径相同），同一组内：
+        z_cond、剩余能量按行批量计算，与 S 有关的矩阵只算一次；
+        use_trie 时先用节点上保存的参考打分与 margin 上界判断最优候选（SelectionTrie），
+        只有判断不了的行（路径真正分叉处）才对全部候选打分
+    停止条件与 forward_selection 完全相同（完成度达标 / 全部选完 / 最大 |z_cond| < z_stop / 无候选能提升），
+    已停止的重复用掩码剔除
+    Args:
+        Z_raw: (n, p) 每行一个扰动后的 clean Z
+        spectral: SpectralContext
+        sigma2: 背景方差（所有重复共用）
+        target_completion, max_candidates: 同 forward_selection
+        use_trie: 是否使用 spectral.selection_trie（max_candidates 给定时候选集合随 z 变化，不使用）
+        diagnostics: 可选，SelectionDiagnostics；每组每一步按行批量写入，重复编号为 replicate_offset + 行号
+    Returns:
+        paths: list of list of int，每个重复选中的索引（按选择顺序）
+        completion: (n,) 每个重复的最终完成度
+    """
+    Z_raw = np.atleast_2d(np.asarray(Z_raw, dtype=np.float64))
+    n, p = Z_raw.shape
+    cache = spectral.projectors
+    trie = spectral.selection_trie if use_trie and max_candidates is None else SelectionTrie(cache, max_bytes=0)
+    diag = diagnostics if diagnostics is not None else SelectionDiagnostics(verbose=SILENT, record_steps=False)
+    Z = Z_raw / np.sqrt(sigma2)
+    Y = cache.energy_basis_batch(Z)
+    E_total = cache.residual_energy_batch(Y, Z, [])
+
+    paths = [[] for _ in range(n)]
+    nodes = [trie.root] * n
+    completion = np.zeros(n)
+    active = np.ones(n, dtype=bool)
+    step = 0
+    while active.any():
+        step += 1
+        groups = {}
+        for r in np.flatnonzero(active):
+            groups.setdefault(id(nodes[r]), []).append(r)
+        for rows in groups.values():
+            rows = np.asarray(rows)
+            node = nodes[rows[0]]
+            S = paths[rows[0]]
+            Zg, Yg, Eg = Z[rows], Y[rows], E_total[rows]
+            Z_cond = cache.conditional_z_batch(Zg, S)
+            E_res = cache.residual_energy_batch(Yg, Zg, S)
+            ok = Eg > 1e-8
+            comp = np.ones(len(rows))
+            comp[ok] = (Eg[ok] - E_res[ok]) / Eg[ok]
+            completion[rows] = comp
+
+            go = comp < target_completion
+            stop = np.where(go, STOP_NONE, STOP_TARGET)
+            remaining = np.ones(p, dtype=bool)
+            remaining[S] = False
+            J = np.flatnonzero(remaining)
+            if len(J) == 0:
+                max_z = np.full(len(rows), np.nan)
+                stop[go] = STOP_ALL_SELECTED
+                go[:] = False
+            else:
+                max_z = np.max(np.abs(Z_cond[:, J]), axis=1)
+                below = go & (max_z < z_stop)
+                stop[below] = STOP_Z_BELOW
+                go &= ~below
+            active[rows[~go]] = False
+            diag.record_steps_batch(rows[~go] + replicate_offset, step, len(S), comp[~go], max_z[~go], stop=stop[~go])
+            if not go.any():
+                continue
+
+            rows_go = rows[go]
+            terms = cache.candidate_terms(S, J)
+            Z_go, Y_go, E_go = Zg[go], Yg[go], Eg[go]
+            choice = np.full(len(rows_go), -1)          ## 每行最优候选在 J 中的位置
+            best_val = np.empty(len(rows_go))
+            n_improving = np.full(len(rows_go), -1)     ## 只有完整打分的行才统计
+
+            def _full_score(sel):
+                E_f = E_go[sel][:, None]
+                E_cand = cache.candidate_energies_batch(Y_go[sel], Z_go[sel], S, J, terms=terms)
+                comp_cand = np.where(E_f > 1e-8, (E_f - E_cand) / np.where(E_f > 1e-8, E_f, 1.0), 1.0)
+                comp_cand = np.where(np.isfinite(comp_cand), comp_cand, -np.inf)
+
+                # 候选按 |z_cond| 降序（与 forward_selection 的排序方式一致），同分时取靠前者
+                order = np.argsort(np.abs(Z_cond[go][sel][:, J]), axis=1)[:, ::-1][:, :max_candidates]
+                comp_sorted = np.take_along_axis(comp_cand, order, axis=1)
+                best_pos = np.argmax(comp_sorted, axis=1)
+                idx = np.flatnonzero(sel)
+                choice[idx] = order[np.arange(len(idx)), best_pos]
+                best_val[idx] = comp_sorted[np.arange(len(idx)), best_pos]
+                n_improving[idx] = np.sum(comp_sorted > completion[rows_go[idx]][:, None], axis=1)
+                trie.full_scores += len(idx)
+                diag.count('full_score', len(idx))
+                return E_cand
+
+            # 1) 节点还没有参考状态且不止一个重复经过：完整打分第一行，作为该节点的参考状态
+            pending = np.ones(len(rows_go), dtype=bool)
+            node.visits += len(rows_go)
+            if node.ref is None and node.visits > 1 and trie.nbytes < trie.max_bytes:
+                first = np.zeros(len(rows_go), dtype=bool)
+                first[0] = True
+                E_first = _full_score(first)
+                pending[0] = False
+                if E_go[0] > 1e-8:
+                    trie.set_reference(node, terms, Z_go[0], Y_go[0], E_first[0])
+
+            # 2) 参考展开 + margin 能确定最优候选的行，只精确计算这一个候选
+            short = np.zeros(len(rows_go), dtype=bool)
+            if node.ref is not None and pending.any():
+                decided, best = trie.predict(node, terms, Z_go[pending], Y_go[pending])
+                short[np.flatnonzero(pending)[decided]] = True
+                short &= E_go > 1e-8
+                if short.any():
+                    best_short = best[short[pending]]
+                    E_best = cache.paired_candidate_energies(Y_go[short], Z_go[short], S, J[best_short])
+                    choice[short] = best_short
+                    best_val[short] = (E_go[short] - E_best) / E_go[short]
+                    trie.shortcuts += int(short.sum())
+                    diag.count('trie_shortcut', int(short.sum()))
+
+            # 3) 其余行（几乎并列、路径可能分叉）：全部候选打分
+            full = pending & ~short
+            if full.any():
+                _full_score(full)
+
+            gain = best_val > completion[rows_go]
+            n_cand = len(J) if max_candidates is None else min(len(J), max_candidates)
+            diag.record_steps_batch(rows_go + replicate_offset, step, len(S), comp[go], max_z[go], n_cand,
+                                    n_improving, stop=np.where(gain, STOP_NONE, STOP_NO_GAIN))
+            for i, r in enumerate(rows_go):
+                if gain[i]:
+                    j = int(J[choice[i]])
+                    paths[r].append(j)
+                    nodes[r] = trie.child(node, j)
+                else:
+                    active[r] = False
+    return paths, completion
+
+
+########## bootstrap：每个重复独立的随机流 + 进程并行
+def child_seed_sequence(seed, *key):
+    """
+    seed 的子随机流：spawn_key 末尾追加 key，key 为 (i,) 时即 SeedSequence(seed).spawn(n)[i]；
+    只依赖 (seed, key)，与之前派生过多少个子流无关
+    seed: int / SeedSequence
+    """
+    root = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    return np.random.SeedSequence(root.entropy, spawn_key=root.spawn_key + tuple(int(k) for k in key),
+                                  pool_size=root.pool_size)
+
+
+def replicate_seed_sequence(seed, i):
+    """
+    第 i 个重复的随机流：只依赖 (seed, i)，与重复的执行顺序和分配方式无关
+    seed: int / SeedSequence
+    """
+    return child_seed_sequence(seed, i)
+
+
+def perturb_replicates(Z_clean, z_perturb_sd, seed, start, stop):
+    """
+    重复 [start, stop) 的扰动 Z，每行一个：Z_clean + N(0, sd²)，各行用自己的 Generator
+    Returns:
+        (stop - start, p)
+    """
+    Z_clean = np.asarray(Z_clean, dtype=np.float64)
+    Z = np.empty((stop - start, len(Z_clean)))
+    for row, i in enumerate(range(start, stop)):
+        rng = np.random.default_rng(replicate_seed_sequence(seed, i))
+        Z[row] = Z_clean + rng.normal(0, z_perturb_sd, size=Z_clean.shape)
+    return Z
+
+
+## worker 进程内的状态：由 initializer 设置一次，之后每个任务只传重复编号
+_WORKER_STATE = {}
+
+
+def _init_bootstrap_worker(spectral, Z_clean, sigma2, z_perturb_sd, seed, options):
+    _WORKER_STATE.update(spectral=spectral, Z_clean=Z_clean, sigma2=sigma2,
+                         z_perturb_sd=z_perturb_sd, seed=seed, options=options)
+
+
+def _bootstrap_chunk(bounds, record_steps=False):
+    start, stop = bounds
+    st = _WORKER_STATE
+    Z = perturb_replicates(st['Z_clean'], st['z_perturb_sd'], st['seed'], start, stop)
+    diag = SelectionDiagnostics(verbose=SILENT, capacity=64 * (stop - start), record_steps=record_steps)
+    paths, completion = lockstep_forward_selection(Z, st['spectral'], st['sigma2'], diagnostics=diag,
+                                                   replicate_offset=start, **st['options'])
+    return start, paths, completion, diag
+
+
+class BootstrapRunner:
+    """
+    可复现、可并行的 bootstrap：第 i 个重复的扰动只由 (seed, i) 决定，
+    重复按固定大小（chunk_size）切块，每块在一个进程里用 lockstep_forward_selection 计算，
+    因此结果与 worker 数逐位一致（n_workers=1 时在当前进程内按同样的块计算）
+    clean 空间（R、U、Λ，即 SpectralContext）与 Z_clean 通过进程池 initializer 每个 worker 只传一次，
+    任务本身只传重复编号区间
+    用法：
+        with BootstrapRunner(spectral, Z_clean, sigma2, 0.01, seed=1, n_workers=4) as runner:
+            paths, completion = runner.run(0, 100)
+    注意：worker 内 BLAS 多线程会与进程并行争抢核，可按需设置 OMP_NUM_THREADS
+    """
+
+    def __init__(self, spectral, Z_clean, sigma2, z_perturb_sd=0.01, seed=None, n_workers=None,
+                 chunk_size=DEFAULT_BOOTSTRAP_CHUNK, target_completion=0.9, max_candidates=None):
+        self.seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.n_workers = (os.cpu_count() or 1) if n_workers is None else max(1, int(n_workers))
+        self.chunk_size = max(1, int(chunk_size))
+        self._initargs = (spectral, np.asarray(Z_clean, dtype=np.float64), sigma2, z_perturb_sd, self.seed,
+                          {'target_completion': target_completion, 'max_candidates': max_candidates})
+        self._pool = None
+
+    @property
+    def entropy(self):
+        """根种子（seed=None 时为随机生成的熵），记录下来即可复现"""
+        return self.seed.entropy
+
+    @property
+    def spawn_key(self):
+        """根种子的 spawn_key（由上层随机流派生时非空），与 entropy 一起确定全部重复的随机流"""
+        return tuple(self.seed.spawn_key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def run(self, start, stop, diagnostics=None):
+        """
+        计算重复 [start, stop)；给定 diagnostics（SelectionDiagnostics）时各块的逐步记录按重复顺序并入其中
+        Returns:
+            paths: list of list of int（clean 空间索引，按选择顺序）
+            completion: (stop - start,)
+        """
+        chunks = [(s, min(s + self.chunk_size, stop)) for s in range(start, stop, self.chunk_size)]
+        record = [diagnostics is not None and diagnostics.record_steps] * len(chunks)
+        if self.n_workers == 1 or len(chunks) <= 1:
+            _init_bootstrap_worker(*self._initargs)
+            try:
+                results = [_bootstrap_chunk(c, r) for c, r in zip(chunks, record)]
+            finally:
+                _WORKER_STATE.clear()
+        else:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.n_workers, initializer=_init_bootstrap_worker,
+                                                 initargs=self._initargs)
+            results = list(self._pool.map(_bootstrap_chunk, chunks, record))
+        paths, completion = [], []
+        for _, chunk_paths, chunk_completion, chunk_diag in sorted(results, key=lambda r: r[0]):
+            paths.extend(chunk_paths)
+            completion.append(chunk_completion)
+            if diagnostics is not None:
+                diagnostics.extend(chunk_diag)
+        return paths, np.concatenate(completion) if completion else np.zeros(0)
+
+
+########## 自适应 bootstrap：选择频率的置信区间
+def wilson_interval(counts, n, z=1.96):
+    """
+    二项比例的 Wilson 置信区间（向量化）
+    Args:
+        counts: (m,) 被选中次数
+        n: 重复数
+        z: 正态分位数，1.96 对应 95%
+    Returns:
+        lower, upper: (m,)
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    if n <= 0:
+        return np.zeros_like(counts), np.ones_like(counts)
+    phat = counts / n
+    z2 = z * z
+    denom = 1.0 + z2 / n
+    center = (phat + z2 / (2 * n)) / denom
+    half = z * np.sqrt(phat * (1 - phat) / n + z2 / (4 * n * n)) / denom
+    return np.clip(center - half, 0.0, 1.0), np.clip(center + half, 0.0, 1.0)
+
+
+def frequencies_resolved(counts, n, thresholds=(0.8, 0.9), z=1.96):
+    """
+    每个变量的选择频率置信区间是否已经完全落在每个阈值的一侧（不会再改变稳定性判定）
+    Returns:
+        resolved: (m,) bool
+    """
+    lower, upper = wilson_interval(counts, n, z)
+    resolved = np.ones(len(lower), dtype=bool)
+    for t in thresholds:
+        resolved &= (lower > t) | (upper < t)
+    return resolved
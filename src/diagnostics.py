@@ -0,0 +1,164 @@
+'''
+前向选择 / bootstrap 的诊断信息收集
+热循环中不再逐步 print：每一步的指标写进预分配的 numpy 数组（容量不够时倍增），
+文字输出按 verbose 级别控制，调用方先用 diag.enabled(level) 判断，级别不够时连 f-string 都不格式化
+    SILENT  = 0   不输出
+    SUMMARY = 1   每次 bootstrap 输出汇总（默认）
+    CALL    = 2   每次 forward_selection / 谱截断的开始、结束信息
+    STEP    = 3   每一步的信息（原来的逐步 print）
+每条记录对应一个重复在一个状态上的一次评估（包括最后判定停止的那一次）
+'''
+import numpy as np
+
+SILENT, SUMMARY, CALL, STEP = 0, 1, 2, 3
+
+## 停止原因（stop 字段）
+STOP_NONE = 0           ## 继续选择
+STOP_TARGET = 1         ## 达到目标完成度
+STOP_ALL_SELECTED = 2   ## 所有 SNP 已选择
+STOP_Z_BELOW = 3        ## 最大条件 |z| < 阈值
+STOP_NO_GAIN = 4        ## 没有候选能提升完成度
+STOP_ERROR = 5          ## 计算失败 / 迭代次数过多
+STOP_REASONS = {
+    STOP_NONE: 'continue',
+    STOP_TARGET: 'target_completion',
+    STOP_ALL_SELECTED: 'all_selected',
+    STOP_Z_BELOW: 'z_below_threshold',
+    STOP_NO_GAIN: 'no_gain',
+    STOP_ERROR: 'error',
+}
+
+_FIELDS = (
+    ('replicate', np.int32),
+    ('step', np.int32),
+    ('n_selected', np.int32),
+    ('completion', np.float64),
+    ('max_abs_z_cond', np.float64),
+    ('n_candidates', np.int32),
+    ('n_improving', np.int32),        ## -1：未统计（如由 trie margin 直接确定最优候选）
+    ('stop', np.int8),
+)
+
+
+class SelectionDiagnostics:
+    """
+    逐步指标收集器
+    Args:
+        verbose: 输出级别（SILENT / SUMMARY / CALL / STEP）
+        capacity: 初始预分配的记录数
+        record_steps: False 时不保存逐步记录，只保留计数器（record_* 直接返回）
+    """
+
+    def __init__(self, verbose=SUMMARY, capacity=1024, record_steps=True):
+        self.verbose = verbose
+        self.record_steps = record_steps
+        self.n = 0
+        self.counters = {}
+        self._data = {name: np.empty(capacity if record_steps else 0, dtype=dtype) for name, dtype in _FIELDS}
+
+    def __len__(self):
+        return self.n
+
+    def enabled(self, level):
+        return self.verbose >= level
+
+    def count(self, event, n=1):
+        """事件计数，如 fallback 次数"""
+        self.counters[event] = self.counters.get(event, 0) + n
+
+    def _reserve(self, m):
+        need = self.n + m
+        cap = len(self._data['step'])
+        if need <= cap:
+            return
+        new_cap = max(need, 2 * cap, 16)
+        for name, arr in self._data.items():
+            grown = np.empty(new_cap, dtype=arr.dtype)
+            grown[:self.n] = arr[:self.n]
+            self._data[name] = grown
+
+    def record_step(self, replicate, step, n_selected, completion, max_abs_z_cond,
+                    n_candidates=0, n_improving=-1, stop=STOP_NONE):
+        if not self.record_steps:
+            return
+        self._reserve(1)
+        i = self.n
+        d = self._data
+        d['replicate'][i] = replicate
+        d['step'][i] = step
+        d['n_selected'][i] = n_selected
+        d['completion'][i] = completion
+        d['max_abs_z_cond'][i] = max_abs_z_cond
+        d['n_candidates'][i] = n_candidates
+        d['n_improving'][i] = n_improving
+        d['stop'][i] = stop
+        self.n += 1
+
+    def record_steps_batch(self, replicate, step, n_selected, completion, max_abs_z_cond,
+                           n_candidates=0, n_improving=-1, stop=STOP_NONE):
+        """多个重复同一步的记录（lockstep 引擎按组写入），标量参数自动广播"""
+        if not self.record_steps:
+            return
+        replicate = np.asarray(replicate)
+        m = len(replicate)
+        if m == 0:
+            return
+        self._reserve(m)
+        sl = slice(self.n, self.n + m)
+        d = self._data
+        d['replicate'][sl] = replicate
+        d['step'][sl] = step
+        d['n_selected'][sl] = n_selected
+        d['completion'][sl] = completion
+        d['max_abs_z_cond'][sl] = max_abs_z_cond
+        d['n_candidates'][sl] = n_candidates
+        d['n_improving'][sl] = n_improving
+        d['stop'][sl] = stop
+        self.n += m
+
+    def extend(self, other):
+        """合并另一个收集器（如并行 worker 返回的）的记录与计数"""
+        for event, n in other.counters.items():
+            self.count(event, n)
+        if not self.record_steps or other.n == 0:
+            return
+        self._reserve(other.n)
+        for name, arr in self._data.items():
+            arr[self.n:self.n + other.n] = other._data[name][:other.n]
+        self.n += other.n
+
+    def arrays(self):
+        """按字段返回记录（视图，长度为记录数）"""
+        return {name: arr[:self.n] for name, arr in self._data.items()}
+
+    def summary(self):
+        """
+        Returns:
+            dict: 记录数、重复数、每个重复的步数、最终完成度、停止原因分布、事件计数
+        """
+        out = {'n_records': int(self.n), 'counters': dict(self.counters)}
+        if self.n == 0:
+            return out
+        d = self.arrays()
+        final = d['stop'] != STOP_NONE
+        replicates, steps = np.unique(d['replicate'], return_counts=True)
+        out.update({
+            'n_replicates': int(len(replicates)),
+            'mean_steps': float(steps.mean()),
+            'max_steps': int(steps.max()),
+            'mean_final_completion': float(d['completion'][final].mean()) if final.any() else float('nan'),
+            'stop_reasons': {STOP_REASONS[int(code)]: int(n)
+                             for code, n in zip(*np.unique(d['stop'][final], return_counts=True))},
+        })
+        return out
+
+    def format_summary(self):
+        s = self.summary()
+        if s['n_records'] == 0:
+            return "   - 诊断: 无记录"
+        reasons = ', '.join(f"{k} {v}" for k, v in s['stop_reasons'].items())
+        lines = [f"   - 诊断: {s['n_replicates']} 个重复, 平均 {s['mean_steps']:.1f} 步 (最多 {s['max_steps']}), "
+                 f"停止原因: {reasons}"]
+        if s['counters']:
+            lines.append("   - 事件计数: " + ', '.join(f"{k} {v}" for k, v in s['counters'].items()))
+        return '\n'.join(lines)
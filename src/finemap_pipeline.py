@@ -0,0 +1,1283 @@
+'''
+精细定位主流程（原 notebook 3 的函数部分，放进模块后可被进程池 worker 导入）
+单个信号：构建 block → clean 空间 → 谱截断 → bootstrap 前向选择 → 稳定变量的多变量效应
+    run_fine_mapping_for_signal(gene_df, ld_df, ...) 是入口，locus 级的读写与调度见 locus_driver
+绘图在 finemap_plots（只有它导入 matplotlib）
+'''
+import warnings
+import functools
+import numpy as np
+import pandas as pd
+import networkx as nx
+from collections import Counter
+from ld_matrix import build_sparse_ld, strong_ld_edges
+from block_engine import (dense_ld_edges, adjacency_from_edges, find_cliques_adjacency,
+                          find_cliques_bitset, sort_cliques_by_mean_r,
+                          leading_eigpair,
+                          clique_membership, clique_mean_r, greedy_disjoint_cliques,
+                          block_loading_matrix, block_ld_products, ExtendedLD)
+from block_cache import block_geometry_key, load_block_geometry, save_block_geometry
+from cojo_engine import (ProjectorCache, SpectralContext, spectral_truncation,
+                         lockstep_forward_selection, BootstrapRunner, perturb_replicates, child_seed_sequence,
+                         frequencies_resolved, estimate_sigma2_batch, CHI2_1_MEDIAN)
+from diagnostics import (SelectionDiagnostics, SILENT, SUMMARY, CALL, STEP, STOP_TARGET,
+                         STOP_ALL_SELECTED, STOP_Z_BELOW, STOP_NO_GAIN, STOP_ERROR)
+
+
+########## 告警
+## 告警装饰器 ## 
+def limit_warnings(max_count=10): 
+    def decorator(func):
+        @functools.wraps(func)   
+        def wrapper(*args, **kwargs):
+            if not hasattr(wrapper, '_warning_count'):
+                wrapper._warning_count = 0
+                wrapper._max_warnings = max_count
+            return func(*args, **kwargs)
+        
+        def controlled_warn(message, category=None):   # 提供一个安全的 warn 方法
+            if wrapper._warning_count < wrapper._max_warnings:    
+                warnings.warn(message, category or UserWarning)
+                wrapper._warning_count += 1
+            else:
+                pass  # 超过次数，静默忽略
+        
+        wrapper.warn = controlled_warn
+        return wrapper
+    return decorator
+
+
+########## block 构建：clique → 去重 → 修剪 → 信息增强
+def find_maximal_clique_blocks(R: np.ndarray, snp_ids: np.ndarray, r_min: float = 0.8, R_sparse=None,
+                               backend: str = 'adjacency', max_cliques: int = None, time_budget: float = None,
+                               use_degeneracy: bool = True, order_by_mean_r: bool = False) :
+    """
+    对每个SNP，完全基于 R ≥ r_min 构建 maximal cliques 作为候选 block
+    Args:
+        R: LD 矩阵 (p x p), 已排序，对称
+        snp_ids: SNP ID 数组 (p,)，内容是详细的文本
+        r_min: 最小 R 阈值（正相位），目前设置为 0.8
+        R_sparse: 可选，build_sparse_ld 得到的 CSR 稀疏 LD；给定时直接从中取强 LD 边，
+                  不再扫描整个 p x p 矩阵
+        backend: 'adjacency'（默认，numpy 邻接表，不经过 networkx）、'networkx'（原实现，便于对照）
+                 或 'bitset'（位集 Bron–Kerbosch，适合 HLA 等 clique 数量爆炸的 locus）
+        max_cliques / time_budget / use_degeneracy: 仅 'bitset' 使用，clique 数上限、时间预算（秒）、是否按退化序展开；
+                 截断时给出 warning，只保留已经枚举到的 clique
+        order_by_mean_r: 是否按 mean_r 降序输出（附带 'mean_r'），resolve_block_overlap 直接复用，不再重算
+    Returns:
+        blocks: List of dict, dict 包含'snps'(索引数组), 'snp_ids'(ID列表), 'size'
+    """
+    p = R.shape[0]
+    # 强 LD 边一次性提取：稀疏路径只遍历存储下来的强 LD 对，稠密路径用上三角 + 阈值掩码
+    # 两者都按 (i, j) 字典序返回，与原来双重循环的加边顺序一致
+    if R_sparse is not None:
+        rows, cols = strong_ld_edges(R_sparse, r_min)
+    else:
+        rows, cols = dense_ld_edges(R, r_min)
+
+    # 找所有 maximal cliques
+    if backend == 'adjacency':
+        # 直接在邻接表上枚举，不构建 networkx 对象，算法与 nx.find_cliques 相同，输出一致
+        indptr, indices = adjacency_from_edges(p, rows, cols)
+        cliques = list(find_cliques_adjacency(p, indptr, indices))
+    elif backend == 'networkx':
+        G = nx.Graph()
+        G.add_nodes_from(range(p))
+        G.add_edges_from(zip(rows.tolist(), cols.tolist()))
+        cliques = list(nx.find_cliques(G)) ## 关键是这里的输出是什么
+    elif backend == 'bitset':
+        indptr, indices = adjacency_from_edges(p, rows, cols)
+        cliques, _ = find_cliques_bitset(p, indptr, indices, max_cliques=max_cliques, time_budget=time_budget,
+                                         use_degeneracy=use_degeneracy, min_size=2)
+    else:
+        raise ValueError(f"Unknown backend: {backend}")
+
+    cliques = [c for c in cliques if len(c) >= 2]
+    mean_r = None
+    if order_by_mean_r:
+        cliques, mean_r = sort_cliques_by_mean_r(cliques, R)
+
+    blocks = []
+    for c, clique in enumerate(cliques):
+        clique = sorted(clique)
+        
+        blk = {
+            'snps': np.array(clique),             ## 这里是纯index
+            'snp_ids': snp_ids[clique].tolist(),  ## 这里是根据index提取的详细文本
+            'size': len(clique)
+        }
+        if mean_r is not None:
+            blk['mean_r'] = mean_r[c]
+        blocks.append(blk)
+    
+    return blocks
+
+
+
+def resolve_block_overlap(blocks, R):
+    """
+    解决 block 间 SNP 重叠，优先保留“内部 LD 内聚性高”者。
+    严格保证输出 block 之间无 SNP 重叠
+    注意，这里传入的R矩阵可能是numpy，注意['snps']是index不是名字（后续检查）
+    Args:
+        blocks: 所有候选 block 列表（来自 find_maximal_clique_blocks）
+        R: LD 矩阵 (p, p)
+        排序依据：'mean_r' ，不使用PC1，因为可能后面还有剪枝，导致PC1不可靠
+        若输入 block 已带 'mean_r'（find_maximal_clique_blocks(order_by_mean_r=True)），直接复用
+    Returns:
+        final_blocks: 无重叠的 block 列表（dict 格式同输入）
+    """
+    if not blocks:
+        return []
+    blocks = [blk for blk in blocks if len(blk['snps']) >= 2]
+    if not blocks:
+        return []
+    # clique × SNP 稀疏成员矩阵：全部 mean_r 一次矩阵乘积得到
+    M = clique_membership([blk['snps'] for blk in blocks], R.shape[0])
+    if all('mean_r' in blk for blk in blocks):
+        mean_r = np.array([blk['mean_r'] for blk in blocks], dtype=float)
+    else:
+        mean_r = clique_mean_r(M, R)
+    # 按 mean_r 降序排序（优先保留内聚性强的），同分保持输入顺序
+    order = np.argsort(-mean_r, kind='stable')
+    # 贪心选择：只要有任何 SNP 重叠，就跳过
+    final_blocks = []
+    for c in greedy_disjoint_cliques(M, order):
+        block = blocks[c].copy()  ## 只拷贝被选中的 block
+        block['mean_r'] = mean_r[c]
+        final_blocks.append(block)
+
+    return final_blocks
+
+
+
+def evaluate_and_prune_block(
+    block: dict,
+    R: np.ndarray,
+    pve_min: float = 0.7,
+    min_size: int = 2
+):
+    """
+    迭代修剪单个 block，直到其 PC1 解释方差R矩阵的比例 ≥ pve_min
+    Z矩阵 的方向是结果，不是定义，因此不作为修剪依据，不参与修剪
+    并且已经保证了 block 代表信号与 GWAS 总体方向一致，已经够了
+    成功时返回包含 snps、loadings、pve 等字段的增强 block 字典；
+    失败时返回 None。
+    关键保证：
+        - 每次更新后优先检查 PVE（只需最大特征对，热启动幂迭代，见 block_engine.leading_eigpair）
+        - 主动修复确保在病态下仍能推进
+        - 返回结果可直接用于后续 enrich 函数
+    """
+    curr = block['snps'].copy().tolist()
+    idx_to_id = dict(zip(block['snps'], block['snp_ids']))  # 提前构建 ID 映射
+    v_prev = None       ## 上一轮的 PC1（已删去被移除的 SNP），作为幂迭代的热启动
+
+    while len(curr) >= min_size:
+        n = len(curr)
+        R_sub = R[np.ix_(curr, curr)]
+        # 步骤1：只求最大特征对，检查是否满足 PVE
+        try:
+            lambda_max, pc1 = leading_eigpair(R_sub, v0=v_prev)
+            pve = lambda_max / n
+
+            if pve >= pve_min:
+                w = pc1 / np.linalg.norm(pc1)             ##  L2 归一化
+                snp_ids_kept = [idx_to_id[i] for i in curr]
+                return {
+                    'snps': np.array(curr),
+                    'snp_ids': snp_ids_kept,
+                    'loadings': w,           # 归一化载荷，也就是PC1解释方差比例
+                    'pve': float(pve),
+                    'size': len(curr),
+                    'mean_r': R_sub[np.triu_indices(n, k=1)].mean() if n > 1 else 0.0
+                }
+
+            # 主动修复：删掉 PC1 载荷绝对值最小的 SNP
+            outlier_idx = np.argmin(np.abs(pc1))
+            curr.pop(outlier_idx)
+            v_prev = np.delete(pc1, outlier_idx)
+            continue
+        except np.linalg.LinAlgError:
+            v_prev = None
+
+        # 兜底（R_sub 本身无法分解时）：逐个试删，保留 PVE 最大的子集；每个试删子集各不相同，没有可复用的分解
+        best_score = -1
+        best_idx = None
+        for i in range(len(curr)):
+            trial = curr[:i] + curr[i+1:]
+            if len(trial) < min_size:
+                continue
+            R_trial = R[np.ix_(trial, trial)]
+            try:
+                eigvals = np.linalg.eigvalsh(R_trial)
+                pve_candidate = eigvals[-1] / len(trial)
+                if pve_candidate > best_score:
+                    best_score = pve_candidate
+                    best_idx = i
+            except (np.linalg.LinAlgError, ValueError):
+                continue
+        if best_idx is not None:
+            curr.pop(best_idx)
+        else:
+            return None  # 无法修复
+    return None
+
+
+
+def enrich_block_with_pca1_info(
+    block: dict,
+    R_full: np.ndarray,
+    z_gwas_full: np.ndarray,
+    z_qtl_full: np.ndarray,
+    R_sparse=None,
+    compute_r_to_others: bool = True
+) -> dict:
+    """
+    为已修剪的 block 添加可用于后续前向选择的统计量。
+    关键转换：将 evaluate_and_prune_block 输出的 L2-unitized loadings
+              转换为满足 Var(PC1) = 1 的建模尺度载荷。
+    Args:
+        block: 来自 evaluate_and_prune_block 的输出字典，包含:
+               - 'snps': np.array of int, SNP 索引
+               - 'snp_ids': list of str, SNP ID 列表
+               - 'loadings': np.array, PC1 载荷（L2 归一化，即 ||w||=1）
+               - 'pve': float, PC1 解释方差比例
+        R_full: (p, p) float, 全局 LD 矩阵（对称、标准化）
+        z_gwas_full: (p,) float, GWAS marginal Z 分数
+        z_qtl_full: (p,) float, QTL marginal Z 分数（可选用途）
+        R_sparse: 可选，CSR 稀疏 LD；给定时 r_to_others 只用 block 行里存下来的非零元素计算
+        compute_r_to_others: False 时 'r_to_others' 先置为 None，
+               由调用方用载荷矩阵一次性算出（build_enriched_blocks_pipeline 的做法）
+    Returns:
+        enhanced_block: dict, 原始 block 的增强版本，新增字段：
+            - 'loading_weights': np.array, 满足 w^T R_block w = 1 的载荷
+            - 'z_gwas_block': float, block 代表 Z（基于标准化 PC1）
+            - 'z_qtl_block': float, QTL 方向上的 block Z
+            - 'r_to_others': np.array (p,), block 与所有 SNP 的加权相关性
+    """
+    snps_in_block = block['snps']
+    if len(snps_in_block) == 0:
+        raise ValueError("Block has no SNPs.")
+    if R_full.shape[0] != R_full.shape[1]:
+        raise ValueError("R_full must be square.")
+    p = R_full.shape[0]
+    if len(z_gwas_full) != p or len(z_qtl_full) != p:
+        raise ValueError("z_gwas_full and z_qtl_full must have length p.")
+    # --- 提取 block 内部信息 ---
+    members_idx = np.array(snps_in_block)
+    R_block = R_full[np.ix_(members_idx, members_idx)]  # (m, m)
+    w_l2 = np.array(block['loadings'])  # L2-unitized from pruning step
+
+    if len(w_l2) != len(members_idx):
+        raise ValueError("Length of 'loadings' does not match number of SNPs in block.")
+    
+    # --- 关键：归一化使得 Var(PC1) = 1，即：w^T R_block w = 1 ---
+    var_pc1 = w_l2 @ R_block @ w_l2
+    if var_pc1 < 1e-10:
+        raise ValueError(
+            f"PC1 variance ({var_pc1:.2e}) too small. "
+            "Likely due to near-collinear SNPs or numerical instability."
+        )
+    scaling_factor = np.sqrt(var_pc1)
+    w_model = w_l2 / scaling_factor  # now w_model^T R_block w_model = 1
+    
+    var_pc1_normalized = w_model @ R_block @ w_model
+    assert np.isclose(var_pc1_normalized, 1.0, atol=1e-5), \
+        f"Normalization failed: Var(PC1) = {var_pc1_normalized:.3f} ≠ 1.0" ## 
+
+    # --- 校正方向：确保与 GWAS 信号同向 ---
+    z_sub = z_gwas_full[members_idx]
+    if w_model @ z_sub < 0:
+        w_model = -w_model
+    # --- 计算 block-level Z 分数 ---
+    z_gwas_block = float(w_model @ z_sub)
+    z_qtl_block = float(w_model @ z_qtl_full[members_idx])
+    # --- 计算 block 与所有 SNP 的加权 LD（相关性尺度）---
+    # r_block,j = Σ_k w_k * r_k,j
+    if not compute_r_to_others:
+        r_to_others = None
+    elif R_sparse is not None:
+        r_to_others = np.asarray(R_sparse[members_idx, :].T @ w_model).ravel()  # (p,)
+    else:
+        r_to_others = w_model @ R_full[members_idx, :]  # (p,)
+    # --- 构建增强 block ---
+    enhanced_block = block.copy()
+    enhanced_block.update({
+        'loading_weights': w_model,           # 用于建模的标准化载荷
+        'z_gwas_block': z_gwas_block,         # 标准化后的 block Z
+        'z_qtl_block': z_qtl_block,
+        'r_to_others': r_to_others            # 长度为 p，包含所有 SNP的相互R
+    })
+
+    return enhanced_block
+
+
+
+def build_enriched_blocks_pipeline(
+    R: np.ndarray,
+    z_gwas: np.ndarray,
+    z_qtl: np.ndarray,
+    snp_ids: np.ndarray,
+    R_sparse=None,
+    clique_backend: str = 'adjacency',
+    clique_options: dict = None,
+    materialize_extended: bool = False,
+    block_cache_dir=None
+) -> dict:
+    """
+    从无到有构建 block，完成：构建 → 去重 → 修剪 → 信息增强
+    输出：
+        - enhanced blocks
+        - 剩余 SNP 索引
+        - block-block 相关性矩阵
+        - 扩展的 LD 矩阵 R_extended (p+B, p+B)，支持 SNP + block 统一建模；
+          默认是惰性视图 ExtendedLD（不分配 (p+B)² 的稠密矩阵），materialize_extended=True 时返回稠密数组
+          （locus_driver 写 pkl 前会物化为 ndarray，保存的格式不变）
+        - 映射表：block 在扩展矩阵中的位置
+    R_sparse: 可选，CSR 稀疏 LD（build_sparse_ld），用于 block 发现和 r_to_others
+    clique_backend: find_maximal_clique_blocks 的 backend；高 LD locus 可用 'bitset'
+    clique_options: 传给 find_maximal_clique_blocks 的其他参数，如 {'max_cliques': 20000, 'time_budget': 60}
+    block_cache_dir: 可选，block 几何缓存目录（block_cache）；命中时只重做依赖 Z 的 enrich
+    Returns:
+        dict: {
+            'blocks': list of enhanced_block,
+            'remaining_snp_idx': np.array,
+            'block_block_r_matrix': (B, B),
+            'R_extended': ExtendedLD (p+B, p+B)，或 materialize_extended=True 时的 ndarray,
+            'block_positions_in_extended': list of int,  # 长度 B，表示每个 block 在 R_extended 中的列索引
+        }
+    """
+    p = R.shape[0]
+
+    assert len(z_gwas) == p and len(z_qtl) == p and len(snp_ids) == p, "输入维度不匹配"
+
+    def _extended(r_to_others, block_block):
+        R_ext = ExtendedLD(R, r_to_others, block_block)
+        return R_ext.toarray() if materialize_extended else R_ext
+
+    if p == 0:
+        return {
+            'blocks': [],
+            'remaining_snp_idx': np.array([]),
+            'block_block_r_matrix': np.array([]).reshape(0, 0),
+            'R_extended': _extended(np.zeros((0, 0)), np.zeros((0, 0))),
+            'block_positions_in_extended': []
+        }
+
+    # Step 0: block 几何结构只依赖 LD、SNP 列表和阈值，命中缓存时跳过 Step 1-3
+    r_min, pve_min, min_size = 0.8, 0.7, 2
+    geometry, cache_key = None, None
+    if block_cache_dir is not None:
+        cache_key = block_geometry_key(R, snp_ids, r_min, pve_min, min_size, clique_backend=clique_backend,
+                                       clique_options=sorted((clique_options or {}).items()))
+        geometry = load_block_geometry(block_cache_dir, cache_key)
+
+    if geometry is not None:
+        pruned_blocks = geometry['pruned']
+    else:
+        # Step 1: 构建 raw blocks
+        candidate_blocks = find_maximal_clique_blocks(R, snp_ids, r_min=r_min, R_sparse=R_sparse,
+                                                      backend=clique_backend, **(clique_options or {}))
+
+        # Step 2: 去重函数（严格无重叠）
+        valid_candidates = resolve_block_overlap(candidate_blocks, R)
+
+        # Step 3: 修剪（基于 PVE ≥ 0.7）
+        pruned_blocks = []
+        for blk in valid_candidates:
+            pruned = evaluate_and_prune_block(
+                block=blk,
+                R=R,
+                pve_min=pve_min,
+                min_size=min_size
+            )
+            if pruned is not None:
+                pruned_blocks.append(pruned)
+
+        if cache_key is not None:
+            try:
+                save_block_geometry(block_cache_dir, cache_key, {
+                    'candidates': [blk['snps'] for blk in valid_candidates],
+                    'pruned': pruned_blocks,
+                })
+            except OSError as e:
+                print(f"⚠️ block 缓存写入失败（不影响结果）: {e}")
+
+    if not pruned_blocks:
+        return {
+            'blocks': [],
+            'remaining_snp_idx': np.arange(p),
+            'block_block_r_matrix': np.array([]).reshape(0, 0),
+            'R_extended': _extended(np.zeros((0, p)), np.zeros((0, 0))),
+            'block_positions_in_extended': []
+        }
+
+    # Step 4: 增强信息（添加 z_block 等；r_to_others 在 Step 6 统一计算）
+    enriched_blocks = [
+        enrich_block_with_pca1_info(blk, R, z_gwas, z_qtl, R_sparse=R_sparse, compute_r_to_others=False)
+        for blk in pruned_blocks
+    ]
+
+    # Step 5: 计算未被 block 覆盖的 SNP
+    used_snps = set()
+    for blk in enriched_blocks:
+        used_snps.update(blk['snps']) ## 为block内部的snp index内容
+        
+    remaining_snp_idx = np.array(sorted(set(range(p)) - used_snps)) ## 生成所有未被使用的SNP_index
+
+    # === Step 6: 载荷矩阵 W (B, p)：r_to_others = W R，block-block 相关性矩阵 = W R Wᵀ ===
+    n_blocks = len(enriched_blocks)
+    W = block_loading_matrix(enriched_blocks, p)
+    r_to_others_all, block_block_r_matrix = block_ld_products(W, R, R_sparse=R_sparse)
+    for b_idx, blk in enumerate(enriched_blocks):
+        blk['r_to_others'] = r_to_others_all[b_idx]
+
+    # === Step 7: R_extended: (p + B) x (p + B) 只作为惰性视图，clean 空间由 build_clean_ld 直接拼出 ===
+    R_extended = _extended(r_to_others_all, block_block_r_matrix)
+    block_positions = [p + b_idx for b_idx in range(n_blocks)]  # block b_idx 放在第 p + b_idx 列
+
+    # === 返回结果 ===
+    return {
+        'blocks': enriched_blocks,
+        'remaining_snp_idx': remaining_snp_idx,
+        'block_block_r_matrix': block_block_r_matrix,
+        'R_extended': R_extended,
+        'block_positions_in_extended': block_positions,  # 可溯源：第 i 个 block 在 R_extended 中的位置
+    }
+
+
+########## 背景方差、conditional Z、谱截断
+def estimate_sigma_ire(z_cond, tol=1e-2, max_iter=10, return_diagnostics=False):
+    """
+    使用迭代加权中位数法估计残差 Z 的背景方差 σ²
+    假设大多数 SNP 属于噪声（z_i ~ N(0, σ²)），而少数为真信号
+    计算在 cojo_engine.estimate_sigma2_batch（z² 只排序一次；多条 Z 向量可一次估计）
+    Args:
+        z_cond: (p,) conditional Z 向量
+        tol: 收敛阈值
+        max_iter: 最大迭代次数
+        return_diagnostics: 是否返回诊断信息        
+    Returns:
+        sigma2: 估计的背景方差，限制在合理范围内 [0.8, 5.0]
+        (sigma2, diagnostics) 当 return_diagnostics=True，diagnostics 含初始值与迭代次数
+    """
+    z = np.asarray(z_cond).flatten()
+    if len(z) == 0:
+        return (1.0, {}) if return_diagnostics else 1.0
+    sigma2, n_iter = estimate_sigma2_batch(z[None, :], tol=tol, max_iter=max_iter, return_n_iter=True)
+    sigma2 = sigma2[0]
+    if return_diagnostics:
+        return sigma2, {'sigma2_initial': float(np.median(z**2) / CHI2_1_MEDIAN), 'n_iter': int(n_iter[0])}
+    return sigma2
+
+
+
+@limit_warnings()
+def compute_conditional_z(
+    z: np.ndarray,
+    R: np.ndarray,
+    selected_indices: list,
+    U_trunc: np.ndarray,      # 全局谱截断特征向量
+    Lambda_trunc: np.ndarray, # 全局谱截断特征值
+    projector_cache=None      # 可选，cojo_engine.ProjectorCache；给定时 z_cond = z - M_S z_S 直接用缓存的投影算子
+):
+    """
+    使用全局谱截断稳定计算 conditional Z (COJO 思想)
+    """
+    if len(selected_indices) == 0:
+        return z.copy()
+    if projector_cache is not None:
+        return projector_cache.conditional_z(z, selected_indices)
+        
+    S = selected_indices
+    R_full_sub = R[:, S]      # (p, |S|) 从所有 SNP 到已选 SNP 的 LD
+    z_selected = z[S]         # (|S|,) 已选 SNP 的 Z 分数
+    R_sub = R[np.ix_(S, S)]   # (|S|, |S|) 已选 SNP 之间的 LD
+
+    try:
+        U_global_S = U_trunc[S, :]  # (|S|, k) 已选 SNP 在主成分空间中的表示
+        R_sub_inv = (U_global_S / Lambda_trunc) @ U_global_S.T   ## 即 P[S, S]
+        beta = R_sub_inv @ z_selected
+        
+    except Exception as e:
+        print(f"compute_conditional_z 谱截断求逆失败: {e}")
+        try:
+            beta = np.linalg.solve(R_sub, z_selected)
+        except:
+            beta = np.linalg.pinv(R_sub) @ z_selected
+
+    # COJO 核心：z_cond = z - R[:,S] @ β
+    proj_mean = R_full_sub @ beta
+    z_cond = z - proj_mean
+    return z_cond
+
+
+
+def apply_spectral_truncation(R: np.ndarray, threshold: float = None, verbose: int = SUMMARY, solver: str = 'auto'):
+    """
+    对 LD 矩阵进行谱截断，返回显著特征值对应的特征向量和特征值
+    返回的是 SpectralContext（U、Λ、G = UΛ^{-1/2}、P 等），每个 clean 空间只建一次，传给所有使用者；
+    仍可按旧写法解包：U_trunc, Lambda_trunc = apply_spectral_truncation(R)
+    verbose: diagnostics 的输出级别，CALL 及以上才输出特征值诊断
+    solver: 'dense' / 'subset' / 'lanczos' / 'randomized' / 'auto'（按 p 选择），见 cojo_engine.spectral_truncation；
+            非 dense 方法的精度可用 spectral_accuracy(R, spectral) 与全谱结果对照
+    """
+    spectral = spectral_truncation(R, threshold, solver=solver)
+    if verbose >= CALL:
+        eig_min, eig_max = spectral.eigenvalue_range
+        print(f"   apply_spectral_truncation 诊断:")
+        print(f"     - 特征分解方式: {spectral.solver}")
+        print(f"     - 原始特征值范围: [{eig_min:.6f}, {eig_max:.6f}]")
+        print(f"     - 截断阈值: {spectral.threshold:.6f}")
+        print(f"     - 保留特征值数: {spectral.k}/{R.shape[0]}")
+        print(f"     - Lambda_trunc 范围: [{spectral.Lambda.min():.6f}, {spectral.Lambda.max():.6f}]")
+    return spectral
+
+
+########## 前向选择与 bootstrap
+@limit_warnings(max_count=30)
+def forward_selection(
+    z_raw: np.ndarray,
+    R: np.ndarray,
+    snp_ids: list,
+    U_trunc: np.ndarray,
+    sigma2: float,
+    Lambda_trunc: np.ndarray,
+    target_completion: float = 0.9,
+    projector_cache=None,
+    max_candidates: int = None,
+    spectral_context=None,
+    diagnostics=None,
+    replicate: int = 0):
+    """
+    基于 conditional Z 和 LD-adjusted 伪 R² 的前向选择算法
+    projector_cache: 可选，cojo_engine.ProjectorCache（同一 R/U_trunc/Lambda_trunc 下跨 bootstrap 共用）；
+                     为 None 时取 spectral_context.projectors，或在本次调用内新建一个
+    max_candidates: 每步按 |z_cond| 取前多少个候选；None 表示全部剩余 SNP
+                    （候选一次性批量打分，代价 O(k |S| |J|)，打全部候选也很便宜）
+    spectral_context: 可选，apply_spectral_truncation 返回的 SpectralContext；给定时 U_trunc/Lambda_trunc 可为 None
+    diagnostics: 可选，diagnostics.SelectionDiagnostics；每一步的完成度、最大 |z_cond|、候选数等写入其中，
+                 文字输出由其 verbose 级别控制（CALL：开始/结束信息，STEP：逐步信息）；
+                 None 时不记录、不输出
+    replicate: 写入 diagnostics 的重复编号
+    """
+    p = len(z_raw)
+    if spectral_context is not None:
+        U_trunc, Lambda_trunc = spectral_context
+        if projector_cache is None:
+            projector_cache = spectral_context.projectors
+    diag = diagnostics if diagnostics is not None else SelectionDiagnostics(verbose=SILENT, record_steps=False)
+    show_call = diag.enabled(CALL)
+    show_step = diag.enabled(STEP)
+    if show_call:
+        print(f"🔍 forward_selection 诊断:")
+        print(f"   - 输入维度: p = {p}")
+        print(f"   - U_trunc 形状: {U_trunc.shape}")
+        print(f"   - Lambda_trunc 形状: {Lambda_trunc.shape}")
+        print(f"   - Lambda_trunc 范围: [{Lambda_trunc.min():.6f}, {Lambda_trunc.max():.6f}]")
+    
+    if snp_ids is None:
+        snp_ids = [f"SNP_{i}" for i in range(p)]
+
+    # === 1. 背景方差校正 ===
+    z = z_raw / np.sqrt(sigma2)
+    if show_call:
+        print(f"   - 背景方差估计: {sigma2:.4f}")
+        print(f"   - 校正后 Z 范围: [{z.min():.4f}, {z.max():.4f}]")
+        print(f"   - 校正后 Z 均值: {z.mean():.6f}")
+    
+    # === 2. 全局能量算子：P = U Λ⁻¹ Uᵀ 不显式构造，能量 = ||Gᵀ z_cond||²（G = U Λ^{-1/2}） ===
+    if projector_cache is None:
+        projector_cache = ProjectorCache(R, U_trunc, Lambda_trunc)
+    y = projector_cache.energy_basis(z)
+    
+    # === 3. 总信号能量 ===
+    E_total = projector_cache.residual_energy(y, z, [])     # = ||y||²
+    if show_call:
+        print(f"   - 总信号能量 E_total: {E_total:.6f}")
+
+    # === 4. 初始化状态 ===
+    selected_indices = []
+    remaining_mask = np.ones(p, dtype=bool)
+    step = 0
+    completion = 0.0  # 初始化 completion
+    if show_call:
+        print(f"🚀 开始前向选择迭代...")
+    # === 5. 主循环 ===
+    while True:
+        step += 1
+        n_sel = len(selected_indices)
+        if step > p + 10:  # 防止无限循环
+            diag.count('step_limit')
+            diag.record_step(replicate, step, n_sel, completion, np.nan, stop=STOP_ERROR)
+            if show_call:
+                print(f"⚠️  迭代次数过多 ({step})，强制退出")
+            break
+        # --- 5.1 计算当前 conditional Z ---
+        try:
+            z_cond = compute_conditional_z(z, R, selected_indices, U_trunc, Lambda_trunc, projector_cache)
+            if show_step:
+                print(f"   - z_cond 计算成功，范围: [{z_cond.min():.4f}, {z_cond.max():.4f}]")
+        except Exception as e:
+            diag.count('conditional_z_failed')
+            diag.record_step(replicate, step, n_sel, completion, np.nan, stop=STOP_ERROR)
+            if show_call:
+                print(f"❌ z_cond 计算失败: {e}")
+            break
+        try:
+            E_residual = projector_cache.residual_energy(y, z, selected_indices)
+            E_explained = E_total - E_residual
+            completion = E_explained / E_total if E_total > 1e-8 else 1.0
+        except Exception as e:
+            diag.count('energy_failed')
+            diag.record_step(replicate, step, n_sel, completion, np.nan, stop=STOP_ERROR)
+            if show_call:
+                print(f"❌ 能量计算失败: {e}")
+            break
+
+        max_z_cond = float(np.max(np.abs(z_cond[remaining_mask]))) if n_sel < p else np.nan
+        if completion >= target_completion:
+            diag.record_step(replicate, step, n_sel, completion, max_z_cond, stop=STOP_TARGET)
+            if show_step:
+                print(f"✅ 达到目标完成度 {target_completion}，停止")
+            break
+        if n_sel == p:
+            diag.record_step(replicate, step, n_sel, completion, max_z_cond, stop=STOP_ALL_SELECTED)
+            if show_step:
+                print(f"⏹️  所有 SNP 已选择，停止")
+            break
+        if max_z_cond < 1.645:
+            diag.record_step(replicate, step, n_sel, completion, max_z_cond, stop=STOP_Z_BELOW)
+            if show_step:
+                print(f"⏹️  最大条件 |z| < 1.645，停止")
+            break
+
+        # --- 5.2 全部候选一次性打分（加入 j 后的剩余能量，见 ProjectorCache.candidate_energies） ---
+        if show_step:
+            print(f"   - 寻找候选 SNP...")
+        remaining_indices = np.where(remaining_mask)[0]
+        sorted_remaining = remaining_indices[np.argsort(np.abs(z_cond[remaining_indices]))[::-1]]
+        candidates = sorted_remaining[:max_candidates]
+        try:
+            E_residual_temp = projector_cache.candidate_energies(y, z, selected_indices, candidates)
+        except Exception as e:
+            diag.count('candidate_scoring_failed')
+            diag.record_step(replicate, step, n_sel, completion, max_z_cond, len(candidates), stop=STOP_ERROR)
+            if show_call:
+                print(f"❌ 候选打分失败: {e}")
+            break
+        if E_total > 1e-8:
+            completion_temp = (E_total - E_residual_temp) / E_total
+        else:
+            completion_temp = np.ones(len(candidates))
+        completion_temp = np.where(np.isfinite(completion_temp), completion_temp, -np.inf)
+
+        best_pos = int(np.argmax(completion_temp))       ## 同分时取 |z_cond| 更大的候选
+        valid_candidates = int(np.sum(completion_temp > completion))
+        if show_step:
+            print(f"   - 候选 SNP 检查: {len(candidates)} 个, 能提升 completion: {valid_candidates} 个")
+        if completion_temp[best_pos] <= completion:
+            diag.record_step(replicate, step, n_sel, completion, max_z_cond, len(candidates), valid_candidates,
+                             stop=STOP_NO_GAIN)
+            if show_step:
+                print("⚠️  没有找到能提升 completion 的 SNP")
+            break
+        best_idx = int(candidates[best_pos])
+        diag.record_step(replicate, step, n_sel, completion, max_z_cond, len(candidates), valid_candidates)
+
+        if show_step:
+            print(f"➡️  选择 SNP: {snp_ids[best_idx]} (index {best_idx})")
+        selected_indices.append(best_idx)
+        remaining_mask[best_idx] = False
+
+    if show_call:
+        print(f"\n🏁 前向选择完成:")
+        print(f"   - 总步数: {step}")
+        print(f"   - 最终选中 SNP 数: {len(selected_indices)}")
+        print(f"   - 最终 completion: {completion:.6f}")
+    
+    # === 6. 返回结果 ===
+    return {
+        'selected_indices': selected_indices,
+        'selected_snp_ids': [snp_ids[i] for i in selected_indices],
+        'n_selected': len(selected_indices),
+        'final_completion': float(completion)  # 新增输出项
+    }
+
+
+
+def bootstrap_selection_paths(
+    blocks: list,           # list of dict, 每个 block 包含 z_gwas_block, z_qtl_block, snps, 等等
+    Z: np.ndarray,          # p, 为原始 Z 向量
+    R_extended,             # (p + B, p + B)，已构建好的扩展 R（ndarray 或 ExtendedLD）；给定 R_clean 时可为 None
+    snp_list: list,         # (p,)，SNP ID 列表
+    analysis_type: str,     # "gwas" or "qtl"
+    remaining_snp_idx: np.ndarray,  # 自由池 SNP 索引
+    n_bootstraps: int = 100,
+    z_perturb_sd: float = 0.01,
+    R_clean: np.ndarray = None,     # 可选，预先拼好的 clean 空间 LD（build_clean_ld），GWAS/QTL 共用
+    engine: str = 'lockstep',       # 'lockstep'：所有重复同步推进、批量计算；'sequential'：逐次调用 forward_selection；
+                                    # 'parallel'：每个重复独立随机流（由 seed 派生），多进程计算，结果与 worker 数无关
+    seed=None,                      # 仅 'parallel'：根种子（int / SeedSequence），None 时随机生成并记录在结果中
+    n_workers: int = None,          # 仅 'parallel'：进程数，None 为 CPU 核数
+    adaptive: bool = False,         # True 时分批运行，所有变量的频率置信区间都离开阈值即停止，n_bootstraps 为上限
+    batch_size: int = 20,           # 仅 adaptive：每批重复数
+    min_bootstraps: int = 20,       # 仅 adaptive：至少运行的重复数
+    stability_thresholds: tuple = (0.8, 0.9),   # 仅 adaptive：需要判定的频率阈值（stable_snp_id / compute_stable_square_beta）
+    confidence_z: float = 1.96,     # 仅 adaptive：Wilson 置信区间的正态分位数
+    spectral_solver: str = 'auto',  # 谱截断的特征分解方式，'auto' 按 clean 空间大小选择（见 apply_spectral_truncation）
+    verbose: int = SUMMARY,         # 输出级别：SILENT / SUMMARY（汇总）/ CALL（每次前向选择）/ STEP（逐步）
+    diagnostics=None,               # 可选，SelectionDiagnostics；给定时逐步记录写入其中（其 verbose 优先）
+    store_replicates: bool = False, # True 时保存每个重复的扰动 Z（'Z_replicates'），供 compute_stable_square_beta 算置信区间
+    spectral_context=None           # 可选，R_clean 已有的谱截断（SpectralContext），给定时不再重新分解；
+                                    # 其投影缓存与选择路径 trie 也一并沿用（见 bootstrap_selection_paths_two_traits）
+):
+    '''
+    基于 bootstrap 的稳定 SNP/block 选择分析
+    
+    Returns:
+    --------
+    dict 包含以下字段：
+        - 'R_clean': 用于分析的 LD 矩阵
+        - 'Z_clean': 用于分析的 Z 分数向量
+        - 'Z_extend': 扩展的 Z 向量（包含 block 信息）
+        - 'sigma2': 背景方差估计
+        - 'all_selected_paths': 每次 bootstrap 的选择路径
+        - 'selection_counter': 选择计数器
+        - 'selection_frequency': 选择频率
+        - 'stable_snp_id': 频率 > 90% 的稳定 SNP/block ID
+        - 'snp_list_clean': 清理后的 SNP ID 列表
+        - 'clean_indices': 清理后的索引
+        - 'n_free_snps': 自由 SNP 数量
+        - 'n_blocks': block 数量
+        - 'avg_completion': 平均信号完成度  # 新增
+        - 'bootstrap_seed': 'parallel' 时的根种子熵（可复现），其他 engine 为 None
+        - 'bootstrap_spawn_key': 'parallel' 时根种子的 spawn_key（seed 为派生的 SeedSequence 时非空，
+          如 bootstrap_selection_paths_two_traits 的各性状随机流），其他 engine 为 None；
+          SeedSequence(bootstrap_seed, spawn_key=bootstrap_spawn_key) 即本次使用的根种子
+        - 'z_perturb_sd': Z 扰动的标准差（与 bootstrap_seed 一起可重新生成扰动）
+        - 'Z_replicates': store_replicates=True 时为 (n_bootstraps_used, N_clean) 的扰动 Z，否则 None
+        - 'n_bootstraps_used': 实际运行的重复数（adaptive 提前停止时小于 n_bootstraps），selection_frequency 以此为分母
+        - 'early_stopped': adaptive 是否提前停止
+        - 'diagnostics': 诊断汇总（SelectionDiagnostics.summary()：步数、停止原因、事件计数）
+    '''
+    
+    # === Step 1: 基本验证 ===
+    p = len(Z)
+    B = len(blocks)
+    assert len(snp_list) == p
+    assert R_clean is not None or R_extended.shape == (p + B, p + B)
+    # === Step 2: 构建扩展 Z 向量 ===
+    Z_extended = np.zeros(p + B)
+    Z_extended[:p] = Z
+    SNPlist_extended = list(snp_list)
+
+    # 添加 block 信息
+    for i, block in enumerate(blocks):
+        pos = p + i
+        if analysis_type.lower() == 'gwas':
+            z_block = block['z_gwas_block']
+        elif analysis_type.lower() == 'qtl':
+            z_block = block['z_qtl_block']
+        else:
+            raise ValueError(f"Unknown analysis_type: {analysis_type}")
+        Z_extended[pos] = z_block
+        lead_snp = block['snp_ids'][0]
+        block_id = f"block|{lead_snp}"
+        SNPlist_extended.append(block_id)
+    # === Step 3: 构建 clean 空间 ===
+    M = len(remaining_snp_idx)  # 自由 SNP 数量
+    N_clean = M + B
+    clean_indices = []
+    clean_indices.extend(remaining_snp_idx.tolist())
+    block_extended_positions = [p + i for i in range(B)]
+    clean_indices.extend(block_extended_positions)
+    assert len(clean_indices) == N_clean
+
+    # 提取 clean R 和 Z
+    if R_clean is None:
+        R_clean = R_extended[np.ix_(clean_indices, clean_indices)]
+    assert R_clean.shape == (N_clean, N_clean)
+    Z_clean = Z_extended[clean_indices]
+    snp_list_clean = [snp_list[idx] for idx in remaining_snp_idx] + [f"block|{block['snp_ids'][0]}" for block in blocks]
+
+    # === Step 4: 预处理步骤 ===
+    diag = diagnostics if diagnostics is not None else SelectionDiagnostics(verbose=verbose)
+    show = diag.enabled(SUMMARY)
+    estimate_sigma = estimate_sigma_ire(Z_clean)             # 在 clean 空间中直接估计
+    if spectral_context is None:
+        spectral = apply_spectral_truncation(R_clean, verbose=diag.verbose, solver=spectral_solver)   # 谱截断上下文，本 clean 空间只建一次
+    else:
+        spectral = spectral_context
+        assert spectral.R.shape == (N_clean, N_clean), "spectral_context 与 clean 空间维度不一致"
+    U_trunc, Lambda_trunc = spectral
+    # 投影算子缓存：M_S 与 z 无关，各次 bootstrap 共用
+    projector_cache = spectral.projectors
+    
+    # === Step 5: Bootstrap 分析 ===
+    if show:
+        print(f"🚀 开始 Bootstrap 分析:")
+        print(f"   - Clean 空间大小: {len(clean_indices)} (自由SNP: {M}, Blocks: {B})")
+        print(f"   - 谱截断: 保留 {spectral.k}/{N_clean} 个特征值 (阈值 {spectral.threshold:.4f}, {spectral.solver})")
+        print(f"   - 背景方差估计: {estimate_sigma:.4f}")
+        print(f"   - Bootstrap 次数: {n_bootstraps}" + ("（上限，自适应）" if adaptive else ""))
+    all_selected = []
+    selection_counter = Counter()
+    successful_bootstraps = 0
+    completion_rates = []  # 新增：记录每次的完成度
+    replicate_rows = []    # store_replicates：各批的扰动 Z
+
+    def _record(path_ids, comp):
+        nonlocal successful_bootstraps
+        if path_ids:
+            successful_bootstraps += 1
+        all_selected.append(path_ids)
+        selection_counter.update(path_ids)
+        completion_rates.append(float(comp))
+
+    # 每个 engine 提供一个“计算重复 [start, stop)”的函数；固定次数时只有一批
+    bootstrap_seed = bootstrap_spawn_key = None
+    runner = None
+    if engine == 'parallel':
+        # 第 i 个重复的扰动只由 (seed, i) 决定；clean 空间每个 worker 只传一次
+        runner = BootstrapRunner(spectral, Z_clean, estimate_sigma, z_perturb_sd, seed=seed,
+                                 n_workers=n_workers, target_completion=0.9)
+        bootstrap_seed = runner.entropy
+        bootstrap_spawn_key = runner.spawn_key
+
+        def _run_batch(start, stop):
+            if store_replicates:
+                replicate_rows.append(perturb_replicates(Z_clean, z_perturb_sd, runner.seed, start, stop))
+            paths, final_completion = runner.run(start, stop, diagnostics=diag)
+            for path, comp in zip(paths, final_completion):
+                _record([snp_list_clean[i] for i in path], comp)
+    elif engine == 'lockstep':
+        def _run_batch(start, stop):
+            # 一次抽出本批全部扰动（与逐次抽取得到的随机数序列相同），所有重复同步推进
+            Z_perturbed = Z_clean + np.random.normal(0, z_perturb_sd, size=(stop - start, len(Z_clean)))
+            if store_replicates:
+                replicate_rows.append(Z_perturbed)
+            paths, final_completion = lockstep_forward_selection(
+                Z_perturbed, spectral, estimate_sigma, target_completion=0.9,
+                diagnostics=diag, replicate_offset=start
+            )
+            for path, comp in zip(paths, final_completion):
+                _record([snp_list_clean[i] for i in path], comp)
+    elif engine == 'sequential':
+        def _run_batch(start, stop):
+            for boot_idx in range(start, stop):
+                if boot_idx % 50 == 0 and diag.enabled(CALL):
+                    print(f"   - Bootstrap 进度: {boot_idx}/{n_bootstraps}")
+                # Z 分数扰动，传入的是纯净的Z-clean
+                Z_clean_perturbed = Z_clean + np.random.normal(0, z_perturb_sd, size=Z_clean.shape)
+                if store_replicates:
+                    replicate_rows.append(Z_clean_perturbed[None, :])
+                try:
+                    result = forward_selection(
+                        z_raw=Z_clean_perturbed,
+                        R=R_clean,
+                        snp_ids=snp_list_clean,
+                        U_trunc=U_trunc,
+                        sigma2= estimate_sigma , 
+                        Lambda_trunc=Lambda_trunc,
+                        target_completion=0.9,
+                        projector_cache=projector_cache,
+                        spectral_context=spectral,
+                        diagnostics=diag,
+                        replicate=boot_idx
+                    )
+                    _record(result['selected_snp_ids'], result['final_completion'])  # 新增：记录完成度
+
+                except Exception as e:
+                    diag.count('bootstrap_failed')
+                    if show:
+                        print(f"Bootstrap {boot_idx} failed: {e}")
+                    completion_rates.append(0.0)  # 失败的情况记录为0
+                    continue
+    else:
+        raise ValueError(f"Unknown engine: {engine}")
+
+    # 自适应：每批之后检查所有变量的频率置信区间是否都已离开 0.8 / 0.9，满足即停止，最多 n_bootstraps 次
+    n_done = 0
+    early_stopped = False
+    try:
+        while n_done < n_bootstraps:
+            if adaptive:
+                step = batch_size if n_done >= min_bootstraps else max(batch_size, min_bootstraps)
+            else:
+                step = n_bootstraps
+            stop = min(n_done + step, n_bootstraps)
+            _run_batch(n_done, stop)
+            n_done = stop
+            if adaptive and n_done < n_bootstraps:
+                counts = np.array([selection_counter[snp_id] for snp_id in snp_list_clean])
+                if frequencies_resolved(counts, n_done, stability_thresholds, confidence_z).all():
+                    early_stopped = True
+                    break
+    finally:
+        if runner is not None:
+            runner.close()
+
+    # 计算平均完成度
+    avg_completion = np.mean(completion_rates) if completion_rates else 0.0
+    if show:
+        if adaptive:
+            print(f"   - 自适应 Bootstrap: 使用 {n_done}/{n_bootstraps} 次" + ("（提前停止）" if early_stopped else ""))
+        print(f"   - 成功的 Bootstrap 次数: {successful_bootstraps}/{n_done}")
+        cache_stats = projector_cache.stats()
+        print(f"   - 投影缓存: {cache_stats['entries']} 个集合, {cache_stats['nbytes'] / 1024 ** 2:.1f} MB, "
+              f"命中率 {cache_stats['hit_rate']:.1%}")
+        if engine == 'lockstep':
+            trie_stats = spectral.selection_trie.stats()
+            print(f"   - 选择路径 trie: {trie_stats['nodes']} 个节点, {trie_stats['nbytes'] / 1024 ** 2:.1f} MB, "
+                  f"margin 直接确定 {trie_stats['shortcut_rate']:.1%}")
+        print(diag.format_summary())
+        print(f"   - 平均信号完成度: {avg_completion:.4f}")
+    
+    selection_freq = {
+        snp_id: count / n_done
+        for snp_id, count in selection_counter.items()
+    }
+
+    for snp_id in snp_list_clean:
+        if snp_id not in selection_freq:
+            selection_freq[snp_id] = 0.0
+
+    stable_snp_id = [snp_id for snp_id, freq in selection_freq.items() if freq > 0.8]
+    return {
+        'R_clean': R_clean,
+        'Z_clean': Z_clean,
+        'Z_extend': Z_extended,
+        'sigma2': estimate_sigma,
+        'U_trunc': U_trunc,              
+        'Lambda_trunc': Lambda_trunc,       
+        'all_selected_paths': all_selected,
+        'selection_counter': selection_counter,
+        'selection_frequency': selection_freq,
+        'stable_snp_id': stable_snp_id,
+        'snp_list_clean': snp_list_clean,
+        'clean_indices': clean_indices,
+        'n_free_snps': M,
+        'n_blocks': B,
+        'avg_completion': float(avg_completion),  # 新增返回值
+        'bootstrap_seed': bootstrap_seed,
+        'bootstrap_spawn_key': bootstrap_spawn_key,
+        'z_perturb_sd': z_perturb_sd,
+        'Z_replicates': np.vstack(replicate_rows) if replicate_rows else None,
+        'n_bootstraps_used': n_done,
+        'early_stopped': early_stopped,
+        'diagnostics': diag.summary()
+    }
+
+
+def bootstrap_selection_paths_two_traits(
+    blocks: list,
+    z_gwas: np.ndarray,
+    z_qtl: np.ndarray,
+    R_extended,                     # ExtendedLD 或 ndarray；给定 R_clean 时可为 None
+    snp_list: list,
+    remaining_snp_idx: np.ndarray,
+    n_bootstraps: int = 100,
+    z_perturb_sd: float = 0.01,
+    R_clean: np.ndarray = None,
+    spectral_solver: str = 'auto',
+    verbose: int = SUMMARY,
+    spectral_context=None,          # 可选，R_clean 已有的谱截断（SpectralContext），给定时不再重新分解
+    **options                       # 其余参数原样传给 bootstrap_selection_paths（engine、adaptive 等）
+):
+    '''
+    GWAS 与 QTL 两个性状共用同一个 clean 空间：两者只有 Z_extended 中 block 的 Z 不同，
+    clean 空间 LD 只拼一次、谱截断只做一次，两个性状的 bootstrap 都在同一个 SpectralContext 上运行，
+    第二个性状直接沿用第一个性状留下的投影算子缓存（M_S 与 z 无关）和选择路径 trie（与 sigma2 无关）
+    随机数：'lockstep' / 'sequential' 的全局随机数消耗顺序与分别调用两次 bootstrap_selection_paths 相同（先 GWAS 后 QTL），
+    结果一致；'parallel' 时两个性状不共用同一个 seed（否则第 i 个重复的扰动完全相同），
+    而是各用根种子的子流 child_seed_sequence(seed, 0) / (seed, 1)，记录在各自的 'bootstrap_seed' / 'bootstrap_spawn_key' 中
+    谱截断上下文不放进返回的结果（结果会被 pickle）：需要复用时由调用方建好后通过 spectral_context 传入，
+    再同样传给 compute_stable_square_beta
+    Returns:
+        (result_gwas, result_qtl)，各自与 bootstrap_selection_paths 的返回值相同
+    '''
+    p = len(z_gwas)
+    if R_clean is None:
+        if hasattr(R_extended, 'clean'):
+            R_clean = R_extended.clean(remaining_snp_idx)
+        else:
+            clean_indices = list(remaining_snp_idx) + [p + i for i in range(len(blocks))]
+            R_clean = R_extended[np.ix_(clean_indices, clean_indices)]
+    if spectral_context is None:
+        spectral = apply_spectral_truncation(R_clean, verbose=verbose, solver=spectral_solver)
+    else:
+        spectral = spectral_context
+        assert spectral.R.shape == R_clean.shape, "spectral_context 与 clean 空间维度不一致"
+
+    trait_seeds = [None, None]
+    if options.get('engine') == 'parallel':
+        root = options.pop('seed', None)
+        root = root if isinstance(root, np.random.SeedSequence) else np.random.SeedSequence(root)
+        trait_seeds = [child_seed_sequence(root, trait_idx) for trait_idx in range(2)]
+
+    results = []
+    for (analysis_type, z), trait_seed in zip((('gwas', z_gwas), ('qtl', z_qtl)), trait_seeds):
+        if trait_seed is not None:
+            options['seed'] = trait_seed
+        results.append(bootstrap_selection_paths(
+            blocks, z, None, snp_list, analysis_type, remaining_snp_idx, n_bootstraps, z_perturb_sd,
+            R_clean=R_clean, verbose=verbose, spectral_context=spectral, **options
+        ))
+    return tuple(results)
+
+
+########## 稳定变量的多变量效应
+@limit_warnings()
+def compute_stable_square_beta(
+    result: dict,
+    frequency_threshold: float = 0.9,
+    min_beta_weight: float = 1e-8,
+    ci_level: float = None,
+    spectral_context=None,
+    verbose: int = SUMMARY
+):
+    """
+    基于 bootstrap 结果，对高频入选变量进行多变量效应估计
+    在统一的谱截断空间中进行回归，保证与信号完成度计算一致性
+    
+    Parameters
+    ----------
+    result : dict
+        bootstrap_selection_paths 的返回结果，必须包含：
+        - 'selection_frequency'
+        - 'snp_list_clean' 
+        - 'R_clean'
+        - 'Z_clean'
+        - 'U_trunc', 'Lambda_trunc' (全局谱截断结果)
+    frequency_threshold : float, default=0.9
+        入选频率阈值
+    min_beta_weight : float
+        防止 beta² 和为 0 的下界
+    ci_level : float, optional
+        给定（如 0.95）时，对 beta_multivar / beta_square 计算 bootstrap 百分位置信区间：
+        稳定集合固定，所有扰动 Z 重复一次矩阵乘法得到 (n_rep, k) 的 beta。
+        重复来自 result['Z_replicates']（bootstrap_selection_paths(store_replicates=True)），
+        没有时若有 'bootstrap_seed'（engine='parallel'）则按种子（及 'bootstrap_spawn_key'）重新生成
+    spectral_context : SpectralContext, optional
+        bootstrap 阶段用过的谱截断上下文（与 result['R_clean'] 对应），给定时直接复用；
+        否则由 'U_trunc' / 'Lambda_trunc' 重建
+    verbose : int, default=SUMMARY
+        输出级别：CALL 及以上才输出输入诊断，SUMMARY 及以上输出“没有稳定变量”的提示
+
+    Returns
+    -------
+    dict
+        增强的结果字典：新 dict，与输入共享全部数组（不修改输入，调用方不必先 copy）
+    """
+    # === Step 1: 提取必要字段 ===
+    selection_frequency = result['selection_frequency']
+    snp_list_clean = result['snp_list_clean']
+    R_clean = result['R_clean']
+    Z_clean_base = result['Z_clean']
+    U_trunc_global = result['U_trunc']            # 全局谱截断特征向量
+    Lambda_trunc_global = result['Lambda_trunc']  # 全局谱截断特征值
+    spectral = spectral_context
+    if spectral is None:
+        spectral = SpectralContext(R_clean, U_trunc_global, Lambda_trunc_global)
+    
+    if verbose >= CALL:
+        print(f"📈 compute_stable_square_beta 输入诊断:")
+        print(f"   - selection_frequency 中的 SNP 数: {len(selection_frequency)}")
+        print(f"   - snp_list_clean 长度: {len(snp_list_clean)}")
+        print(f"   - R_clean 形状: {R_clean.shape}")
+        print(f"   - 全局主成分数量: {len(Lambda_trunc_global)}")
+
+    # === Step 2: 找出频率 > threshold 的稳定变量 ===
+    stable_snp_ids = [
+        snp_id for snp_id, freq in selection_frequency.items() 
+        if freq >= frequency_threshold
+    ]
+
+    if len(stable_snp_ids) == 0:
+        if verbose >= SUMMARY:
+            print(f"⚠️ No variable selected with frequency ≥ {frequency_threshold}. Skipping pseudobeta.")
+        return {
+            **result,
+            'stable_snps': [],
+            'stable_snp_indices': [],
+            'beta_square': {},
+            'beta_multivar': {},
+            'beta_sorted': [],
+            'R_sub_condition_number': 0.0,
+        }
+    
+    # === Step 3: 映射 snp_id → index in clean space ===
+    snp_to_idx = {snp: idx for idx, snp in enumerate(snp_list_clean)}
+    stable_indices = [snp_to_idx[snp_id] for snp_id in stable_snp_ids]
+    # === Step 4: 提取子矩阵 ===
+    R_sub = R_clean[np.ix_(stable_indices, stable_indices)]
+    z_sub = Z_clean_base[stable_indices]
+    k = len(stable_indices)
+    # === 在统一的谱截断空间中求解 ===
+    # 投影后的广义逆：R⁻¹ ≈ U_sub @ diag(1/Λ) @ U_sub.T，即 P[S, S]，由谱截断上下文直接给出
+    R_sub_inv = spectral.P_sub(stable_indices)
+    # 求解 beta = R⁻¹ z
+    beta = R_sub_inv @ z_sub
+    # 条件数估计（用于诊断）：R_sub 对称，|λ|max / |λ|min 即 2-范数条件数，k×k 的 eigvalsh 代替 SVD
+    if k > 1:
+        eig_abs = np.abs(np.linalg.eigvalsh(R_sub))
+        cond_num = eig_abs.max() / eig_abs.min() if eig_abs.min() > 0 else np.inf
+    else:
+        cond_num = 1.0
+    
+    # === Step 6: 计算 beta 平方权重 ===
+    beta = np.asarray(beta).flatten()
+    weights = beta ** 2
+    total_weight = weights.sum()
+    # 数值稳定性处理
+    if total_weight < min_beta_weight or total_weight == 0:
+        beta_squared_weight = np.ones_like(weights) / len(weights) if len(weights) > 0 else np.array([])
+        compute_stable_square_beta.warn(
+            f"Sum of beta^2 too small ({total_weight:.2e}). Using uniform weights."
+        )
+    else:
+        beta_squared_weight = weights / total_weight
+
+    # === Step 7: 绑定回 snp_id ===
+    beta_squared_dict = {
+        snp_id: float(beta2weight) 
+        for snp_id, beta2weight in zip(stable_snp_ids, beta_squared_weight)
+    }
+    beta_dict = {
+        snp_id: float(b) 
+        for snp_id, b in zip(stable_snp_ids, beta)
+    }
+    beta_sorted = sorted(beta_squared_dict.items(), key=lambda x: x[1], reverse=True)
+
+    # === Step 8: 新结果字典（共享输入的数组）===
+    out = {
+        **result,
+        'stable_snps': stable_snp_ids,
+        'stable_snp_indices': stable_indices,
+        'beta_square': beta_squared_dict,
+        'beta_multivar': beta_dict,
+        'beta_sorted': beta_sorted,
+        'R_sub_condition_number': float(cond_num),
+    }
+
+    # === Step 9（可选）: bootstrap 置信区间，所有重复一次向量化计算 ===
+    if ci_level is not None:
+        Z_reps = result.get('Z_replicates')
+        if Z_reps is None and result.get('bootstrap_seed') is not None:
+            seed = np.random.SeedSequence(result['bootstrap_seed'],
+                                          spawn_key=tuple(result.get('bootstrap_spawn_key') or ()))
+            Z_reps = perturb_replicates(Z_clean_base, result['z_perturb_sd'], seed,
+                                        0, result['n_bootstraps_used'])
+        if Z_reps is None:
+            compute_stable_square_beta.warn(
+                "No stored Z replicates or bootstrap seed in result. Skipping bootstrap CI."
+            )
+        else:
+            beta_reps = Z_reps[:, stable_indices] @ R_sub_inv           # (n_rep, k)，P[S, S] 对称
+            w_reps = beta_reps ** 2
+            total_reps = w_reps.sum(axis=1, keepdims=True)
+            small = (total_reps < min_beta_weight) | (total_reps == 0)
+            beta2_reps = np.where(small, 1.0 / k, w_reps / np.where(small, 1.0, total_reps))
+            alpha = (1 - ci_level) / 2
+            beta_lo, beta_hi = np.quantile(beta_reps, [alpha, 1 - alpha], axis=0)
+            beta2_lo, beta2_hi = np.quantile(beta2_reps, [alpha, 1 - alpha], axis=0)
+            out.update({
+                'beta_multivar_ci': {snp_id: (float(lo), float(hi))
+                                     for snp_id, lo, hi in zip(stable_snp_ids, beta_lo, beta_hi)},
+                'beta_square_ci': {snp_id: (float(lo), float(hi))
+                                   for snp_id, lo, hi in zip(stable_snp_ids, beta2_lo, beta2_hi)},
+                'ci_level': ci_level,
+                'n_ci_replicates': int(len(Z_reps)),
+            })
+
+    return out
+
+
+########## 单个信号的完整流程
+def run_fine_mapping_for_signal(
+        gene_df, ld_df, beta_col_gwas, se_col_gwas,
+        beta_col_qtl, se_col_qtl, sparse_ld_floor=None, block_cache_dir=None, bootstrap_options=None,
+        verbose=SUMMARY):
+    """
+    对某一信号运行完整流程，返回 GWAS 和 QTL 的分析结果,以及block构造信息
+    sparse_ld_floor: None 时全部走稠密 LD；给定时（如 0.0 或 0.05）构建一次 CSR 稀疏 LD，
+                     block 发现和 r_to_others 都从稀疏 LD 计算（|r| ≤ floor 的弱 LD 视为 0）
+    block_cache_dir: 可选，block 几何缓存目录；同一 locus 重跑或多个结局 GWAS 共用 locus 时复用 block
+    bootstrap_options: 传给 bootstrap_selection_paths 的其他参数，如 {'engine': 'parallel', 'seed': 1, 'n_workers': 4}、
+                       {'adaptive': True}（100 次为上限，选择频率确定后提前停止）
+    verbose: 输出级别（SILENT / SUMMARY / CALL / STEP），CALL 及以上才输出本函数与 compute_stable_square_beta 的诊断；
+             也是 bootstrap 的输出级别（bootstrap_options 中另给 'verbose' 时以其为准）
+    Returns:
+    --------
+    tuple: (result_raw_gwas, result_stable_gwas, 
+            result_raw_qtl, result_stable_qtl)
+    """
+    # === 数据准备 ===
+    snps_list = ld_df.index.intersection(ld_df.columns).intersection(gene_df.index)
+    snps_list = snps_list.astype(str)
+    
+    ld_matrix_raw = ld_df.loc[snps_list, snps_list].values
+    
+    # Z 分数计算
+    beta_gwas = gene_df.loc[snps_list, beta_col_gwas].values
+    se_gwas = gene_df.loc[snps_list, se_col_gwas].values
+    z_gwas = beta_gwas / se_gwas 
+
+    beta_qtl = gene_df.loc[snps_list, beta_col_qtl].values
+    se_qtl = gene_df.loc[snps_list, se_col_qtl].values
+    z_qtl = beta_qtl / se_qtl 
+
+    # 构建 blocks
+    ld_sparse = build_sparse_ld(ld_matrix_raw, sparse_ld_floor) if sparse_ld_floor is not None else None
+    blocks_result = build_enriched_blocks_pipeline(ld_matrix_raw, z_gwas, z_qtl, snps_list, R_sparse=ld_sparse,
+                                                   block_cache_dir=block_cache_dir)
+    blocks = blocks_result['blocks']
+    remaining_snp = blocks_result['remaining_snp_idx']
+    # clean 空间 LD 只拼一次、谱截断只做一次，GWAS / QTL 的 bootstrap 与稳定 beta 共用
+    r_clean = blocks_result['R_extended'].clean(remaining_snp)
+    bootstrap_options = dict(bootstrap_options or {})
+    bootstrap_options.setdefault('verbose', verbose)
+    spectral = apply_spectral_truncation(r_clean, verbose=bootstrap_options['verbose'],
+                                         solver=bootstrap_options.pop('spectral_solver', 'auto'))
+    show = verbose >= CALL
+
+    if show:
+        print(f"📊 GWAS 分析诊断:")
+        print(f"   - 总 SNP 数: {len(snps_list)}")
+        print(f"   - Block 数: {len(blocks)}")
+        print(f"   - 剩余自由 SNP: {len(remaining_snp)}")
+    
+    # === GWAS / QTL 分析：共用 clean 空间与谱截断 ===
+    result_raw_gwas, result_raw_qtl = bootstrap_selection_paths_two_traits(
+        blocks, z_gwas, z_qtl, None, snps_list, remaining_snp, 100, 0.01, R_clean=r_clean,
+        spectral_context=spectral, **bootstrap_options
+    )
+    
+    # GWAS 诊断
+    if show:
+        print(f"   - Bootstrap 选择路径数: {len(result_raw_gwas.get('all_selected_paths', []))}")
+        print(f"   - 稳定 SNP 数: {len(result_raw_gwas.get('stable_snp_id', []))}")
+        if result_raw_gwas.get('stable_snp_id'):
+            print(f"   - 稳定 SNP ID: {result_raw_gwas['stable_snp_id'][:5]}...")
+    
+    # GWAS 稳定 SNP 分析
+    result_stable_gwas = compute_stable_square_beta(result_raw_gwas, frequency_threshold=0.9,
+                                                    spectral_context=spectral, verbose=verbose)
+    
+    # === QTL 分析 ===
+    if show:
+        print(f"📊 QTL 分析诊断:")
+        print(f"   - 剩余自由 SNP: {len(remaining_snp)}")
+        # QTL 诊断
+        print(f"   - Bootstrap 选择路径数: {len(result_raw_qtl.get('all_selected_paths', []))}")
+        print(f"   - 稳定 SNP 数: {len(result_raw_qtl.get('stable_snp_id', []))}")
+        if result_raw_qtl.get('stable_snp_id'):
+            print(f"   - 稳定 SNP ID: {result_raw_qtl['stable_snp_id'][:5]}...")
+    
+    # QTL 稳定 SNP 分析
+    result_stable_qtl = compute_stable_square_beta(result_raw_qtl, frequency_threshold=0.9,
+                                                   spectral_context=spectral, verbose=verbose)
+    
+    return (result_raw_gwas, result_stable_gwas,
+            result_raw_qtl, result_stable_qtl, blocks_result)
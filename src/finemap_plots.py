@@ -0,0 +1,131 @@
+'''
+精细定位结果的绘图（只有这里导入 matplotlib）
+plot_causal_discovery：稳定 SNP / block 的 beta² 权重柱状图
+save_causal_discovery：画图、保存、关闭，供 plot_stage 按 locus 出图
+'''
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.patches import Patch
+
+
+def plot_causal_discovery(
+    result: dict, 
+    title: str = "Causal Discovery by SNP Importance", 
+    figsize: tuple = (12, 6),
+    show_legend: bool = True,
+    bar_alpha: float = 0.8,
+    bar_colors: dict = None
+):
+    """
+    可视化稳定SNP的因果信号解释能力（仅显示beta平方权重）
+    可视化内容：
+    - 横轴：stable SNP 按 beta_square 降序排列
+    - 纵轴：beta_square（多变量效应平方权重）
+    - 颜色：block 用红色，普通 SNP 用天蓝色    
+    
+    Parameters
+    ----------
+    result : dict
+        compute_stable_square_beta 的输出，必须包含：
+        - 'beta_square': dict, snp_id -> beta_square 权重
+        - 'stable_snps': list of str, 稳定 SNP ID 列表
+        
+    title : str, default="Causal Discovery by SNP Importance"
+        图表标题
+        
+    figsize : tuple, default=(12, 6)
+        图像尺寸 (width, height)
+        
+    show_legend : bool, default=True
+        是否显示图例
+        
+    bar_alpha : float, default=0.8
+        柱状图透明度
+        
+    bar_colors : dict, optional
+        自定义颜色映射，格式：{'block': color, 'snp': color}
+        
+    Returns
+    -------
+    tuple
+        (fig, ax) matplotlib 图形对象
+    """
+    # -----------------------------
+    # 提取数据
+    # -----------------------------
+    beta_square_dict = result.get('beta_square', {})
+    stable_snp_ids = result.get('stable_snps', [])
+
+    # 检查必要数据
+    if not stable_snp_ids or not beta_square_dict:
+        fig, ax = plt.subplots(figsize=figsize)
+        ax.text(0.5, 0.5, 'No stable SNPs/blocks identified', 
+                transform=ax.transAxes, fontsize=14, color='gray', alpha=0.7, 
+                ha='center', va='center')
+        ax.set_xlim(0, 1)
+        ax.set_ylim(0, 1)
+        ax.axis('off')
+        ax.set_ylabel("")
+        plt.title(title, pad=20)
+        fig.tight_layout()
+        return fig, ax
+
+    # ----------------------------- 
+    # 核心排序：按 beta_square 降序
+    # -----------------------------
+    sorted_by_beta2 = sorted(beta_square_dict.items(), key=lambda x: x[1], reverse=True)
+    snp_labels = [item[0] for item in sorted_by_beta2]
+    beta2_values = [item[1] for item in sorted_by_beta2]
+    x_pos = np.arange(len(snp_labels))
+    
+    # 颜色设置
+    if bar_colors is None:
+        bar_colors = {'block': 'red', 'snp': 'skyblue'}
+    
+    colors = [
+        bar_colors['block'] if snp.startswith('block|') else bar_colors['snp'] 
+        for snp in snp_labels
+    ]
+
+    # -----------------------------
+    # 绘图
+    # -----------------------------
+    fig, ax = plt.subplots(figsize=figsize, dpi=300)
+    
+    # 绘制 beta_square 柱状图
+    bars = ax.bar(x_pos, beta2_values, color=colors, alpha=bar_alpha, width=0.6)
+    ax.set_xlabel("Stable SNPs (ordered by $\\beta^2$ weight)")
+    ax.set_ylabel("$\\beta^2$ Weight", color='black')
+    ax.tick_params(axis='y', labelcolor='black')
+    ax.set_xticks(x_pos)
+    ax.set_xticklabels(snp_labels, rotation=45, ha='right', fontsize=9)
+    ax.set_xlim(-0.6, len(snp_labels) - 0.4)
+
+    # 图例
+    if show_legend:
+        legend_elements = [
+            Patch(facecolor=bar_colors['snp'], label='SNP'),
+            Patch(facecolor=bar_colors['block'], label='Block')
+        ]
+        ax.legend(
+            handles=legend_elements,
+            loc='upper right',
+            frameon=True,
+            fontsize=9
+        )
+    
+    plt.title(title, pad=20)
+    fig.tight_layout()
+    return fig, ax
+
+
+def save_causal_discovery(result, title, path, dpi=300, format=None):
+    """
+    画 plot_causal_discovery 并保存到 path，保存后关闭图形（批量出图时不累积 figure）
+    format: 传给 savefig；path 不以 .png 等结尾（如临时文件）时需要指定
+    """
+    fig, _ = plot_causal_discovery(result, title)
+    try:
+        fig.savefig(path, dpi=dpi, bbox_inches='tight', format=format)
+    finally:
+        plt.close(fig)
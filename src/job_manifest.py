@@ -0,0 +1,259 @@
+'''
+locus 任务清单（SQLite，单文件），代替“探测 .pkl / _gwas.png / _qtl.png / _blank 文件”和逐行追加 log_analysis.csv
+    <folder>/job_manifest.sqlite
+    jobs    每个 locus 一行：state、输入指纹、共同 SNP 数、尝试次数、起止时间、耗时、最后的信息
+    events  原 log_analysis.csv 的每一行；export_log 导出同样列的 CSV
+state（计算）：
+    running  已提交给 worker；主进程中途崩溃时停在这里，下次重跑
+    done     pkl 已写完（worker 先写临时文件再改名）之后，由主进程在一个事务里标记
+    blank    共同 SNP 不足（原 _blank 文件）
+    error    失败，下次重跑
+跳过判断只看 jobs 表（一次读入 dict，每个 locus O(1)），不读任何输入：
+    done / blank 且输入指纹不变 → 跳过；输入文件改过（大小或 mtime 变化）→ 重跑
+输入指纹只用 os.stat（文件名、大小、mtime），不读文件内容
+plot_state（绘图阶段，见 plot_stage）：NULL 未出图 / done / error，plot_source 为出图时 pkl 的指纹，
+pkl 更新后旧图视为过期；avg_completion（GWAS）随计算结果写入，绘图阶段据此筛选 locus
+只有主进程写数据库，worker 不连接
+'''
+import os
+import time
+import sqlite3
+import hashlib
+import pandas as pd
+from pathlib import Path
+from datetime import datetime
+
+MANIFEST_NAME = 'job_manifest.sqlite'
+
+STATE_RUNNING = 'running'
+STATE_DONE = 'done'
+STATE_BLANK = 'blank'
+STATE_ERROR = 'error'
+
+LOG_COLUMNS = ['timestamp', 'csv_file', 'parquet_file', 'gene', 'status', 'common_snp_count', 'message']
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    locus TEXT PRIMARY KEY,
+    parquet_file TEXT,
+    state TEXT NOT NULL,
+    input_hash TEXT,
+    common_snp_count INTEGER DEFAULT 0,
+    n_attempts INTEGER DEFAULT 0,
+    started REAL,
+    finished REAL,
+    elapsed REAL,
+    detail TEXT,
+    message TEXT,
+    avg_completion REAL,
+    plot_state TEXT,
+    plot_source TEXT,
+    plotted REAL,
+    plot_message TEXT
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT,
+    csv_file TEXT,
+    parquet_file TEXT,
+    gene TEXT,
+    status TEXT,
+    common_snp_count INTEGER,
+    message TEXT
+);
+"""
+
+
+## 后来加入 jobs 的列：旧清单打开时补上
+_JOBS_ADDED_COLUMNS = {
+    'avg_completion': 'REAL',
+    'plot_state': 'TEXT',
+    'plot_source': 'TEXT',
+    'plotted': 'REAL',
+    'plot_message': 'TEXT',
+}
+
+
+def input_fingerprint(*paths):
+    """输入文件的指纹：文件名 + 大小 + mtime 的 sha1（只 stat，不读内容）；不存在的文件记为 missing"""
+    h = hashlib.sha1()
+    for path in paths:
+        if path is None:
+            h.update(b'none;')
+            continue
+        path = Path(path)
+        try:
+            st = path.stat()
+            h.update(f"{path.name}|{st.st_size}|{st.st_mtime_ns};".encode('utf-8'))
+        except OSError:
+            h.update(f"{path.name}|missing;".encode('utf-8'))
+    return h.hexdigest()
+
+
+def replace_atomic(path, write):
+    """write(tmp) 写到临时文件，成功后改名为 path；中途失败或崩溃不会留下不完整的 path"""
+    path = Path(path)
+    tmp = path.with_name(path.name + '.tmp')
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class JobManifest:
+    """
+    locus 任务清单
+    用法：
+        with JobManifest(folder / MANIFEST_NAME) as manifest:
+            jobs = manifest.jobs()
+            reason = manifest.skip_reason(jobs.get(locus), input_hash)
+    每个写操作是一个事务（全部写入或全部不写）
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._conn = sqlite3.connect(str(self.path))
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.executescript(_SCHEMA)
+            existing = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            for name, sql_type in _JOBS_ADDED_COLUMNS.items():
+                if name not in existing:
+                    self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {sql_type}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def jobs(self):
+        """全部 locus 的当前记录：{locus: dict}，调用方据此 O(1) 判断是否跳过"""
+        cur = self._conn.execute("SELECT * FROM jobs")
+        cols = [c[0] for c in cur.description]
+        return {row[0]: dict(zip(cols, row)) for row in cur.fetchall()}
+
+    @staticmethod
+    def skip_reason(job, input_hash):
+        """done / blank 且输入指纹不变时返回该 state，否则 None（需要运行）"""
+        if job is None or job['input_hash'] != input_hash:
+            return None
+        return job['state'] if job['state'] in (STATE_DONE, STATE_BLANK) else None
+
+    def adopt(self, entries):
+        """
+        登记清单建立之前就已有结果的 locus（由原来的输出文件判断，只在没有记录时做一次）
+        entries: iterable of (locus, parquet_file, state, input_hash)
+        """
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO jobs (locus, parquet_file, state, input_hash, finished, message) "
+                "VALUES (?, ?, ?, ?, ?, '由已有输出文件登记')",
+                [(locus, pq, state, h, time.time()) for locus, pq, state, h in entries])
+
+    def mark_running(self, entries):
+        """
+        提交前标记为 running（尝试次数 +1）；只有结果写完后 record_result 才会改成 done
+        entries: iterable of (locus, parquet_file, input_hash)
+        """
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO jobs (locus, parquet_file, state, input_hash, n_attempts, started) "
+                "VALUES (?, ?, ?, ?, 1, ?) "
+                "ON CONFLICT(locus) DO UPDATE SET parquet_file = excluded.parquet_file, state = excluded.state, "
+                "input_hash = excluded.input_hash, n_attempts = n_attempts + 1, started = excluded.started, "
+                "finished = NULL, elapsed = NULL",
+                [(locus, pq, STATE_RUNNING, h, now) for locus, pq, h in entries])
+
+    def record_result(self, record):
+        """
+        一个 locus 的结果：日志事件与 jobs 状态在同一个事务中写入
+        record: locus_driver.process_locus 的返回值（'state' 为 done / blank / error）
+        """
+        with self._conn:
+            self._insert_events((record['csv_prefix'], record['pq_prefix'], status, count, message)
+                                for status, count, message in record['events'])
+            self._conn.execute(
+                "UPDATE jobs SET state = ?, common_snp_count = ?, finished = ?, elapsed = ?, "
+                "detail = COALESCE(?, detail), message = ?, avg_completion = COALESCE(?, avg_completion) "
+                "WHERE locus = ?",
+                (record['state'], int(record['common_snp_count']), time.time(), float(record['elapsed']),
+                 record.get('detail'), record['events'][-1][2] if record['events'] else None,
+                 record.get('avg_completion'), record['csv_prefix']))
+
+    def set_completion(self, entries):
+        """
+        补写 avg_completion（由已有 pkl 登记的 locus 第一次进入绘图阶段时）
+        entries: iterable of (locus, avg_completion)
+        """
+        with self._conn:
+            self._conn.executemany("UPDATE jobs SET avg_completion = ? WHERE locus = ?",
+                                   [(value, locus) for locus, value in entries])
+
+    def record_plots(self, entries):
+        """
+        绘图阶段的结果
+        entries: iterable of (locus, plot_state, plot_source, plot_message)
+        """
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE jobs SET plot_state = ?, plot_source = ?, plotted = ?, plot_message = ? WHERE locus = ?",
+                [(state, source, now, message, locus) for locus, state, source, message in entries])
+
+    def log_events(self, rows):
+        """
+        只写日志事件（如跳过的 locus），不改 jobs 状态
+        rows: iterable of (csv_file, parquet_file, status, common_snp_count, message)
+        """
+        with self._conn:
+            self._insert_events(rows)
+
+    def _insert_events(self, rows):
+        self._conn.executemany(
+            "INSERT INTO events (timestamp, csv_file, parquet_file, gene, status, common_snp_count, message) "
+            "VALUES (?, ?, ?, '', ?, ?, ?)",
+            [(_now(), csv_file, pq, status, int(count), message) for csv_file, pq, status, count, message in rows])
+
+    def import_log(self, log_path):
+        """
+        清单第一次建立时（events 为空）导入已有的 log_analysis.csv，之后 export_log 不会丢掉旧日志
+        Returns:
+            导入的行数
+        """
+        log_path = Path(log_path)
+        if not log_path.exists() or self._conn.execute("SELECT 1 FROM events LIMIT 1").fetchone():
+            return 0
+        df = pd.read_csv(log_path).reindex(columns=LOG_COLUMNS)
+        df['common_snp_count'] = pd.to_numeric(df['common_snp_count'], errors='coerce').fillna(0).astype(int)
+        df = df.astype(object).where(df.notna(), None)
+        with self._conn:
+            self._conn.executemany(
+                f"INSERT INTO events ({', '.join(LOG_COLUMNS)}) VALUES ({', '.join('?' * len(LOG_COLUMNS))})",
+                df.itertuples(index=False, name=None))
+        return len(df)
+
+    def summary(self):
+        """各 state 的 locus 数"""
+        return dict(self._conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    def export_log(self, log_path):
+        """把 events 表导出为原 log_analysis.csv 的格式（整体写临时文件再改名）"""
+        log_path = Path(log_path)
+        df = pd.read_sql_query(f"SELECT {', '.join(LOG_COLUMNS)} FROM events ORDER BY id", self._conn)
+        tmp = log_path.with_name(log_path.name + '.tmp')
+        df.to_csv(tmp, index=False)
+        os.replace(tmp, log_path)
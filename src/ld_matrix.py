@@ -0,0 +1,144 @@
+'''
+LD 长表 (ID_A, ID_B, R) → 稠密 LD 矩阵 的向量化工具
+原来的 pivot_ld_to_matrix 用 iterrows 逐行写入，宽一点的 locus 上比整个 block 流程还慢
+现在的做法：ID 先 factorize 成整数编码，再一次性 scatter 写入预分配好的数组
+另外支持只 pivot CSV/LD 的共同 SNP（snps_common），省掉 ld_df.loc[snps_common, snps_common] 的整块拷贝
+宽 locus 上大部分 LD 远低于 block 阈值，因此也提供按阈值截断的 CSR 稀疏 LD
+'''
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+def ld_snp_index(ld_df):
+    """
+    LD 长表中出现过的全部 SNP（排序后），等价于原来的 sorted(set(ID_A) | set(ID_B))
+    用它和 CSV 求交集即可得到 snps_common，不需要先把矩阵 pivot 出来
+    """
+    _, uniques = pd.factorize(
+        np.concatenate([ld_df['ID_A'].to_numpy(), ld_df['ID_B'].to_numpy()]),
+        sort=True
+    )
+    return pd.Index(uniques)
+
+
+def pivot_ld_to_array(ld_df, snps=None, dtype=np.float64):
+    """
+    将三列格式的 LD 数据转换为对称矩阵（numpy 版本）
+    Args:
+        ld_df: 长表，包含 'ID_A', 'ID_B', 'R' 三列
+        snps: 可选，只 pivot 这些 SNP（例如 snps_common），输出的行列顺序与 snps 一致；
+              不在 snps 中的 LD 对直接丢弃。为 None 时使用全部 SNP（排序后）
+        dtype: 输出矩阵的数据类型
+    Returns:
+        matrix: (n, n) 对称矩阵，对角线默认为 1
+        snp_index: pd.Index，矩阵行列对应的 SNP ID
+    """
+    ld_df = ld_df.drop_duplicates(subset=['ID_A', 'ID_B'])
+    id_a = ld_df['ID_A'].to_numpy()
+    id_b = ld_df['ID_B'].to_numpy()
+    r = ld_df['R'].to_numpy(dtype=dtype)
+
+    if snps is None:
+        codes, uniques = pd.factorize(np.concatenate([id_a, id_b]), sort=True)
+        snp_index = pd.Index(uniques)
+        i, j = codes[:len(id_a)], codes[len(id_a):]
+    else:
+        snp_index = pd.Index(snps)
+        if not snp_index.is_unique:
+            raise ValueError("snps 中存在重复 ID")
+        i = snp_index.get_indexer(id_a)
+        j = snp_index.get_indexer(id_b)
+        keep = (i >= 0) & (j >= 0)         ## 只保留两端都在 snps 中的 LD 对
+        i, j, r = i[keep], j[keep], r[keep]
+
+    n = len(snp_index)
+    matrix = np.eye(n, dtype=dtype)        # 默认对角线为1
+    if len(r) == 0:
+        return matrix, snp_index
+
+    # 与 iterrows 的语义保持一致：同一无序对 (A,B)/(B,A) 后出现的行覆盖先出现的行
+    lo = np.minimum(i, j).astype(np.int64)
+    hi = np.maximum(i, j).astype(np.int64)
+    key = lo * n + hi
+    _, first_in_reversed = np.unique(key[::-1], return_index=True)
+    last = len(key) - 1 - first_in_reversed
+
+    matrix[lo[last], hi[last]] = r[last]
+    matrix[hi[last], lo[last]] = r[last]
+    return matrix, snp_index
+
+
+def pivot_ld_to_matrix(ld_df, snps=None):
+    """将三列格式的 LD 数据转换为对称矩阵（DataFrame，行列均为 SNP ID）"""
+    matrix, snp_index = pivot_ld_to_array(ld_df, snps=snps)
+    return pd.DataFrame(matrix, index=snp_index, columns=snp_index)
+
+
+########## 稀疏 LD（只保留 |r| 超过阈值的对）
+def build_sparse_ld(R, r_floor=0.0):
+    """
+    由稠密 LD 构建 CSR 稀疏 LD，每个 locus 构建一次，供 block 发现和 r_to_others 复用
+    Args:
+        R: (p, p) 稠密 LD 矩阵
+        r_floor: 只保留 |r| > r_floor 的元素（对角线总是保留）；
+                 0.0 时只丢掉精确为 0 的元素，结果与稠密矩阵完全一致；
+                 > 0 时低于阈值的弱 LD 视为 0，r_to_others 随之近似
+    Returns:
+        R_sparse: scipy.sparse.csr_matrix (p, p)，列索引已排序
+    """
+    R = np.asarray(R)
+    p = R.shape[0]
+    keep = np.abs(R) > r_floor
+    np.fill_diagonal(keep, True)
+    rows, cols = np.nonzero(keep)                       # 行优先顺序，天然有序
+    R_sparse = sparse.csr_matrix((R[rows, cols], (rows, cols)), shape=(p, p))
+    R_sparse.sort_indices()
+    return R_sparse
+
+
+def sparse_ld_from_long(ld_df, snps, r_floor=0.0):
+    """
+    直接从 LD 长表构建 CSR 稀疏 LD，不经过稠密矩阵（内存只随强 LD 对数增长）
+    与 pivot_ld_to_array(ld_df, snps) 的语义一致：对角线为 1，同一无序对后出现的行覆盖先出现的行
+    """
+    ld_df = ld_df.drop_duplicates(subset=['ID_A', 'ID_B'])
+    snp_index = pd.Index(snps)
+    if not snp_index.is_unique:
+        raise ValueError("snps 中存在重复 ID")
+    n = len(snp_index)
+    i = snp_index.get_indexer(ld_df['ID_A'].to_numpy())
+    j = snp_index.get_indexer(ld_df['ID_B'].to_numpy())
+    r = ld_df['R'].to_numpy(dtype=np.float64)
+    keep = (i >= 0) & (j >= 0) & (i != j)               ## 对角线统一置 1
+    i, j, r = i[keep], j[keep], r[keep]
+
+    lo = np.minimum(i, j).astype(np.int64)
+    hi = np.maximum(i, j).astype(np.int64)
+    _, first_in_reversed = np.unique((lo * n + hi)[::-1], return_index=True)
+    last = len(lo) - 1 - first_in_reversed
+    lo, hi, r = lo[last], hi[last], r[last]
+    strong = np.abs(r) > r_floor
+    lo, hi, r = lo[strong], hi[strong], r[strong]
+
+    diag = np.arange(n)
+    rows = np.concatenate([lo, hi, diag])
+    cols = np.concatenate([hi, lo, diag])
+    vals = np.concatenate([r, r, np.ones(n)])
+    R_sparse = sparse.csr_matrix((vals, (rows, cols)), shape=(n, n))
+    R_sparse.sort_indices()
+    return R_sparse
+
+
+def strong_ld_edges(R_sparse, r_min=0.8):
+    """
+    从稀疏 LD 中取出上三角 R ≥ r_min 的边（正相位），按 (i, j) 字典序返回，
+    与原来 for i / for j>i 双重循环的加边顺序一致
+    Returns:
+        (rows, cols): 两个等长的 int 数组，rows < cols
+    """
+    coo = R_sparse.tocoo()
+    mask = (coo.row < coo.col) & (coo.data >= r_min)
+    rows, cols = coo.row[mask], coo.col[mask]
+    order = np.lexsort((cols, rows))
+    return rows[order], cols[order]
@@ -0,0 +1,196 @@
+'''
+per-locus 二进制 bundle：一次构建，后面每个阶段直接打开，不再反复读 parquet、pivot、去重、校对方向
+一个 bundle 就是一个文件夹：
+    ld.npy        稠密 LD 矩阵（共同SNP × 共同SNP），np.load(mmap_mode='r') 直接内存映射
+    snps.json     SNP 索引 sidecar，顺序与 ld.npy 的行列一致
+    summary.pkl   去重 + 方向校对后的汇总表（index 为 SNP，顺序同上）
+    meta.json     计数、来源文件及其指纹（文件名、大小、mtime、sha1）等信息；最后写入，作为“bundle 完整”的标志
+来源 CSV / parquet 重新生成后 bundle 即过期：使用方用 bundle_is_current 对照当前输入，过期时重建（或不用）
+'''
+import os
+import json
+import shutil
+import pickle
+import hashlib
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from datetime import datetime
+from block_engine import build_clean_ld
+
+BUNDLE_SUFFIX = '.bundle'
+BUNDLE_VERSION = 1
+
+_LD_FILE = 'ld.npy'
+_SNP_FILE = 'snps.json'
+_SUMMARY_FILE = 'summary.pkl'
+_META_FILE = 'meta.json'
+
+
+def bundle_path_for(folder, prefix):
+    """约定的 bundle 路径：与 pkl 同名，后缀为 .bundle"""
+    return Path(folder) / f"{prefix}{BUNDLE_SUFFIX}"
+
+
+def is_locus_bundle(bundle_dir):
+    """meta.json 最后写入，存在即说明 bundle 完整"""
+    return (Path(bundle_dir) / _META_FILE).exists()
+
+
+def _file_sha1(path, chunk=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def source_fingerprint(*paths):
+    """
+    来源文件的指纹，写进 meta.json：每个文件 {'name', 'size', 'mtime_ns', 'sha1'}
+    构建 bundle 时本来就要完整读一遍来源文件，多算一次 sha1 的代价很小
+    """
+    out = []
+    for path in paths:
+        path = Path(path)
+        st = path.stat()
+        out.append({'name': path.name, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': _file_sha1(path)})
+    return out
+
+
+def bundle_is_current(bundle_dir, *source_paths, missing_ok=False):
+    """
+    bundle 完整且来源文件与 meta 中的指纹一致（source_paths 顺序同写入时：CSV, parquet）
+    大小不同即过期；大小和 mtime 都相同视为未变（只 stat）；只有 mtime 不同（如复制过）时再比对 sha1
+    没有记录指纹的旧 bundle 返回 False
+    missing_ok: 来源文件不存在时不核对该文件（下游只拿到 pkl + bundle 的情形）；否则视为过期
+    """
+    meta = read_bundle_meta(bundle_dir)
+    recorded = None if meta is None else meta.get('source_fingerprint')
+    if not recorded or len(recorded) != len(source_paths):
+        return False
+    for rec, path in zip(recorded, source_paths):
+        path = Path(path)
+        try:
+            st = path.stat()
+        except OSError:
+            if missing_ok:
+                continue
+            return False
+        if st.st_size != rec['size']:
+            return False
+        if st.st_mtime_ns != rec['mtime_ns'] and _file_sha1(path) != rec['sha1']:
+            return False
+    return True
+
+
+def read_bundle_meta(bundle_dir):
+    """只读 meta.json（计数、来源文件），不打开 LD；bundle 不完整时返回 None"""
+    meta_path = Path(bundle_dir) / _META_FILE
+    if not meta_path.exists():
+        return None
+    with open(meta_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_locus_bundle(bundle_dir, ld, snps, summary, meta=None, dtype=np.float64):
+    """
+    写出一个 locus bundle（先写临时目录，再整体改名，中途崩溃不会留下半成品）
+    Args:
+        bundle_dir: bundle 文件夹路径
+        ld: (p, p) LD 矩阵，ndarray 或 DataFrame
+        snps: 长度 p 的 SNP ID，顺序与 ld 行列一致
+        summary: 去重、方向校对后的汇总表，index 为 SNP；会按 snps 重新排序
+        meta: 额外写入 meta.json 的信息（计数、来源文件等；来源指纹 'source_fingerprint' 见 source_fingerprint）
+        dtype: ld.npy 的存储类型，默认 float64
+    Returns:
+        bundle_dir: Path
+    """
+    bundle_dir = Path(bundle_dir)
+    snps = [str(s) for s in snps]
+    ld = np.asarray(ld, dtype=dtype)
+    if ld.shape != (len(snps), len(snps)):
+        raise ValueError(f"LD 维度 {ld.shape} 与 SNP 数 {len(snps)} 不匹配")
+    summary = summary.loc[snps]
+
+    tmp_dir = bundle_dir.with_name(bundle_dir.name + '.tmp')
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+
+    np.save(tmp_dir / _LD_FILE, ld)
+    with open(tmp_dir / _SNP_FILE, 'w', encoding='utf-8') as f:
+        json.dump(snps, f)
+    with open(tmp_dir / _SUMMARY_FILE, 'wb') as f:
+        pickle.dump(summary, f)
+
+    meta_all = {
+        'version': BUNDLE_VERSION,
+        'n_snps': len(snps),
+        'dtype': np.dtype(dtype).name,
+        'created': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    meta_all.update(meta or {})
+    with open(tmp_dir / _META_FILE, 'w', encoding='utf-8') as f:
+        json.dump(meta_all, f, ensure_ascii=False, indent=1)
+
+    if bundle_dir.exists():
+        shutil.rmtree(bundle_dir)
+    os.replace(tmp_dir, bundle_dir)
+    return bundle_dir
+
+
+def open_locus_bundle(bundle_dir, mmap_mode='r'):
+    """
+    打开 locus bundle，LD 矩阵以内存映射方式读取（不拷贝）
+    Args:
+        bundle_dir: bundle 文件夹路径
+        mmap_mode: 传给 np.load，默认只读映射；None 表示完整读入内存
+    Returns:
+        dict: {
+            'ld': (p, p) np.memmap / ndarray,
+            'snps': pd.Index，长度 p,
+            'summary': DataFrame，index 为 SNP，顺序与 'snps' 一致,
+            'meta': dict,
+        }
+    """
+    bundle_dir = Path(bundle_dir)
+    if not is_locus_bundle(bundle_dir):
+        raise FileNotFoundError(f"不是完整的 locus bundle: {bundle_dir}")
+    meta = read_bundle_meta(bundle_dir)
+    if meta.get('version') != BUNDLE_VERSION:
+        raise ValueError(f"bundle 版本不匹配: {meta.get('version')} != {BUNDLE_VERSION}")
+    with open(bundle_dir / _SNP_FILE, 'r', encoding='utf-8') as f:
+        snps = pd.Index(json.load(f))
+    with open(bundle_dir / _SUMMARY_FILE, 'rb') as f:
+        summary = pickle.load(f)
+    ld = np.load(bundle_dir / _LD_FILE, mmap_mode=mmap_mode)
+    return {
+        'ld': ld,
+        'snps': snps,
+        'summary': summary,
+        'meta': meta,
+    }
+
+
+def bundle_ld_frame(bundle):
+    """把 bundle 的 LD 包装成 DataFrame（不拷贝底层数组），供 run_fine_mapping_for_signal 使用"""
+    return pd.DataFrame(bundle['ld'], index=bundle['snps'], columns=bundle['snps'], copy=False)
+
+
+def bundle_clean_ld(bundle, block_data):
+    """
+    直接从 bundle 的 LD 和 pkl 中保存的 block 信息拼出 R_clean（剩余SNP + block），
+    与 R_extended[np.ix_(clean_indices, clean_indices)] 完全一致，不再需要单独的 _r_clean.parquet
+    Args:
+        bundle: open_locus_bundle 的返回值
+        block_data: build_enriched_blocks_pipeline 的返回值（pkl 中的 'block'）
+    Returns:
+        R_clean: (M + B, M + B)
+    """
+    blocks = block_data['blocks']
+    p = bundle['ld'].shape[0]
+    r_to_others = (np.stack([blk['r_to_others'] for blk in blocks]) if blocks
+                   else np.zeros((0, p)))                              # (B, p)
+    return build_clean_ld(bundle['ld'], block_data['remaining_snp_idx'], r_to_others,
+                          np.asarray(block_data['block_block_r_matrix']).reshape(len(blocks), len(blocks)))
@@ -0,0 +1,422 @@
+'''
+notebook 3 主循环的 locus 级驱动：一个 locus 一个任务，进程池并行
+    读 CSV / Parquet（或直接打开 locus bundle）→ 方向校对 → pivot → 精细定位 → 写 pkl
+    绘图是单独的阶段（plot_stage），计算 worker 不导入 matplotlib
+调度：任务按估计代价（共同 SNP 数）从大到小提交，最慢的 locus 最先开始，不会在最后单独拖尾
+    估计不读 parquet：有 locus bundle 时用 meta 中的共同 SNP 数，否则用 CSV 行数（共同 SNP 数的上界）
+worker 只返回很小的状态记录（日志事件、SNP 数、完成度、耗时）；pkl 由 worker 自己写（临时文件 + 改名）
+跳过与日志由主进程通过任务清单（job_manifest，SQLite）完成：提交前按清单判断，不读任何输入；
+结果写完后在一个事务里把 locus 标记为 done，中途崩溃的 locus 停在 running，下次重跑；
+log_analysis.csv 每次运行结束时从清单整体导出
+worker 内不要再开进程池：bootstrap 用默认的 'lockstep'，或 {'engine': 'parallel', 'seed': ..., 'n_workers': 1}（可复现）；
+BLAS 多线程会与进程并行争抢核，可按需设置 OMP_NUM_THREADS
+'''
+import os
+import time
+import pickle
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from ld_matrix import ld_snp_index, pivot_ld_to_matrix
+from locus_bundle import (bundle_path_for, is_locus_bundle, bundle_is_current, source_fingerprint,
+                          read_bundle_meta, write_locus_bundle, open_locus_bundle, bundle_ld_frame)
+from block_engine import ExtendedLD
+from finemap_pipeline import run_fine_mapping_for_signal
+from job_manifest import (JobManifest, MANIFEST_NAME, input_fingerprint, replace_atomic,
+                          STATE_DONE, STATE_BLANK, STATE_ERROR)
+
+
+########## 方向校对：GWAS / QTL 等位基因对齐，方向相反的翻转 beta_QTL
+def is_subset_np(a_arr, b_arr):
+    """判断两个字符串数组中每个元素是否满足子集关系"""
+    result = []
+    for a, b in zip(a_arr, b_arr):
+        if pd.isna(a) or pd.isna(b):
+            result.append(False)
+            continue
+        str_a = str(a).upper()
+        str_b = str(b).upper()
+        set_a = set(str_a.split(','))
+        set_b = set(str_b.split(','))
+        if any(len(allele) > 1 and allele != '-' for allele in set_a | set_b):
+            result.append(False)
+            continue
+        result.append(set_a <= set_b or set_b <= set_a)
+    return np.array(result)
+
+def classify_and_adjust_beta_vectorized(df):
+    # 根据实际列名修正
+    required_cols = {'REF_GWAS', 'ALF_GWAS', 'REF_QTL', 'ALT_QTL', 'beta_QTL'}
+    if not required_cols.issubset(df.columns):
+        missing = required_cols - set(df.columns)
+        raise ValueError(f"缺少必需列: {missing}")
+    # 使用实际的列名
+    ref_qtl = df['REF_QTL'].values      # 大写
+    alt_qtl = df['ALT_QTL'].values      # 大写
+    ref_gwas = df['REF_GWAS'].values    # 大写
+    alt_gwas = df['ALF_GWAS'].values    # 根据你的列名是 ALF_GWAS
+    beta_qtl = df['beta_QTL'].values    # 小写保持不变
+
+    cond1 = is_subset_np(alt_gwas, alt_qtl) & is_subset_np(ref_gwas, ref_qtl)  # 方向一致
+    cond2 = is_subset_np(alt_gwas, ref_qtl) & is_subset_np(ref_gwas, alt_qtl)  # 方向相反
+    valid_mask = cond1 | cond2
+    invalid_count = (~valid_mask).sum()
+    print(f"共 {invalid_count} 行被丢弃（无法归类）")
+
+    adjusted_beta = np.where(cond2, -beta_qtl, beta_qtl)
+    df.loc[valid_mask, 'beta_QTL'] = adjusted_beta[valid_mask]
+
+    return df[valid_mask].copy()
+
+
+########## locus 任务
+def discover_loci(folder_path, exclude=()):
+    """
+    文件夹中的 locus 任务：每个 CSV 一个，按文件名配对 *_LD_matrix.parquet（与原循环相同）
+    exclude: 不当作 locus 的 CSV 文件名（如日志文件 log_analysis.csv）
+    Returns:
+        list of dict: {'csv_prefix', 'csv_path', 'pq_path'（没有配对时为 None）, 'pq_prefix'}
+    """
+    folder_path = Path(folder_path)
+    csv_files = {f.stem: f for f in folder_path.glob("*.csv") if f.name not in exclude}
+    parquet_files = {f.stem.replace('_LD_matrix', ''): f for f in folder_path.glob("*_LD_matrix.parquet")}
+    tasks = []
+    for csv_prefix, csv_path in csv_files.items():
+        pq_path = parquet_files.get(csv_prefix)
+        tasks.append({
+            'csv_prefix': csv_prefix,
+            'csv_path': csv_path,
+            'pq_path': pq_path,
+            'pq_prefix': pq_path.stem if pq_path else "",
+        })
+    return tasks
+
+
+def estimate_locus_cost(task, folder_path):
+    """
+    locus 的估计代价（SNP 数）：有未过期的 bundle 时为共同 SNP 数，否则为 CSV 数据行数；读不到时为 0
+    """
+    if task['pq_prefix']:
+        bundle_dir = bundle_path_for(folder_path, task['pq_prefix'])
+        meta = read_bundle_meta(bundle_dir)
+        if meta is not None and 'n_snps' in meta and bundle_is_current(bundle_dir, task['csv_path'], task['pq_path']):
+            return int(meta['n_snps'])
+    try:
+        with open(task['csv_path'], 'rb') as f:
+            n_lines = sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1 << 20), b''))
+    except OSError:
+        return 0
+    return max(n_lines - 1, 0)
+
+
+def process_locus(task, folder_path, block_cache_dir=None, bootstrap_options=None, parquet_engine='fastparquet'):
+    """
+    处理一个 locus（原 notebook 主循环的循环体），日志事件不直接写文件，随记录返回
+    是否跳过由 run_loci 在提交前按任务清单判断，这里不再探测输出文件
+    task['rebuild_bundle'] 为 True（输入在上次运行之后改过）时不用已有的 bundle
+    Returns:
+        dict: {
+            'csv_prefix', 'pq_prefix',
+            'status': 最后一个事件的状态（SUCCESS / SKIPPED / ERROR）,
+            'state': 写入任务清单的状态（done / blank / error）,
+            'detail': CSV / Parquet SNP 数与覆盖率（之后跳过时写进日志），读取失败时为 None,
+            'avg_completion': GWAS 的平均信号完成度（绘图阶段据此筛选），未完成分析时为 None,
+            'common_snp_count': int,
+            'estimated_snps': 调度用的估计 SNP 数（run_loci 填入）,
+            'events': list of (status, common_snp_count, message)，按发生顺序，由主进程写入 log_analysis.csv,
+            'elapsed': 秒,
+        }
+    """
+    t_start = time.perf_counter()
+    folder_path = Path(folder_path)
+    csv_prefix, csv_path = task['csv_prefix'], task['csv_path']
+    pq_path, pq_prefix = task['pq_path'], task['pq_prefix']
+    events = []
+    common_snp_count = 0
+    counts_msg = None
+    avg_completion = None
+
+    def _done(status, count, message=None, state=STATE_ERROR):
+        if message is not None:
+            events.append((status, count, message))
+        return {
+            'csv_prefix': csv_prefix,
+            'pq_prefix': pq_prefix,
+            'status': status,
+            'state': state,
+            'detail': counts_msg,
+            'avg_completion': avg_completion,
+            'common_snp_count': int(count),
+            'estimated_snps': task.get('estimated_snps'),
+            'events': events,
+            'elapsed': time.perf_counter() - t_start,
+        }
+
+    print(f"\n👉 正在处理: {csv_prefix}")
+    bundle_dir = bundle_path_for(folder_path, pq_prefix)
+
+    # 已有 locus bundle 且来源文件没变：直接内存映射打开，跳过 CSV/Parquet 读取、去重、方向校对和 pivot
+    bundle = None
+    if pq_prefix and is_locus_bundle(bundle_dir):
+        if task.get('rebuild_bundle'):
+            print(f"♻️ 任务清单中的输入指纹已改变，重新构建 bundle: {bundle_dir.name}")
+        elif not bundle_is_current(bundle_dir, csv_path, pq_path):
+            print(f"♻️ 来源文件已改变（或 bundle 没有来源指纹），重新构建 bundle: {bundle_dir.name}")
+        else:
+            try:
+                bundle = open_locus_bundle(bundle_dir)
+                csv_snp_count = bundle['meta']['csv_snp_count']
+                pq_snp_count = bundle['meta']['pq_snp_count']
+                coverage_ratio = bundle['meta']['coverage_ratio']
+                print(f"📦 读取 locus bundle: {bundle_dir.name}")
+            except Exception as e:
+                print(f"⚠️ 读取 bundle 失败，重新构建: {e}")
+                bundle = None
+
+    if bundle is None:
+        # 来源指纹在读输入之前记下，写进 bundle（之后来源文件再改，bundle 即过期）
+        try:
+            sources = source_fingerprint(csv_path, pq_path) if pq_path is not None else None
+        except OSError:
+            sources = None
+        # 读取CSV文件，基于P_GWAS去重，保留P值最小的
+        df_full = pd.read_csv(csv_path)
+        original_rows = len(df_full)
+        if 'P_GWAS' in df_full.columns:
+            df_full = df_full.loc[df_full.groupby('SNP')['P_GWAS'].idxmin()]
+            if len(df_full) < original_rows:
+                print(f"🧹 基于P_GWAS去重: {original_rows} → {len(df_full)} 行 (保留P值最小)")
+        csv_snp_count = len(df_full['SNP'].unique())
+
+        try:
+            ld_long = pd.read_parquet(pq_path, engine=parquet_engine)
+            pq_snp_set = set(ld_long['ID_A']) | set(ld_long['ID_B'])
+            pq_snp_count = len(pq_snp_set)
+            coverage_ratio = (pq_snp_count / csv_snp_count) * 100 if csv_snp_count > 0 else 0
+        except Exception as e:
+            print(f"❌ 读取Parquet失败: {e}")
+            return _done("ERROR", 0, f"读取Parquet失败: {e}")
+
+    counts_msg = f"CSV SNP数: {csv_snp_count}, Parquet SNP数: {pq_snp_count}, 覆盖率: {coverage_ratio:.2f}%"
+    output_pkl = folder_path / f"{pq_prefix}.pkl"
+
+    if bundle is None:
+        # 调整 beta_QTL 方向（对完整数据进行处理）
+        try:
+            df_adjusted = classify_and_adjust_beta_vectorized(df_full)
+            print(f"📊 数据过滤：原始 {len(df_full)} 行 → 过滤后 {len(df_adjusted)} 行")
+        except Exception as e:
+            print(f"❌ 调整 beta 失败: {e}")
+            return _done("ERROR", 0, f"调整beta失败: {e} | {counts_msg}")
+
+        # 先在长表上求共同SNP，不需要先 pivot 出整个矩阵
+        df_adjusted = df_adjusted.set_index('SNP')
+        snps_common = ld_snp_index(ld_long).intersection(df_adjusted.index)
+        common_snp_count = len(snps_common)
+        if common_snp_count < 3:
+            print(f"⚠️ 共同SNP数量不足（{common_snp_count} < 3），跳过分析")
+            return _done("SKIPPED", common_snp_count, f"共同SNP数量不足 | {counts_msg}", state=STATE_BLANK)
+
+        # 只 pivot 共同SNP的子集，行列顺序与 snps_common 一致
+        try:
+            ld_df = pivot_ld_to_matrix(ld_long, snps=snps_common)
+        except Exception as e:
+            error_msg = f"转换Parquet失败: {e}"
+            print(f"❌ {error_msg}")
+            return _done("ERROR", common_snp_count, f"{error_msg} | {counts_msg}")
+        df_sub = df_adjusted.loc[snps_common]
+
+        # 写出 locus bundle，后续重跑和 9.5 直接打开，不再重复 pivot
+        try:
+            write_locus_bundle(bundle_dir, ld_df.values, snps_common, df_sub, meta={
+                'csv_snp_count': int(csv_snp_count),
+                'pq_snp_count': int(pq_snp_count),
+                'coverage_ratio': float(coverage_ratio),
+                'source_csv': csv_path.name,
+                'source_parquet': pq_path.name,
+                'source_fingerprint': sources,
+            })
+        except Exception as e:
+            print(f"⚠️ 写出 bundle 失败（不影响本次分析）: {e}")
+    else:
+        ld_df = bundle_ld_frame(bundle)
+        df_sub = bundle['summary']
+        common_snp_count = len(bundle['snps'])
+
+    # 开始分析，输入的是清理后的LD以及 df_sub
+    try:
+        (result_raw_gwas, result_stable_gwas,
+         result_raw_qtl, result_stable_qtl, blocks_result) = run_fine_mapping_for_signal(
+            df_sub, ld_df, 'BETA_GWAS', 'SE_GWAS', 'beta_QTL', 'SE_QTL',
+            block_cache_dir=block_cache_dir, bootstrap_options=bootstrap_options
+        )
+        avg_completion = float(result_raw_gwas['avg_completion'])
+        print(f"✅ 分析完成，共同SNP数: {common_snp_count}")
+        events.append(("SUCCESS", common_snp_count, f"分析完成 | {counts_msg}"))
+    except Exception as e:
+        error_msg = f"分析失败: {e}"
+        print(f"❌ {error_msg}")
+        return _done("ERROR", common_snp_count, f"{error_msg} | {counts_msg}")
+
+    # 保存结果
+    try:
+        ## R_extended 在内存中是惰性视图 ExtendedLD；pkl 里仍存稠密 ndarray（原格式，读取方不需要 block_engine）
+        if isinstance(blocks_result['R_extended'], ExtendedLD):
+            blocks_result = {**blocks_result, 'R_extended': blocks_result['R_extended'].toarray()}
+        combined = {
+            "gwas_bootstrap": result_raw_gwas,
+            "gwas_stable": result_stable_gwas,
+            "qtl_bootstrap": result_raw_qtl,
+            "qtl_stable": result_stable_qtl,
+            "block": blocks_result
+        }
+
+        def _dump(tmp):
+            with open(tmp, 'wb') as f:
+                pickle.dump(combined, f)
+        replace_atomic(output_pkl, _dump)
+        print(f"✅ 结果已保存至 {output_pkl}")
+    except Exception as e:
+        error_msg = f"保存失败: {e}"
+        print(f"❌ {error_msg}")
+        return _done("ERROR", common_snp_count, f"{error_msg} | {counts_msg}")
+
+    return _done("SUCCESS", common_snp_count, state=STATE_DONE)        ## 成功事件已在分析完成时记录
+
+
+def _init_locus_worker():
+    """worker 进程：全局随机状态重新播种（fork 出来的 worker 不共用同一随机流）"""
+    np.random.seed()
+
+
+def _adopt_existing_outputs(manifest, tasks, folder_path, hashes):
+    """
+    清单里还没有记录的 locus：按原来的输出文件（_blank；pkl）登记一次，之后只看清单
+    （图是否已出由绘图阶段自己判断）
+    Returns:
+        登记的 locus 数
+    """
+    entries = []
+    for task in tasks:
+        pq_prefix = task['pq_prefix']
+        if not pq_prefix:
+            continue
+        if (folder_path / f"{pq_prefix}_blank").exists():
+            state = STATE_BLANK
+        elif (folder_path / f"{pq_prefix}.pkl").exists():
+            state = STATE_DONE
+        else:
+            continue
+        entries.append((task['csv_prefix'], pq_prefix, state, hashes[task['csv_prefix']]))
+    manifest.adopt(entries)
+    return len(entries)
+
+
+def run_loci(folder_path, n_workers=None, log_file_path=None, block_cache_dir=None, bootstrap_options=None,
+             parquet_engine='fastparquet', tasks=None, manifest_path=None):
+    """
+    并行处理文件夹中的全部 locus（原 notebook 主循环）
+    Args:
+        folder_path: CSV / *_LD_matrix.parquet 所在文件夹，输出也写在这里
+        n_workers: 进程数，None 为 CPU 核数；1 时在当前进程内逐个运行（便于调试）
+        log_file_path: 日志 CSV，默认 folder_path / "log_analysis.csv"；每次运行结束时由任务清单整体导出
+        block_cache_dir / bootstrap_options: 传给 run_fine_mapping_for_signal
+        parquet_engine: pd.read_parquet 的 engine
+        tasks: 可选，discover_loci 的输出（或其子集）；None 时扫描 folder_path
+        manifest_path: 任务清单（SQLite），默认 folder_path / MANIFEST_NAME
+    Returns:
+        list of dict: 本次实际运行的 locus 的状态记录（见 process_locus），按完成顺序
+    """
+    folder_path = Path(folder_path)
+    log_file_path = Path(log_file_path) if log_file_path is not None else folder_path / "log_analysis.csv"
+    manifest_path = Path(manifest_path) if manifest_path is not None else folder_path / MANIFEST_NAME
+    if tasks is None:
+        tasks = discover_loci(folder_path, exclude=(log_file_path.name,))
+    n_workers = (os.cpu_count() or 1) if n_workers is None else max(1, int(n_workers))
+    records = []
+
+    with JobManifest(manifest_path) as manifest:
+        manifest.import_log(log_file_path)
+        try:
+            # 跳过判断只看清单：done / blank 且输入指纹（os.stat）不变
+            hashes = {task['csv_prefix']: input_fingerprint(task['csv_path'], task['pq_path']) for task in tasks}
+            jobs = manifest.jobs()
+            if _adopt_existing_outputs(manifest, [t for t in tasks if t['csv_prefix'] not in jobs], folder_path, hashes):
+                jobs = manifest.jobs()
+            pending, skipped = [], []
+            for task in tasks:
+                job = jobs.get(task['csv_prefix'])
+                reason = manifest.skip_reason(job, hashes[task['csv_prefix']])
+                if reason is None:
+                    ## 因输入改变而重跑：旧 bundle 是旧输入建的，必须重建
+                    stale = job is not None and job['input_hash'] not in (None, hashes[task['csv_prefix']])
+                    pending.append(dict(task, rebuild_bundle=stale))
+                    continue
+                message = "已完成，跳过" if reason == STATE_DONE else "已知问题：SNP不足"
+                if job['detail']:
+                    message += f" | {job['detail']}"
+                skipped.append((task['csv_prefix'], task['pq_prefix'], "SKIPPED", 0, message))
+            manifest.log_events(skipped)
+
+            # 最大的 locus 最先提交
+            costs = [estimate_locus_cost(task, folder_path) for task in pending]
+            order = np.argsort(costs, kind='stable')[::-1]
+            pending = [dict(pending[i], estimated_snps=costs[i]) for i in order]
+            print(f"🔍 找到 {len(tasks)} 个 locus，跳过 {len(skipped)} 个（清单中已完成 / SNP 不足），"
+                  f"{len(pending)} 个待处理；{n_workers} 个进程，按估计 SNP 数从大到小处理")
+            manifest.mark_running([(t['csv_prefix'], t['pq_prefix'], hashes[t['csv_prefix']]) for t in pending])
+            _run_pending(pending, manifest, records, n_workers, {
+                'folder_path': folder_path,
+                'block_cache_dir': block_cache_dir,
+                'bootstrap_options': bootstrap_options,
+                'parquet_engine': parquet_engine,
+            })
+        finally:
+            manifest.export_log(log_file_path)
+        print(f"✅ 全部任务完成，清单状态: {manifest.summary()}")
+    return records
+
+
+def _run_pending(tasks, manifest, records, n_workers, options):
+    """运行待处理的 locus，每个结果返回后立即写入清单（一个事务）"""
+
+    def _collect(record):
+        manifest.record_result(record)
+        records.append(record)
+        print(f"[{len(records)}/{len(tasks)}] {record['status']} {record['csv_prefix']} "
+              f"({record['common_snp_count']} SNP, {record['elapsed']:.1f}s)")
+
+    def _failed(task, e, elapsed=0.0):
+        ## 循环体外的异常（如 CSV 读取失败）只影响这一个 locus
+        print(f"❌ {task['csv_prefix']} 未处理的异常: {e}")
+        return {
+            'csv_prefix': task['csv_prefix'],
+            'pq_prefix': task['pq_prefix'],
+            'status': "ERROR",
+            'state': STATE_ERROR,
+            'detail': None,
+            'avg_completion': None,
+            'common_snp_count': 0,
+            'estimated_snps': task.get('estimated_snps'),
+            'events': [("ERROR", 0, f"未处理的异常: {e}")],
+            'elapsed': elapsed,
+        }
+
+    if n_workers == 1:
+        for task in tasks:
+            t_start = time.perf_counter()
+            try:
+                record = process_locus(task, **options)
+            except Exception as e:
+                record = _failed(task, e, time.perf_counter() - t_start)
+            _collect(record)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_locus_worker) as pool:
+            futures = {pool.submit(process_locus, task, **options): task for task in tasks}
+            for future in as_completed(futures):
+                try:
+                    record = future.result()
+                except Exception as e:
+                    record = _failed(futures[future], e)
+                _collect(record)
@@ -0,0 +1,162 @@
+'''
+绘图阶段：与计算分离，从已保存的 pkl 按需出图（原来每个 locus 在计算 worker 里画两张 300 dpi 的图，
+包括之后会被 7.找出0.8的pkl文件 筛掉的 locus）
+    只渲染请求的 locus，或完成度通过筛选的 locus（gwas_bootstrap['avg_completion'] > min_completion，与脚本 7 相同）
+    独立进程池，worker 使用 Agg 后端；计算 worker（locus_driver）不导入 matplotlib
+选择只看任务清单（job_manifest）：state 为 done 的 locus，avg_completion 随计算结果写入清单；
+清单建立前就有的 pkl 第一次进入本阶段时读一次补写，原来和计算一起画好的图直接登记
+出图结果写回清单（plot_state / plot_source = 出图时 pkl 的指纹）：pkl 没变就不重画，pkl 更新后重画
+png 先写临时文件再改名
+'''
+import os
+import time
+import pickle
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from job_manifest import JobManifest, MANIFEST_NAME, input_fingerprint, replace_atomic, STATE_DONE
+
+PLOT_DONE = 'done'
+PLOT_ERROR = 'error'
+
+## (pkl 中的结果键, 图文件后缀)
+PLOT_TARGETS = (('gwas_stable', 'gwas'), ('qtl_stable', 'qtl'))
+
+
+def _plot_paths(folder_path, pq_prefix):
+    return [folder_path / f"{pq_prefix}_{suffix}.png" for _, suffix in PLOT_TARGETS]
+
+
+def _load_completion(pkl_path):
+    """已有 pkl 的 GWAS 平均完成度（脚本 7 的筛选标准）；读取失败时为 None"""
+    try:
+        with open(pkl_path, 'rb') as f:
+            return float(pickle.load(f)['gwas_bootstrap']['avg_completion'])
+    except Exception as e:
+        print(f"⚠️ 无法读取 {Path(pkl_path).name} 的 avg_completion: {e}")
+        return None
+
+
+def select_plot_loci(manifest, folder_path, loci=None, min_completion=0.8, force=False):
+    """
+    需要出图的 locus
+    Args:
+        manifest: JobManifest
+        loci: 可选，指定的 locus（CSV 文件名前缀）；给定时不按完成度筛选
+        min_completion: 未指定 loci 时，只选 avg_completion > min_completion 的 locus
+        force: True 时忽略已有的图，全部重画
+    Returns:
+        list of dict: {'csv_prefix', 'pq_prefix', 'pkl_path', 'pkl_hash'}
+    """
+    folder_path = Path(folder_path)
+    jobs = {locus: job for locus, job in manifest.jobs().items() if job['state'] == STATE_DONE}
+    if loci is not None:
+        missing = [locus for locus in loci if locus not in jobs]
+        if missing:
+            print(f"⚠️ {len(missing)} 个指定的 locus 没有已完成的结果，跳过: {missing[:5]}")
+        jobs = {locus: jobs[locus] for locus in loci if locus in jobs}
+    else:
+        ## 清单建立前就有的 pkl 没有 avg_completion：读一次写回清单
+        backfill = [(locus, _load_completion(folder_path / f"{job['parquet_file']}.pkl"))
+                    for locus, job in jobs.items() if job['avg_completion'] is None]
+        backfill = [(locus, value) for locus, value in backfill if value is not None]
+        if backfill:
+            manifest.set_completion(backfill)
+            for locus, value in backfill:
+                jobs[locus]['avg_completion'] = value
+        jobs = {locus: job for locus, job in jobs.items()
+                if job['avg_completion'] is not None and job['avg_completion'] > min_completion}
+
+    selected, adopted = [], []
+    for locus, job in jobs.items():
+        pkl_path = folder_path / f"{job['parquet_file']}.pkl"
+        if not pkl_path.exists():
+            continue
+        pkl_hash = input_fingerprint(pkl_path)
+        if not force:
+            if job['plot_state'] == PLOT_DONE and job['plot_source'] == pkl_hash:
+                continue
+            ## 以前和计算一起画好的图：由已有输出登记、之后没有重算过（n_attempts 为 0）的 locus 直接登记
+            if job['plot_state'] is None and not job['n_attempts']:
+                if all(p.exists() for p in _plot_paths(folder_path, job['parquet_file'])):
+                    adopted.append((locus, PLOT_DONE, pkl_hash, '由已有图文件登记'))
+                    continue
+        selected.append({'csv_prefix': locus, 'pq_prefix': job['parquet_file'],
+                         'pkl_path': pkl_path, 'pkl_hash': pkl_hash})
+    manifest.record_plots(adopted)
+    return selected
+
+
+def render_locus(task, folder_path, dpi=300):
+    """
+    从一个 locus 的 pkl 画 GWAS / QTL 两张图（worker 中调用）
+    Returns:
+        dict: {'csv_prefix', 'plot_state', 'plot_source', 'message', 'elapsed'}
+    """
+    from finemap_plots import save_causal_discovery
+    t_start = time.perf_counter()
+    folder_path = Path(folder_path)
+    try:
+        with open(task['pkl_path'], 'rb') as f:
+            combined = pickle.load(f)
+        for (key, suffix), png_path in zip(PLOT_TARGETS, _plot_paths(folder_path, task['pq_prefix'])):
+            replace_atomic(png_path, lambda tmp: save_causal_discovery(
+                combined[key], f"{task['csv_prefix']}_{suffix}", tmp, dpi=dpi, format='png'))
+        state, message = PLOT_DONE, None
+    except Exception as e:
+        state, message = PLOT_ERROR, f"绘图失败: {e}"
+    return {
+        'csv_prefix': task['csv_prefix'],
+        'plot_state': state,
+        'plot_source': task['pkl_hash'],
+        'message': message,
+        'elapsed': time.perf_counter() - t_start,
+    }
+
+
+def _init_plot_worker():
+    """绘图 worker：导入 pyplot 之前切到无界面后端"""
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def run_plot_stage(folder_path, loci=None, min_completion=0.8, n_workers=None, dpi=300, force=False,
+                   manifest_path=None):
+    """
+    为已完成的 locus 出图（在 run_loci 之后单独调用，也可以只对指定 locus 重画）
+    Args:
+        folder_path: run_loci 的输出文件夹（pkl 所在，图也写在这里）
+        loci / min_completion / force: 见 select_plot_loci
+        n_workers: 进程数，None 为 CPU 核数；1 时在当前进程内逐个出图
+        dpi: 图的分辨率
+        manifest_path: 任务清单，默认 folder_path / MANIFEST_NAME
+    Returns:
+        list of dict: 本次出图的 locus 的记录（见 render_locus），按完成顺序
+    """
+    folder_path = Path(folder_path)
+    manifest_path = Path(manifest_path) if manifest_path is not None else folder_path / MANIFEST_NAME
+    n_workers = (os.cpu_count() or 1) if n_workers is None else max(1, int(n_workers))
+    records = []
+
+    with JobManifest(manifest_path) as manifest:
+        tasks = select_plot_loci(manifest, folder_path, loci=loci, min_completion=min_completion, force=force)
+        print(f"🖼️ {len(tasks)} 个 locus 需要出图；{n_workers} 个进程")
+
+        def _collect(record):
+            manifest.record_plots([(record['csv_prefix'], record['plot_state'],
+                                    record['plot_source'], record['message'])])
+            records.append(record)
+            if record['message']:
+                print(f"❌ {record['csv_prefix']} {record['message']}")
+
+        if n_workers == 1:
+            ## 当前进程（notebook）保留原来的后端：save_causal_discovery 画完即关闭，不会显示
+            for task in tasks:
+                _collect(render_locus(task, folder_path, dpi))
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_plot_worker) as pool:
+                futures = [pool.submit(render_locus, task, folder_path, dpi) for task in tasks]
+                for future in as_completed(futures):
+                    _collect(future.result())
+    n_failed = sum(r['plot_state'] == PLOT_ERROR for r in records)
+    print(f"✅ 出图完成：{len(records) - n_failed} 个成功，{n_failed} 个失败")
+    return records
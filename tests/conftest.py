@@ -0,0 +1,53 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+
+
+def synth_ld(p, seed=0, n=400, rng=None):
+    """按 haplotype block 生成基因型的 LD 矩阵（块内强相关，块大小 1–11）"""
+    rng = np.random.default_rng(seed) if rng is None else rng
+    G = np.zeros((n, p))
+    pos = 0
+    while pos < p:
+        base = rng.normal(size=n)
+        for _ in range(int(rng.integers(1, 12))):
+            if pos >= p:
+                break
+            G[:, pos] = base + rng.normal(scale=rng.uniform(0.05, 1.5), size=n)
+            pos += 1
+    return np.corrcoef(G, rowvar=False)
+
+
+def write_locus(folder, name, p=60, seed=0, n=400):
+    """
+    合成一个 locus：{name}.csv（汇总统计）与 {name}_LD_matrix.parquet（长表 LD），格式同主流程的输入
+    基因型按 haplotype block 生成，两个因果 SNP
+    """
+    rng = np.random.default_rng(seed)
+    R = synth_ld(p, n=n, rng=rng)
+    beta = np.zeros(p)
+    causal = rng.choice(p, 2, replace=False)
+    beta[causal] = rng.normal(0, 0.3, 2)
+    z_gwas = R @ beta * np.sqrt(n) + rng.normal(size=p)
+    z_qtl = R @ beta * np.sqrt(n) + rng.normal(size=p)
+    ids = np.array([f"rs{1000 + i}" for i in range(p)])
+    se = np.full(p, 0.05)
+    folder = Path(folder)
+    pd.DataFrame({
+        'SNP': ids, 'ALF_GWAS': 'G', 'REF_GWAS': 'A', 'SE_GWAS': se, 'BETA_GWAS': z_gwas * se,
+        'P_GWAS': np.linspace(1e-5, 1e-3, p), 'ALT_QTL': 'G', 'REF_QTL': 'A', 'beta_QTL': z_qtl * se, 'SE_QTL': se,
+    }).to_csv(folder / f"{name}.csv", index=False)
+    i, j = np.triu_indices(p, 1)
+    pd.DataFrame({'ID_A': ids[i], 'ID_B': ids[j], 'R': R[i, j]}).to_parquet(folder / f"{name}_LD_matrix.parquet")
+    return folder / f"{name}.csv", folder / f"{name}_LD_matrix.parquet"
+
+
+@pytest.fixture
+def locus_folder(tmp_path):
+    write_locus(tmp_path, 'loc0', p=60, seed=1)
+    return tmp_path
@@ -0,0 +1,128 @@
+import numpy as np
+import networkx as nx
+import pytest
+
+from conftest import synth_ld
+from block_engine import adjacency_from_edges, find_cliques_bitset
+from finemap_pipeline import find_maximal_clique_blocks, resolve_block_overlap, evaluate_and_prune_block
+
+LD_CASES = [(p, seed) for p in (30, 80, 150) for seed in range(3)]
+
+
+def _ld(p, seed):
+    R = synth_ld(p, seed=seed)
+    return R, np.array([f"rs{i}" for i in range(p)])
+
+
+def _baseline_cliques(R, r_min=0.8):
+    """原实现：双重循环加边 + nx.find_cliques"""
+    p = R.shape[0]
+    G = nx.Graph()
+    G.add_nodes_from(range(p))
+    for i in range(p):
+        for j in range(i + 1, p):
+            if R[i, j] >= r_min:
+                G.add_edge(i, j)
+    return [sorted(c) for c in nx.find_cliques(G) if len(c) >= 2]
+
+
+@pytest.mark.parametrize('p, seed', LD_CASES)
+def test_adjacency_backend_matches_networkx_in_order(p, seed):
+    R, ids = _ld(p, seed)
+    expected = _baseline_cliques(R)
+    for backend in ('adjacency', 'networkx'):
+        blocks = find_maximal_clique_blocks(R, ids, backend=backend)
+        assert [blk['snps'].tolist() for blk in blocks] == expected
+        assert all(blk['snp_ids'] == ids[blk['snps']].tolist() for blk in blocks)
+
+
+@pytest.mark.parametrize('p, seed', LD_CASES)
+@pytest.mark.parametrize('use_degeneracy', [True, False])
+def test_bitset_backend_matches_networkx_as_sets(p, seed, use_degeneracy):
+    R, ids = _ld(p, seed)
+    blocks = find_maximal_clique_blocks(R, ids, backend='bitset', use_degeneracy=use_degeneracy)
+    assert sorted(blk['snps'].tolist() for blk in blocks) == sorted(_baseline_cliques(R))
+
+
+def _dense_random_graph(p=60, density=0.5, seed=0):
+    rng = np.random.default_rng(seed)
+    mask = np.triu(rng.random((p, p)) < density, k=1)
+    rows, cols = np.nonzero(mask)
+    return adjacency_from_edges(p, rows, cols)
+
+
+def test_bitset_max_cliques_warns_and_truncates():
+    indptr, indices = _dense_random_graph()
+    full, info = find_cliques_bitset(60, indptr, indices)
+    assert not info['truncated'] and len(full) > 100
+    with pytest.warns(UserWarning, match='max_cliques'):
+        cliques, info = find_cliques_bitset(60, indptr, indices, max_cliques=10)
+    assert info['truncated'] and info['reason'] == 'max_cliques'
+    assert len(cliques) == info['n_cliques'] == 10
+    assert {tuple(sorted(c)) for c in cliques} <= {tuple(sorted(c)) for c in full}
+
+
+def test_bitset_time_budget_warns_and_truncates():
+    indptr, indices = _dense_random_graph(p=120)
+    with pytest.warns(UserWarning, match='time_budget'):
+        cliques, info = find_cliques_bitset(120, indptr, indices, time_budget=0.0)
+    assert info['truncated'] and info['reason'] == 'time_budget'
+    assert 0 < len(cliques) < find_cliques_bitset(120, indptr, indices)[1]['n_cliques']
+
+
+def _baseline_prune(block, R, pve_min=0.7, min_size=2):
+    """原实现的主路径：每一步 eigvalsh + eigh，删去 PC1 载荷绝对值最小的 SNP"""
+    curr = block['snps'].tolist()
+    while len(curr) >= min_size:
+        R_sub = R[np.ix_(curr, curr)]
+        eigvals, eigvecs = np.linalg.eigh(R_sub)
+        if eigvals[-1] / len(curr) >= pve_min:
+            return curr, eigvals[-1] / len(curr), eigvecs[:, -1]
+        curr.pop(int(np.argmin(np.abs(eigvecs[:, -1]))))
+    return None
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_prune_matches_full_eigh(seed):
+    rng = np.random.default_rng(seed)
+    for m in (5, 20, 40):
+        R = synth_ld(m, rng=rng)
+        block = {'snps': np.arange(m), 'snp_ids': [f"rs{i}" for i in range(m)]}
+        expected = _baseline_prune(block, R)
+        pruned = evaluate_and_prune_block(block, R)
+        if expected is None:
+            assert pruned is None
+            continue
+        snps, pve, pc1 = expected
+        assert pruned['snps'].tolist() == snps
+        assert pruned['pve'] == pytest.approx(pve, abs=1e-8)
+        assert abs(pruned['loadings'] @ pc1) == pytest.approx(1.0, abs=1e-8)
+
+
+def _baseline_resolve(blocks, R):
+    """原实现：逐 block 求 mean_r，sorted(reverse=True) 后用集合贪心去重"""
+    scored = []
+    for blk in blocks:
+        snps = blk['snps']
+        if len(snps) < 2:
+            continue
+        R_sub = R[np.ix_(snps, snps)]
+        scored.append((R_sub[np.triu_indices_from(R_sub, k=1)].mean(), blk))
+    used, kept = set(), []
+    for mean_r, blk in sorted(scored, key=lambda x: x[0], reverse=True):
+        if used & set(blk['snps']):
+            continue
+        kept.append((blk['snps'].tolist(), mean_r))
+        used |= set(blk['snps'])
+    return kept
+
+
+@pytest.mark.parametrize('p, seed', LD_CASES)
+@pytest.mark.parametrize('order_by_mean_r', [False, True])
+def test_resolve_block_overlap_matches_baseline(p, seed, order_by_mean_r):
+    R, ids = _ld(p, seed)
+    expected = _baseline_resolve(find_maximal_clique_blocks(R, ids), R)
+    candidates = find_maximal_clique_blocks(R, ids, order_by_mean_r=order_by_mean_r)
+    kept = resolve_block_overlap(candidates, R)
+    assert [blk['snps'].tolist() for blk in kept] == [snps for snps, _ in expected]
+    np.testing.assert_allclose([blk['mean_r'] for blk in kept], [r for _, r in expected], rtol=0, atol=1e-12)
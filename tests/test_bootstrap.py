@@ -0,0 +1,269 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import write_locus
+from ld_matrix import pivot_ld_to_matrix
+from diagnostics import SILENT, SUMMARY, CALL
+from cojo_engine import perturb_replicates, child_seed_sequence, wilson_interval, frequencies_resolved
+from finemap_pipeline import (build_enriched_blocks_pipeline, bootstrap_selection_paths,
+                              bootstrap_selection_paths_two_traits, compute_stable_square_beta,
+                              apply_spectral_truncation, run_fine_mapping_for_signal)
+
+## (p, seed)：write_locus 合成的 locus，按 block 拼好 clean 空间后直接跑 bootstrap
+SIGNAL_CASES = [(60, 1), (90, 4)]
+
+
+def _load(folder, p, seed):
+    csv_path, pq_path = write_locus(folder, f'sig{seed}', p=p, seed=seed)
+    gene_df = pd.read_csv(csv_path).set_index('SNP')
+    return gene_df, pivot_ld_to_matrix(pd.read_parquet(pq_path), snps=gene_df.index.astype(str))
+
+
+def _signal(folder, p, seed):
+    gene_df, ld_df = _load(folder, p, seed)
+    snps = ld_df.index
+    z_gwas = (gene_df.loc[snps, 'BETA_GWAS'] / gene_df.loc[snps, 'SE_GWAS']).values
+    z_qtl = (gene_df.loc[snps, 'beta_QTL'] / gene_df.loc[snps, 'SE_QTL']).values
+    blocks_result = build_enriched_blocks_pipeline(ld_df.values, z_gwas, z_qtl, snps)
+    R_clean = blocks_result['R_extended'].clean(blocks_result['remaining_snp_idx'])
+    return {
+        'blocks': blocks_result['blocks'],
+        'z': z_gwas,
+        'z_qtl': z_qtl,
+        'snp_list': list(snps),
+        'remaining_snp_idx': blocks_result['remaining_snp_idx'],
+        'R_clean': R_clean,
+    }
+
+
+def _bootstrap(signal, n_bootstraps=40, z_perturb_sd=0.05, **options):
+    return bootstrap_selection_paths(
+        signal['blocks'], signal['z'], None, signal['snp_list'], 'gwas', signal['remaining_snp_idx'],
+        n_bootstraps, z_perturb_sd, R_clean=signal['R_clean'], verbose=SILENT, **options)
+
+
+@pytest.fixture(params=SIGNAL_CASES, ids=lambda case: f'p{case[0]}-s{case[1]}')
+def signal(request, tmp_path):
+    return _signal(tmp_path, *request.param)
+
+
+########## lockstep 与逐次 forward_selection
+@pytest.mark.parametrize('use_shared_context', [False, True])
+def test_lockstep_matches_sequential(signal, use_shared_context):
+    ## 两种 engine 消耗的随机数序列相同（lockstep 一次抽出整批），路径应逐个相同
+    results = {}
+    for engine in ('sequential', 'lockstep'):
+        options = {}
+        if use_shared_context:
+            ## 共用谱截断上下文：lockstep 沿用 sequential 留下的投影缓存，trie 也从空开始建
+            options['spectral_context'] = results['sequential'][1] if results else \
+                apply_spectral_truncation(signal['R_clean'], verbose=SILENT)
+        np.random.seed(2024)
+        results[engine] = (_bootstrap(signal, engine=engine, **options), options.get('spectral_context'))
+    seq, lock = results['sequential'][0], results['lockstep'][0]
+    assert lock['all_selected_paths'] == seq['all_selected_paths']
+    assert lock['selection_counter'] == seq['selection_counter']
+    assert lock['selection_frequency'] == seq['selection_frequency']
+    assert lock['stable_snp_id'] == seq['stable_snp_id']
+    assert lock['avg_completion'] == pytest.approx(seq['avg_completion'], rel=1e-9)
+    assert len({tuple(path) for path in seq['all_selected_paths']}) > 1      ## 扰动足够大，路径确有分叉
+
+
+########## 进程并行：每个重复独立的随机流
+def _same_output(a, b):
+    assert a['all_selected_paths'] == b['all_selected_paths']
+    assert a['selection_frequency'] == b['selection_frequency']
+    assert a['avg_completion'] == b['avg_completion']
+    assert a['bootstrap_seed'] == b['bootstrap_seed']
+    np.testing.assert_array_equal(a['Z_replicates'], b['Z_replicates'])
+
+
+def test_parallel_fixed_seed_independent_of_n_workers(signal):
+    ## 40 个重复切成 3 块（DEFAULT_BOOTSTRAP_CHUNK = 16）：1 个进程内计算、2 / 3 个 worker 分块计算结果逐位相同
+    runs = [_bootstrap(signal, engine='parallel', seed=7, n_workers=n_workers, store_replicates=True)
+            for n_workers in (1, 2, 3)]
+    for other in runs[1:]:
+        _same_output(runs[0], other)
+    assert runs[0]['bootstrap_seed'] == 7
+    np.testing.assert_array_equal(
+        runs[0]['Z_replicates'], perturb_replicates(runs[0]['Z_clean'], runs[0]['z_perturb_sd'], 7, 0, 40))
+    assert len({tuple(path) for path in runs[0]['all_selected_paths']}) > 1
+
+
+def test_parallel_random_seed_is_recorded(signal):
+    first = _bootstrap(signal, engine='parallel', n_workers=1, store_replicates=True)
+    again = _bootstrap(signal, engine='parallel', seed=first['bootstrap_seed'], n_workers=2, store_replicates=True)
+    _same_output(first, again)
+    other = _bootstrap(signal, engine='parallel', seed=first['bootstrap_seed'] + 1, n_workers=1)
+    assert other['all_selected_paths'] != first['all_selected_paths']
+
+
+def test_two_traits_parallel_use_separate_streams(signal):
+    ## 同一个 seed：GWAS / QTL 各用一个子流，第 i 个重复的扰动不同；各自可由 (bootstrap_seed, bootstrap_spawn_key) 复现
+    gwas, qtl = bootstrap_selection_paths_two_traits(
+        signal['blocks'], signal['z'], signal['z_qtl'], None, signal['snp_list'], signal['remaining_snp_idx'],
+        40, 0.05, R_clean=signal['R_clean'], verbose=SILENT,
+        engine='parallel', seed=7, n_workers=1, store_replicates=True)
+    noise_gwas = gwas['Z_replicates'] - gwas['Z_clean']
+    noise_qtl = qtl['Z_replicates'] - qtl['Z_clean']
+    assert not np.allclose(noise_gwas, noise_qtl)
+    for trait_idx, (analysis_type, z, result) in enumerate((('gwas', signal['z'], gwas),
+                                                              ('qtl', signal['z_qtl'], qtl))):
+        assert result['bootstrap_seed'] == 7
+        assert result['bootstrap_spawn_key'] == (trait_idx,)
+        alone = bootstrap_selection_paths(
+            signal['blocks'], z, None, signal['snp_list'], analysis_type, signal['remaining_snp_idx'], 40, 0.05,
+            R_clean=signal['R_clean'], verbose=SILENT, engine='parallel', seed=child_seed_sequence(7, trait_idx),
+            n_workers=1, store_replicates=True)
+        _same_output(result, alone)
+        assert alone['bootstrap_spawn_key'] == (trait_idx,)
+
+        ## 不保存扰动时，置信区间按记录的随机流重新生成，与保存的扰动算出的相同
+        with_reps = compute_stable_square_beta(result, frequency_threshold=0.5, ci_level=0.9, verbose=SILENT)
+        regenerated = compute_stable_square_beta({**result, 'Z_replicates': None}, frequency_threshold=0.5,
+                                                 ci_level=0.9, verbose=SILENT)
+        assert with_reps['stable_snps']
+        assert regenerated['beta_multivar_ci'] == with_reps['beta_multivar_ci']
+        assert regenerated['beta_square_ci'] == with_reps['beta_square_ci']
+
+
+########## 自适应：Wilson 置信区间离开阈值即停止
+def test_wilson_interval_matches_formula():
+    for n in (1, 7, 20, 100):
+        for count in range(n + 1):
+            phat, z = count / n, 1.96
+            center = (phat + z * z / (2 * n)) / (1 + z * z / n)
+            half = z * np.sqrt(phat * (1 - phat) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+            lower, upper = wilson_interval([count], n, z)
+            assert lower[0] == pytest.approx(max(0.0, center - half), abs=1e-12)
+            assert upper[0] == pytest.approx(min(1.0, center + half), abs=1e-12)
+            assert lower[0] - 1e-12 <= phat <= upper[0] + 1e-12
+    ## 全部 / 从未入选：20 次时下界还不到 0.9，40 次时两个阈值都已确定
+    assert not frequencies_resolved([20, 0], 20).all()
+    np.testing.assert_array_equal(frequencies_resolved([40, 0, 34, 30], 40), [True, True, False, False])
+
+
+def _checkpoints(result, batch_size=20, min_bootstraps=20):
+    """每批结束时（自适应的检查点）各变量的选择次数"""
+    snp_list = result['snp_list_clean']
+    n = min_bootstraps
+    while n <= result['n_bootstraps_used']:
+        counts = dict.fromkeys(snp_list, 0)
+        for path in result['all_selected_paths'][:n]:
+            for snp_id in path:
+                counts[snp_id] += 1
+        yield n, np.array([counts[snp_id] for snp_id in snp_list])
+        n += batch_size
+
+
+def test_adaptive_stops_once_frequencies_resolve(signal):
+    ## 扰动极小：各重复路径相同，频率只有 0 / 1，第 2 批（40 次）后置信区间都离开 0.8 / 0.9
+    np.random.seed(11)
+    result = _bootstrap(signal, n_bootstraps=100, z_perturb_sd=1e-6, engine='lockstep', adaptive=True)
+    assert result['early_stopped']
+    assert result['n_bootstraps_used'] == 40
+    assert set(result['selection_frequency'].values()) <= {0.0, 1.0}
+    assert len(result['all_selected_paths']) == 40
+
+
+@pytest.mark.parametrize('engine, z_perturb_sd', [('lockstep', 0.01), ('lockstep', 0.3), ('parallel', 0.01)])
+def test_adaptive_stop_rule(signal, engine, z_perturb_sd):
+    options = {'seed': 5, 'n_workers': 1} if engine == 'parallel' else {}
+    np.random.seed(11)
+    full = _bootstrap(signal, n_bootstraps=100, z_perturb_sd=z_perturb_sd, engine=engine, **options)
+    np.random.seed(11)
+    result = _bootstrap(signal, n_bootstraps=100, z_perturb_sd=z_perturb_sd, engine=engine, adaptive=True, **options)
+    n_used = result['n_bootstraps_used']
+    ## 提前停止只截断重复序列，不改变前 n_used 次的路径；频率以实际次数为分母
+    assert result['all_selected_paths'] == full['all_selected_paths'][:n_used]
+    counts = dict(result['selection_counter'])
+    assert all(result['selection_frequency'][snp_id] == counts.get(snp_id, 0) / n_used
+               for snp_id in result['snp_list_clean'])
+    ## 停在第一个所有频率都已确定的检查点；没有提前停止时跑满上限
+    resolved = [(n, frequencies_resolved(c, n).all()) for n, c in _checkpoints(result)]
+    assert not any(ok for n, ok in resolved[:-1])
+    assert resolved[-1][0] == n_used
+    assert result['early_stopped'] == (n_used < 100)
+    if result['early_stopped']:
+        assert resolved[-1][1]
+
+
+########## 输出级别
+@pytest.mark.parametrize('verbose', [SILENT, SUMMARY, CALL])
+def test_run_fine_mapping_verbose(tmp_path, capsys, verbose):
+    gene_df, ld_df = _load(tmp_path, 60, 1)
+    options = {'engine': 'parallel', 'seed': 3, 'n_workers': 1}
+    results = run_fine_mapping_for_signal(gene_df, ld_df, 'BETA_GWAS', 'SE_GWAS', 'beta_QTL', 'SE_QTL',
+                                          bootstrap_options=options, verbose=verbose)
+    out = capsys.readouterr().out
+    assert ('compute_stable_square_beta 输入诊断' in out) == (verbose >= CALL)
+    assert ('GWAS 分析诊断' in out) == (verbose >= CALL)
+    if verbose == SILENT:
+        assert out == ''
+    ## 输出级别不影响结果
+    quiet = run_fine_mapping_for_signal(gene_df, ld_df, 'BETA_GWAS', 'SE_GWAS', 'beta_QTL', 'SE_QTL',
+                                        bootstrap_options={**options, 'verbose': SILENT})
+    assert results[1]['beta_multivar'] == quiet[1]['beta_multivar']
+    assert results[3]['beta_multivar'] == quiet[3]['beta_multivar']
+
+
+########## 稳定变量的效应与 bootstrap 置信区间
+def _baseline_stable_beta(result, frequency_threshold=0.9, min_beta_weight=1e-8):
+    """原实现（notebook 第 12 格 compute_stable_square_beta）的计算部分，返回 (stable_snp_ids, beta, beta²权重, 条件数)"""
+    stable_snp_ids = [snp_id for snp_id, freq in result['selection_frequency'].items() if freq >= frequency_threshold]
+    snp_to_idx = {snp: idx for idx, snp in enumerate(result['snp_list_clean'])}
+    stable_indices = [snp_to_idx[snp_id] for snp_id in stable_snp_ids]
+    R_sub = result['R_clean'][np.ix_(stable_indices, stable_indices)]
+    z_sub = result['Z_clean'][stable_indices]
+    U_sub = result['U_trunc'][stable_indices, :]
+    R_sub_inv = U_sub @ np.diag(1.0 / result['Lambda_trunc']) @ U_sub.T
+    beta = (R_sub_inv @ z_sub).flatten()
+    weights = beta ** 2
+    total_weight = weights.sum()
+    if total_weight < min_beta_weight or total_weight == 0:
+        beta_squared_weight = np.ones_like(weights) / len(weights)
+    else:
+        beta_squared_weight = weights / total_weight
+    cond_num = np.linalg.cond(R_sub) if len(stable_indices) > 1 else 1.0
+    return stable_snp_ids, beta, beta_squared_weight, cond_num
+
+
+def _baseline_ci(result, Z_reps, ci_level, frequency_threshold, min_beta_weight=1e-8):
+    """旧做法：每个扰动 Z 单独重跑一次稳定 beta，再逐个变量取百分位"""
+    betas, weights = [], []
+    for z_rep in Z_reps:
+        _, beta, w, _ = _baseline_stable_beta({**result, 'Z_clean': z_rep}, frequency_threshold, min_beta_weight)
+        betas.append(beta)
+        weights.append(w)
+    alpha = (1 - ci_level) / 2
+    return (np.quantile(np.array(betas), [alpha, 1 - alpha], axis=0),
+            np.quantile(np.array(weights), [alpha, 1 - alpha], axis=0))
+
+
+@pytest.mark.filterwarnings('ignore:Sum of beta')
+@pytest.mark.parametrize('min_beta_weight', [1e-8, 1e12])
+def test_stable_beta_and_ci_match_per_replicate_loop(signal, min_beta_weight):
+    ## min_beta_weight 很大时每个重复都退回均匀权重
+    np.random.seed(3)
+    result = _bootstrap(signal, engine='lockstep', z_perturb_sd=0.3, store_replicates=True)
+    spectral = apply_spectral_truncation(signal['R_clean'], verbose=SILENT)
+    for ci_level in (0.9, 0.5):
+        threshold = 0.5
+        stable = compute_stable_square_beta(result, frequency_threshold=threshold, min_beta_weight=min_beta_weight,
+                                            ci_level=ci_level, spectral_context=spectral, verbose=SILENT)
+        stable_ids, beta, weights, cond_num = _baseline_stable_beta(result, threshold, min_beta_weight)
+        assert len(stable_ids) > 1
+        assert stable['stable_snps'] == stable_ids
+        np.testing.assert_allclose([stable['beta_multivar'][s] for s in stable_ids], beta, rtol=1e-10)
+        np.testing.assert_allclose([stable['beta_square'][s] for s in stable_ids], weights, rtol=1e-10)
+        assert stable['R_sub_condition_number'] == pytest.approx(cond_num, rel=1e-8)
+        assert 'beta_multivar_ci' not in result                     ## 输入不被修改
+
+        (beta_lo, beta_hi), (w_lo, w_hi) = _baseline_ci(result, result['Z_replicates'], ci_level, threshold,
+                                                         min_beta_weight)
+        assert stable['n_ci_replicates'] == len(result['Z_replicates']) == 40
+        np.testing.assert_allclose([stable['beta_multivar_ci'][s] for s in stable_ids],
+                                   np.column_stack([beta_lo, beta_hi]), rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose([stable['beta_square_ci'][s] for s in stable_ids],
+                                   np.column_stack([w_lo, w_hi]), rtol=1e-10, atol=1e-12)
@@ -0,0 +1,205 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import synth_ld, write_locus
+from cojo_engine import (ProjectorCache, SelectionTrie, spectral_truncation, lockstep_forward_selection,
+                         estimate_sigma2_batch, estimate_sigma2)
+from finemap_pipeline import estimate_sigma_ire
+
+## (p, seed)：块内强相关的 LD，截断后 k < p
+LD_CASES = [(40, 0), (80, 3), (120, 7)]
+
+
+def _case(p, seed):
+    R = synth_ld(p, seed=seed)
+    spectral = spectral_truncation(R, solver='dense')
+    rng = np.random.default_rng(seed + 100)
+    z = R @ rng.normal(0, 2, p) + rng.normal(size=p)
+    return R, spectral, z, rng
+
+
+def _selections(p, rng):
+    return [[], [int(rng.integers(p))]] + [sorted(rng.choice(p, m, replace=False).tolist()) for m in (2, 5, 9)]
+
+
+########## 原实现（notebook 第 8 格 compute_conditional_z，去掉 limit_warnings 装饰器）
+def _baseline_conditional_z(z, R, selected_indices, U_trunc, Lambda_trunc):
+    if len(selected_indices) == 0:
+        return z.copy()
+    S = selected_indices
+    R_full_sub = R[:, S]
+    z_selected = z[S]
+    U_global_S = U_trunc[S, :]
+    R_sub_inv = U_global_S @ np.diag(1.0 / Lambda_trunc) @ U_global_S.T
+    beta = R_sub_inv @ z_selected
+    return z - R_full_sub @ beta
+
+
+@pytest.mark.parametrize('p, seed', LD_CASES)
+def test_conditional_z_matches_baseline(p, seed):
+    R, spectral, z, rng = _case(p, seed)
+    cache = ProjectorCache(R, spectral.U, spectral.Lambda)
+    Z = np.vstack([z, z[::-1], rng.normal(size=p)])
+    for S in _selections(p, rng):
+        expected = _baseline_conditional_z(z, R, S, spectral.U, spectral.Lambda)
+        np.testing.assert_allclose(cache.conditional_z(z, S), expected, rtol=1e-10, atol=1e-10)
+        np.testing.assert_allclose(cache.conditional_z(z, S[::-1]), expected, rtol=1e-10, atol=1e-10)
+        np.testing.assert_allclose(spectral.conditional_z(z, S), expected, rtol=1e-10, atol=1e-10)
+        batch = cache.conditional_z_batch(Z, S)
+        for row, z_row in zip(batch, Z):
+            np.testing.assert_allclose(
+                row, _baseline_conditional_z(z_row, R, S, spectral.U, spectral.Lambda), rtol=1e-10, atol=1e-10)
+    assert cache.hits > 0
+
+
+def test_conditional_z_after_eviction():
+    R, spectral, z, rng = _case(80, 3)
+    selections = _selections(80, rng)[1:]
+    ## 限额只够一个条目：每次都会淘汰，结果仍与原实现一致
+    cache = ProjectorCache(R, spectral.U, spectral.Lambda, max_bytes=80 * 9 * 8 + spectral.k * 9 * 8 + 9 * 8)
+    for S in selections + selections:
+        np.testing.assert_allclose(cache.conditional_z(z, S),
+                                   _baseline_conditional_z(z, R, S, spectral.U, spectral.Lambda),
+                                   rtol=1e-10, atol=1e-10)
+        assert cache.nbytes <= cache.max_bytes
+    assert len(cache) == 1
+
+
+########## 原实现的候选打分（notebook 第 10 格：每个候选重算 z_cond，再求 z_condᵀ P z_cond）
+def _baseline_energies(z, R, selected, candidates, U_trunc, Lambda_trunc):
+    P = U_trunc @ np.diag(1.0 / Lambda_trunc) @ U_trunc.T
+    out = []
+    for idx in candidates:
+        z_cond_temp = _baseline_conditional_z(z, R, selected + [int(idx)], U_trunc, Lambda_trunc)
+        out.append(z_cond_temp @ P @ z_cond_temp)
+    return np.array(out)
+
+
+@pytest.mark.parametrize('p, seed', LD_CASES)
+def test_candidate_energies_match_baseline(p, seed):
+    R, spectral, z, rng = _case(p, seed)
+    cache = ProjectorCache(R, spectral.U, spectral.Lambda)
+    P = spectral.U @ np.diag(1.0 / spectral.Lambda) @ spectral.U.T
+    Z = np.vstack([z, rng.normal(size=p), R @ rng.normal(size=p)])
+    Y = cache.energy_basis_batch(Z)
+    y = cache.energy_basis(z)
+    assert y @ y == pytest.approx(z @ P @ z, rel=1e-10)
+    for S in _selections(p, rng):
+        candidates = np.setdiff1d(np.arange(p), S)
+        z_cond = _baseline_conditional_z(z, R, S, spectral.U, spectral.Lambda)
+        assert cache.residual_energy(y, z, S) == pytest.approx(z_cond @ P @ z_cond, rel=1e-9, abs=1e-9)
+
+        expected = _baseline_energies(z, R, S, candidates, spectral.U, spectral.Lambda)
+        energies = cache.candidate_energies(y, z, S, candidates)
+        np.testing.assert_allclose(energies, expected, rtol=1e-9, atol=1e-9)
+        assert candidates[np.argmin(energies)] == candidates[np.argmin(expected)]
+
+        ## 多行版本（小 chunk 走分段路径）与逐行的原实现一致
+        batch = cache.candidate_energies_batch(Y, Z, S, candidates, chunk_elems=spectral.k * len(candidates))
+        for row, z_row in zip(batch, Z):
+            np.testing.assert_allclose(
+                row, _baseline_energies(z_row, R, S, candidates, spectral.U, spectral.Lambda), rtol=1e-9, atol=1e-9)
+
+        ## 每行一个候选
+        paired = rng.choice(candidates, len(Z))
+        np.testing.assert_allclose(
+            cache.paired_candidate_energies(Y, Z, S, paired),
+            [_baseline_energies(z_row, R, S, [j], spectral.U, spectral.Lambda)[0] for z_row, j in zip(Z, paired)],
+            rtol=1e-9, atol=1e-9)
+
+
+########## 选择路径 trie：参考展开 + margin 确定的最优候选与重新完整打分一致
+@pytest.mark.parametrize('p, seed', LD_CASES)
+def test_trie_prediction_matches_full_scoring(p, seed):
+    R, spectral, z, rng = _case(p, seed)
+    cache = ProjectorCache(R, spectral.U, spectral.Lambda)
+    trie = SelectionTrie(cache)
+    n_decided = 0
+    for S in _selections(p, rng):
+        J = np.setdiff1d(np.arange(p), S)
+        terms = cache.candidate_terms(S, J)
+        node = trie.root
+        for j in S:
+            node = trie.child(node, j)
+        y = cache.energy_basis(z)
+        trie.set_reference(node, terms, z, y, cache.candidate_energies(y, z, S, J))
+        assert node.ref is not None
+
+        ## 扰动从极小到很大：小扰动应由 margin 直接确定，大扰动可以确定不了，但确定的必须正确
+        Z = z + rng.normal(size=(24, p)) * np.repeat([1e-4, 1e-2, 0.3, 3.0], 6)[:, None]
+        ok, best = trie.predict(node, terms, Z, cache.energy_basis_batch(Z))
+        for row in np.flatnonzero(ok):
+            expected = _baseline_energies(Z[row], R, S, J, spectral.U, spectral.Lambda)
+            assert J[best[row]] == J[np.argmin(expected)]
+        assert ok[:6].all()
+        n_decided += int(ok.sum())
+    assert n_decided > 0
+
+
+@pytest.mark.parametrize('p, seed', LD_CASES)
+def test_lockstep_paths_with_and_without_trie(p, seed):
+    R, spectral, z, rng = _case(p, seed)
+    for sd in (0.01, 0.2):
+        Z = z + rng.normal(0, sd, size=(30, p))
+        paths_trie, comp_trie = lockstep_forward_selection(Z, spectral, 1.0, use_trie=True)
+        paths_full, comp_full = lockstep_forward_selection(Z, spectral, 1.0, use_trie=False)
+        assert paths_trie == paths_full
+        np.testing.assert_allclose(comp_trie, comp_full, rtol=1e-10)
+    assert spectral.selection_trie.shortcuts > 0
+
+
+########## 背景方差：原实现（notebook 第 7 格 estimate_sigma_ire，每轮 argsort）
+def _baseline_sigma_ire(z_cond, tol=1e-2, max_iter=10):
+    z = np.asarray(z_cond).flatten()
+    if len(z) == 0:
+        return 1.0
+    sigma2 = np.median(z**2) / 0.454936448
+    for iter_idx in range(max_iter):
+        w = np.exp(-z**2 / (2 * sigma2 + 1e-8))
+        z2 = z**2
+        sorted_idx = np.argsort(z2)
+        z2_sorted = z2[sorted_idx]
+        w_sorted = w[sorted_idx]
+        cumw = np.cumsum(w_sorted)
+        target = 0.5 * cumw[-1]
+        weighted_median_z2 = z2_sorted[np.searchsorted(cumw, target, side='right') - 1]
+        sigma2_new = np.clip(weighted_median_z2 / 0.454936448, 0.8, 5.0)
+        if abs(sigma2_new - sigma2) < tol:
+            sigma2 = sigma2_new
+            break
+        sigma2 = sigma2_new
+    return sigma2
+
+
+def _sigma_vectors(tmp_path):
+    rng = np.random.default_rng(5)
+    vectors = [rng.normal(0, scale, size) for scale in (0.5, 1.0, 1.5, 2.5) for size in (1, 2, 7, 50, 501)]
+    vectors += [np.concatenate([rng.normal(size=300), rng.normal(0, 12, 30)]),    ## 少数强信号
+                np.round(rng.normal(0, 2, 200)),                                   ## 大量并列的 z²
+                np.zeros(20), np.full(9, 3.0)]
+    for seed in range(3):
+        df = pd.read_csv(write_locus(tmp_path, f'sigma{seed}', p=80, seed=seed)[0])
+        vectors += [(df['BETA_GWAS'] / df['SE_GWAS']).values, (df['beta_QTL'] / df['SE_QTL']).values]
+    return vectors
+
+
+@pytest.mark.parametrize('tol, max_iter', [(1e-2, 10), (1e-6, 50), (1e-2, 1), (0.0, 3)])
+def test_sigma2_batch_matches_baseline(tmp_path, tol, max_iter):
+    vectors = _sigma_vectors(tmp_path)
+    expected = np.array([_baseline_sigma_ire(z, tol, max_iter) for z in vectors])
+    ## 长度不一：NaN 补齐后一次估计
+    np.testing.assert_allclose(estimate_sigma2_batch(vectors, tol=tol, max_iter=max_iter), expected,
+                               rtol=1e-12, atol=0)
+    for z, sigma2 in zip(vectors, expected):
+        assert estimate_sigma2(z, tol=tol, max_iter=max_iter) == pytest.approx(sigma2, rel=1e-12)
+        assert estimate_sigma_ire(z, tol=tol, max_iter=max_iter) == pytest.approx(sigma2, rel=1e-12)
+    ## 等长的矩阵输入（各 bootstrap 重复）
+    Z = np.vstack([vectors[-1] + np.random.default_rng(i).normal(0, 0.5, 80) for i in range(12)])
+    np.testing.assert_allclose(estimate_sigma2_batch(Z, tol=tol, max_iter=max_iter),
+                               [_baseline_sigma_ire(z, tol, max_iter) for z in Z], rtol=1e-12, atol=0)
+
+
+def test_sigma2_batch_empty_rows():
+    assert estimate_sigma_ire(np.array([])) == 1.0
+    np.testing.assert_array_equal(estimate_sigma2_batch([np.array([]), np.array([np.nan, np.nan])]), [1.0, 1.0])
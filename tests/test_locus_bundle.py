@@ -0,0 +1,44 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+from conftest import write_locus
+from locus_bundle import write_locus_bundle, bundle_is_current, source_fingerprint, _META_FILE
+
+
+def _bundle_from(folder, csv_path, pq_path, with_fingerprint=True):
+    summary = pd.DataFrame({'BETA_GWAS': [0.1, 0.2]}, index=['rs1', 'rs2'])
+    meta = {'source_fingerprint': source_fingerprint(csv_path, pq_path)} if with_fingerprint else {}
+    return write_locus_bundle(folder / 'loc0_LD_matrix.bundle', np.eye(2), ['rs1', 'rs2'], summary, meta=meta)
+
+
+def test_bundle_is_current_until_sources_change(tmp_path):
+    csv_path, pq_path = write_locus(tmp_path, 'loc0', p=20, seed=0)
+    bundle_dir = _bundle_from(tmp_path, csv_path, pq_path)
+    assert bundle_is_current(bundle_dir, csv_path, pq_path)
+
+    # 只改 mtime（如复制文件）：内容 sha1 相同，仍然有效
+    st = csv_path.stat()
+    os.utime(csv_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert bundle_is_current(bundle_dir, csv_path, pq_path)
+
+    # 重新生成来源（大小相同、内容不同）：过期
+    text = csv_path.read_text()
+    csv_path.write_text(text.replace('rs1000', 'rs1999', 1))
+    assert csv_path.stat().st_size == len(text)
+    assert not bundle_is_current(bundle_dir, csv_path, pq_path)
+
+
+def test_bundle_without_fingerprint_or_sources(tmp_path):
+    csv_path, pq_path = write_locus(tmp_path, 'loc0', p=20, seed=0)
+    bundle_dir = _bundle_from(tmp_path, csv_path, pq_path, with_fingerprint=False)
+    assert not bundle_is_current(bundle_dir, csv_path, pq_path)      ## 旧 bundle 没有记录来源指纹
+
+    bundle_dir = _bundle_from(tmp_path, csv_path, pq_path)
+    csv_path.unlink()
+    assert not bundle_is_current(bundle_dir, csv_path, pq_path)
+    assert bundle_is_current(bundle_dir, csv_path, pq_path, missing_ok=True)
+    with open(bundle_dir / _META_FILE, encoding='utf-8') as f:
+        assert [rec['name'] for rec in json.load(f)['source_fingerprint']] == [csv_path.name, pq_path.name]
@@ -0,0 +1,80 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import locus_driver
+from locus_driver import run_loci
+from job_manifest import JobManifest, MANIFEST_NAME
+
+## 固定种子的 bootstrap：输入相同则 pkl 逐字节相同
+BOOTSTRAP = {'engine': 'parallel', 'seed': 2024, 'n_workers': 1}
+
+
+def _run(folder):
+    return run_loci(folder, n_workers=1, bootstrap_options=BOOTSTRAP, parquet_engine='pyarrow')
+
+
+def _pkl_bytes(folder):
+    return (folder / 'loc0_LD_matrix.pkl').read_bytes()
+
+
+def _edit_csv(folder):
+    csv_path = folder / 'loc0.csv'
+    df = pd.read_csv(csv_path)
+    df['BETA_GWAS'] *= 2
+    df.to_csv(csv_path, index=False)
+
+
+@pytest.mark.parametrize('trust_bundle_meta', [False, True])
+def test_rerun_after_csv_edit_recomputes(locus_folder, monkeypatch, trust_bundle_meta):
+    if trust_bundle_meta:
+        ## 只靠任务清单的输入指纹：即使 bundle 的来源核对（误）判为未变，也要重建
+        monkeypatch.setattr(locus_driver, 'bundle_is_current', lambda *args, **kwargs: True)
+    records = _run(locus_folder)
+    assert [(r['csv_prefix'], r['state']) for r in records] == [('loc0', 'done')]
+    before = _pkl_bytes(locus_folder)
+    with open(locus_folder / 'loc0_LD_matrix.pkl', 'rb') as f:
+        z_before = [blk['z_gwas_block'] for blk in pickle.load(f)['block']['blocks']]
+
+    _edit_csv(locus_folder)
+    records = _run(locus_folder)
+    assert [(r['csv_prefix'], r['state']) for r in records] == [('loc0', 'done')]
+    assert _pkl_bytes(locus_folder) != before
+    with open(locus_folder / 'loc0_LD_matrix.pkl', 'rb') as f:
+        z_after = [blk['z_gwas_block'] for blk in pickle.load(f)['block']['blocks']]
+    assert z_after == pytest.approx([2 * z for z in z_before])
+
+    assert _run(locus_folder) == []         ## 输入不再变化：跳过
+    with JobManifest(locus_folder / MANIFEST_NAME) as manifest:
+        assert manifest.jobs()['loc0']['n_attempts'] == 2
+
+
+def test_rerun_with_unchanged_inputs_is_reproducible(locus_folder):
+    _run(locus_folder)
+    before = _pkl_bytes(locus_folder)
+    (locus_folder / 'loc0.csv').touch()      ## 只改 mtime：任务清单重跑，结果不变
+    assert [r['csv_prefix'] for r in _run(locus_folder)] == ['loc0']
+    assert _pkl_bytes(locus_folder) == before
+
+
+def test_pkl_stores_dense_r_extended(locus_folder):
+    _run(locus_folder)
+    raw = _pkl_bytes(locus_folder)
+    assert b'block_engine' not in raw         ## 读取 pkl 不需要导入 block_engine
+    block = pickle.loads(raw)['block']
+    R_ext = block['R_extended']
+    assert type(R_ext) is np.ndarray
+    n_blocks = len(block['blocks'])
+    assert block['block_positions_in_extended'] == list(range(R_ext.shape[0] - n_blocks, R_ext.shape[0]))
+    np.testing.assert_allclose(R_ext, R_ext.T)
+
+
+def test_pkl_results_have_no_spectral_context(locus_folder):
+    _run(locus_folder)
+    raw = _pkl_bytes(locus_folder)
+    assert b'cojo_engine' not in raw          ## 谱截断上下文只在内存中传递，不进 pkl
+    combined = pickle.loads(raw)
+    for key in ('gwas_bootstrap', 'gwas_stable', 'qtl_bootstrap', 'qtl_stable'):
+        assert 'spectral_context' not in combined[key]
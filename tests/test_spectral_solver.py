@@ -0,0 +1,59 @@
+import os
+import warnings
+
+import numpy as np
+import pytest
+
+from cojo_engine import spectral_truncation, spectral_accuracy, choose_spectral_solver, DENSE_EIGH_MAX_P
+
+
+def ar_block_ld(p, n, rho=0.9, seed=0):
+    """n 个样本的 AR(ρ) 基因型相关矩阵：n > p 时满秩，阈值 0.2 附近有大量特征值"""
+    rng = np.random.default_rng(seed)
+    X = np.empty((n, p))
+    X[:, 0] = rng.standard_normal(n)
+    eps = rng.standard_normal((n, p))
+    for j in range(1, p):
+        X[:, j] = rho * X[:, j - 1] + np.sqrt(1 - rho ** 2) * eps[:, j]
+    X -= X.mean(axis=0)
+    X /= np.linalg.norm(X, axis=0)
+    return X.T @ X
+
+
+@pytest.mark.parametrize('p', [10, DENSE_EIGH_MAX_P - 1, DENSE_EIGH_MAX_P, 12000, 50000])
+def test_auto_never_picks_an_iterative_solver(p):
+    assert choose_spectral_solver(p) == ('dense' if p < DENSE_EIGH_MAX_P else 'subset')
+
+
+def test_subset_matches_dense_on_full_rank_ld():
+    R = ar_block_ld(600, 1000)
+    spectral = spectral_truncation(R, solver='subset')
+    acc = spectral_accuracy(R, spectral)
+    assert acc['k'] == acc['k_dense'] > 100
+    assert acc['max_eigenvalue_error'] < 1e-10
+    assert acc['energy_operator_error'] < 1e-8
+
+
+@pytest.mark.skipif(not os.environ.get('RUN_SLOW_TESTS'), reason='p=12000 的全谱分解需要几分钟和约 4 GB 内存')
+def test_auto_path_at_large_p():
+    """p ≥ 12000 的 'auto'：不走随机方法、不退回；分块对角的 R 可以按块用全谱结果核对"""
+    blocks = [ar_block_ld(3000, 5000, seed=s) for s in range(4)]
+    p = sum(len(b) for b in blocks)
+    R = np.zeros((p, p))
+    start = 0
+    for b in blocks:
+        R[start:start + len(b), start:start + len(b)] = b
+        start += len(b)
+    del blocks
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        spectral = spectral_truncation(R, solver='auto')
+    assert spectral.solver == 'subset'
+    expected, start = [], 0
+    for size in [3000] * 4:
+        vals = np.linalg.eigvalsh(R[start:start + size, start:start + size])
+        expected.append(vals[vals > spectral.threshold])
+        start += size
+    expected = np.sort(np.concatenate(expected))[::-1]
+    assert spectral.k == len(expected)
+    np.testing.assert_allclose(spectral.Lambda, expected, rtol=0, atol=1e-9)